@@ -0,0 +1,91 @@
+import asyncio
+import collections
+import math
+import time
+from metrics import Counter, Gauge, Histogram
+
+queue_seconds = Histogram("admission_queue_seconds", "Time requests waited for a slot of their approach", ["approach"])
+rejected_total = Counter("admission_rejected_total", "Requests rejected because their approach was overloaded", ["approach", "reason"])
+in_flight = Gauge("admission_in_flight", "Requests currently running per approach", ["approach"])
+queued = Gauge("admission_queued", "Requests currently waiting for a slot per approach", ["approach"])
+
+class Overloaded(Exception):
+    def __init__(self, approach: str, retry_after: int):
+        super().__init__(f"Too many requests for approach {approach}, retry in {retry_after}s")
+        self.approach = approach
+        self.retry_after = retry_after
+
+class AdmissionLimiter:
+    """
+    Limits how many requests of one approach run at the same time. Requests over the limit wait in a FIFO queue of
+    at most max_queue entries for at most queue_timeout seconds, anything beyond that is rejected right away with
+    Overloaded, so that a burst against the expensive agent approaches can't starve the cheap ones. The suggested
+    Retry-After is estimated from the queue length and a moving average of how long requests hold their slot.
+    """
+
+    # Weight of the latest run in the moving average of run times
+    SMOOTHING = 0.2
+
+    def __init__(self, name: str, max_concurrency: int, max_queue: int, queue_timeout: float):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.running = 0
+        self.waiters: collections.deque[asyncio.Future] = collections.deque()
+        self.average_run_seconds = 1.0
+        in_flight.set(0, approach=name)
+        queued.set(0, approach=name)
+
+    def retry_after(self) -> int:
+        return max(1, math.ceil((len(self.waiters) + 1) * self.average_run_seconds / self.max_concurrency))
+
+    def reject(self, reason: str):
+        rejected_total.inc(approach=self.name, reason=reason)
+        raise Overloaded(self.name, self.retry_after())
+
+    # Returns the time the slot was granted, to be passed to release()
+    async def acquire(self) -> float:
+        start = time.monotonic()
+        if self.running < self.max_concurrency and not self.waiters:
+            self.running += 1
+        elif len(self.waiters) >= self.max_queue:
+            self.reject("queue_full")
+        else:
+            waiter = asyncio.get_running_loop().create_future()
+            self.waiters.append(waiter)
+            queued.set(len(self.waiters), approach=self.name)
+            try:
+                # release() hands its slot directly to the waiter, running stays unchanged
+                await asyncio.wait_for(waiter, self.queue_timeout)
+            except asyncio.TimeoutError:
+                self.reject("queue_timeout")
+            except asyncio.CancelledError:
+                # The client went away right after it was handed a slot, pass the slot on
+                if waiter.done() and not waiter.cancelled():
+                    self.hand_over()
+                raise
+            finally:
+                if waiter in self.waiters:
+                    self.waiters.remove(waiter)
+                queued.set(len(self.waiters), approach=self.name)
+
+        granted = time.monotonic()
+        queue_seconds.observe(granted - start, approach=self.name)
+        in_flight.set(self.running, approach=self.name)
+        return granted
+
+    def release(self, granted: float):
+        self.average_run_seconds += self.SMOOTHING * (time.monotonic() - granted - self.average_run_seconds)
+        self.hand_over()
+
+    def hand_over(self):
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                break
+        else:
+            self.running -= 1
+        queued.set(len(self.waiters), approach=self.name)
+        in_flight.set(self.running, approach=self.name)
@@ -0,0 +1,119 @@
+from typing import Any, Awaitable, Callable, Optional
+from langchain.agents import Tool, AgentExecutor
+from langchain.agents.agent import Agent
+from langchain.callbacks.base import BaseCallbackHandler
+from langchain.callbacks.manager import CallbackManager, Callbacks
+from langchain.schema import AgentAction, AgentFinish, OutputParserException
+from metrics import Counter, Histogram
+from nearduplicates import word_similarity
+from tracing import current_trace
+
+agent_iterations = Histogram("agent_iterations", "Iterations of the agent loop it took to answer a request", ["approach"], buckets=(1, 2, 3, 4, 5, 6, 8, 10))
+agent_tool_calls = Histogram("agent_tool_calls", "Tool calls of the agent to answer a request, including the ones answered from the memo", ["approach"], buckets=(0, 1, 2, 3, 4, 5, 6, 8, 10))
+agent_tool_calls_total = Counter("agent_tool_calls_total", "Tool calls of agents, by whether the tool ran or the observation of an earlier call of the request was reused", ["approach", "tool", "result"])
+agent_early_stops_total = Counter("agent_early_stops_total", "Agent runs stopped early because their tool calls stopped finding anything new", ["approach"])
+
+# Answer of an agent that was stopped early and didn't come up with an answer when asked for one
+NO_ANSWER = "I don't know, please contact customer support."
+
+class AgentStalled(Exception):
+    pass
+
+def approach_name() -> str:
+    request_trace = current_trace.get()
+    return request_trace.tags["approach"] if request_trace else ""
+
+class ToolMemo(BaseCallbackHandler):
+    """
+    Tool calls of one agent run. Agents often call a tool again with the same input, or one worded almost the same, e.g.
+    "car insurance coverage" after "Car insurance coverage?", and such a call gets the observation of the earlier call
+    instead of running the tool again. A call answered from the memo, or one whose observation the agent already had,
+    makes no progress. After max_stalls of those the run is stopped, and the agent is asked once for its final answer
+    from what it found so far instead of going on until max_iterations.
+
+    The memo is a callback handler of the run as well, it keeps the agent's actions with their observations to ask for
+    that answer, and counts the iterations.
+    """
+
+    # Callbacks that don't run inline are called from a thread pool, after the agent may already have gone on
+    run_inline = True
+
+    # Jaccard similarity of the words of two tool inputs from which they are considered the same
+    SIMILARITY = 0.75
+
+    def __init__(self, max_stalls: int = 2):
+        self.max_stalls = max_stalls
+        self.stalls = 0
+        self.iterations = 0
+        self.tool_calls = 0
+        self.observations: dict[str, list[tuple[str, Any]]] = {}
+        self.steps: list[tuple[AgentAction, str]] = []
+        self.action: Optional[AgentAction] = None
+
+    def tool(self, name: str, description: str, coroutine: Callable[[str], Awaitable[Any]], callbacks: Optional[CallbackManager] = None) -> Tool:
+        async def memoized(tool_input: str) -> Any:
+            return await self.call(name, tool_input, coroutine)
+        return Tool(name=name, func=lambda _: "Not implemented", coroutine=memoized, description=description, callbacks=callbacks)
+
+    async def call(self, tool: str, tool_input: str, coroutine: Callable[[str], Awaitable[Any]]) -> Any:
+        self.tool_calls += 1
+        for earlier_input, observation in self.observations.get(tool, []):
+            if word_similarity(earlier_input, tool_input) >= self.SIMILARITY:
+                agent_tool_calls_total.inc(approach=approach_name(), tool=tool, result="memoized")
+                self.stalled(f"{tool}[{tool_input}] was already answered by {tool}[{earlier_input}]")
+                return observation
+
+        observation = await coroutine(tool_input)
+        agent_tool_calls_total.inc(approach=approach_name(), tool=tool, result="ran")
+        known = any(observation == earlier for observations in self.observations.values() for _, earlier in observations)
+        self.observations.setdefault(tool, []).append((tool_input, observation))
+        if known:
+            self.stalled(f"{tool}[{tool_input}] found nothing new")
+        return observation
+
+    def stalled(self, reason: str):
+        self.stalls += 1
+        if self.stalls >= self.max_stalls:
+            agent_early_stops_total.inc(approach=approach_name())
+            raise AgentStalled(f"{reason}, stopping after {self.stalls} tool calls that made no progress")
+
+    async def run(self, executor: AgentExecutor, input: str, callbacks: Callbacks = None, **inputs: Any) -> str:
+        """
+        Runs the agent with this memo as one of its callbacks. inputs are the other variables of the agent's prompt,
+        which are needed to ask a stalled agent for its final answer.
+        """
+        try:
+            return await executor.arun(input, callbacks=[*(callbacks or []), self])
+        except AgentStalled:
+            return await self.final_answer(executor.agent, callbacks, input=input, **inputs)
+        finally:
+            agent_iterations.observe(self.iterations, approach=approach_name())
+            agent_tool_calls.observe(self.tool_calls, approach=approach_name())
+
+    async def final_answer(self, agent: Agent, callbacks: Callbacks, **inputs: Any) -> str:
+        """
+        Asks the agent once more, to answer from the steps so far. This is what LangChain's "generate" early stopping
+        method does, which can't be used here because it calls the LLM synchronously.
+        """
+        full_inputs = agent.get_full_inputs(self.steps, **inputs)
+        if isinstance(full_inputs["agent_scratchpad"], str):
+            full_inputs["agent_scratchpad"] += "\n\nI now need to return a final answer based on the previous steps:"
+        output = await agent.llm_chain.apredict(callbacks=callbacks, **full_inputs)
+        try:
+            parsed = agent.output_parser.parse(output)
+        except OutputParserException:
+            # Not in the agent's format, but an answer all the same
+            return output.strip() or NO_ANSWER
+        return parsed.return_values["output"] if isinstance(parsed, AgentFinish) else NO_ANSWER
+
+    def on_agent_action(self, action: AgentAction, **kwargs: Any) -> Any:
+        self.iterations += 1
+        self.action = action
+
+    def on_agent_finish(self, finish: AgentFinish, **kwargs: Any) -> None:
+        self.iterations += 1
+
+    def on_tool_end(self, output: str, **kwargs: Any) -> None:
+        if self.action:
+            self.steps.append((self.action, output))
+            self.action = None
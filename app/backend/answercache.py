@@ -0,0 +1,121 @@
+import asyncio
+import hashlib
+import json
+import os
+import threading
+import time
+from typing import Any, Optional, Protocol
+from metrics import Counter
+from searchcache import TTLCache, normalize_query
+
+answer_cache_requests_total = Counter("answer_cache_requests_total", "Answers served from the answer cache or generated", ["approach", "result"])
+
+class AnswerStore(Protocol):
+    async def get(self, key: str) -> Optional[Any]: ...
+    async def put(self, key: str, value: Any): ...
+
+class MemoryAnswerStore:
+    """Answers kept in the worker's memory, at most max_entries for at most ttl seconds."""
+
+    def __init__(self, max_entries: int, ttl: float):
+        self.cache = TTLCache(max_entries, ttl)
+
+    async def get(self, key: str) -> Optional[Any]:
+        return self.cache.get(key)
+
+    async def put(self, key: str, value: Any):
+        self.cache.put(key, value)
+
+class DiskAnswerStore:
+    """
+    Answers kept as small JSON files in a directory, so all workers on the machine share them. Files are written to a
+    temporary file and moved into place, reading one updates its modification time, which is used as the last access
+    time when the least recently used answers are evicted. Eviction scans the directory, so it only runs every
+    EVICT_EVERY writes and the store can hold up to that many answers over max_entries.
+    """
+
+    EVICT_EVERY = 100
+
+    def __init__(self, directory: str, max_entries: int, ttl: float):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.writes = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key + ".json")
+
+    # The store is used from the event loop, so all file operations run in a worker thread
+    async def get(self, key: str) -> Optional[Any]:
+        return await asyncio.to_thread(self._get, self._path(key))
+
+    async def put(self, key: str, value: Any):
+        await asyncio.to_thread(self._put, self._path(key), value)
+        self.writes += 1
+        if self.writes % self.EVICT_EVERY == 0:
+            await asyncio.to_thread(self._evict)
+
+    def _get(self, path: str) -> Optional[Any]:
+        try:
+            with open(path, encoding="utf-8") as f:
+                entry = json.load(f)
+            if entry["created_on"] + self.ttl < time.time():
+                return None
+            os.utime(path)
+        except (OSError, ValueError, KeyError):
+            return None
+        return entry["value"]
+
+    def _put(self, path: str, value: Any):
+        # Writes of the same key can run in several threads of the worker at once
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"created_on": time.time(), "value": value}, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    def _evict(self):
+        files = []
+        for file in os.scandir(self.directory):
+            if file.name.endswith(".json"):
+                try:
+                    files.append((file.stat().st_mtime, file.path))
+                except FileNotFoundError:
+                    continue
+        for _, path in sorted(files)[:max(0, len(files) - self.max_entries)]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+class AnswerCache:
+    """
+    Generated answers by everything that determines them: the normalized question, the exact sources put in the prompt
+    (which include the source names and their content), the prompt template, the model deployment and the temperature.
+    Re-indexed content changes the sources, so a stale answer is never found. Sources are keyed as a set, the order
+    search returned them in doesn't change the answer enough to matter.
+    """
+
+    def __init__(self, store: AnswerStore, approach: str):
+        self.store = store
+        self.approach = approach
+
+    def key(self, q: str, sources: list[str], template: str, deployment: str, temperature: float) -> str:
+        return hashlib.sha256(json.dumps([normalize_query(q), sorted(sources), template, deployment, temperature], ensure_ascii=False).encode("utf-8")).hexdigest()
+
+    async def get(self, key: str) -> Optional[str]:
+        answer = await self.store.get(key)
+        answer_cache_requests_total.inc(approach=self.approach, result="miss" if answer is None else "hit")
+        return answer
+
+    async def put(self, key: str, answer: str):
+        await self.store.put(key, answer)
+
+def create_answer_store(backend: str, directory: str, max_entries: int, ttl: float) -> Optional[AnswerStore]:
+    if backend == "memory":
+        return MemoryAnswerStore(max_entries, ttl)
+    if backend == "disk":
+        return DiskAnswerStore(directory, max_entries, ttl)
+    if backend == "none":
+        return None
+    raise ValueError(f"Unknown answer cache backend {backend}, use memory, disk or none")
@@ -1,19 +1,33 @@
 import os
-import io
+import asyncio
+import json
+import tempfile
 import mimetypes
 import time
 import logging
+import aiohttp
 import openai
-from flask import Flask, request, jsonify, send_file, abort
-from azure.identity import DefaultAzureCredential
-from azure.search.documents import SearchClient
-from approaches.retrievethenread import RetrieveThenReadApproach
-from approaches.readretrieveread import ReadRetrieveReadApproach
-from approaches.readdecomposeask import ReadDecomposeAsk
-from approaches.chatretrievethenread import ChatRetrieveThenReadApproach
-from approaches.chatreadretrieveread import ChatReadRetrieveReadApproach
-from azure.storage.blob import BlobServiceClient
-import mimetypes
+from typing import Any, AsyncGenerator
+from quart import Quart, Response, request, jsonify, abort, current_app
+from azure.core.exceptions import ResourceNotFoundError
+from azure.identity.aio import DefaultAzureCredential
+from azure.search.documents.aio import SearchClient
+from approaches.approach import LazyApproaches
+from admission import AdmissionLimiter, Overloaded
+import cassette
+from azure.storage.blob.aio import BlobServiceClient
+from contentcache import ContentCache
+from lookupindex import LookupIndex
+from searchcache import CachingSearchClient, IndexVersionWatcher, TTLCache
+from answercache import AnswerCache, create_answer_store
+from nearduplicates import NearDuplicateIndex
+from openaiclient import CircuitOpenError, ResilientOpenAI
+from overrides import InvalidOverride, positive_override
+from contextpacker import budget_override, start_loading_encoding, stop_loading_encoding
+from deadline import deadline, iterate_within_deadline, remaining
+from metrics import generate_latest
+from tracing import trace
+from tokenmanager import OpenAITokenManager
 
 mimetypes.add_type('application/javascript', '.js')
 mimetypes.add_type('text/css', '.css')
@@ -32,103 +46,496 @@ KB_FIELDS_CONTENT = os.environ.get("KB_FIELDS_CONTENT") or "content"
 KB_FIELDS_CATEGORY = os.environ.get("KB_FIELDS_CATEGORY") or "category"
 KB_FIELDS_SOURCEPAGE = os.environ.get("KB_FIELDS_SOURCEPAGE") or "sourcepage"
 
-# Use the current user identity to authenticate with Azure OpenAI, Cognitive Search and Blob Storage (no secrets needed, 
-# just use 'az login' locally, and managed identity when deployed on Azure). If you need to use keys, use separate AzureKeyCredential instances with the 
-# keys for each service
-# If you encounter a blocking error during a DefaultAzureCredntial resolution, you can exclude the problematic credential by using a parameter (ex. exclude_shared_token_cache_credential=True)
-azure_credential = DefaultAzureCredential()
-
-# Used by the OpenAI SDK
-openai.api_type = "azure_ad"
-openai.api_base = f"https://{AZURE_OPENAI_SERVICE}.openai.azure.com"
-openai.api_version = "2023-06-01-preview"
-
-openai_token = azure_credential.get_token("https://cognitiveservices.azure.com/.default")
-openai.api_key = openai_token.token
-
-# Set up clients for Cognitive Search and Storage
-search_client = SearchClient(
-    endpoint=f"https://{AZURE_SEARCH_SERVICE}.search.windows.net",
-    index_name=AZURE_SEARCH_INDEX,
-    credential=azure_credential)
-blob_client = BlobServiceClient(
-    account_url=f"https://{AZURE_STORAGE_ACCOUNT}.blob.core.windows.net", 
-    credential=azure_credential)
-blob_container = blob_client.get_container_client(AZURE_STORAGE_CONTAINER)
-
-# Various approaches to integrate GPT and external knowledge, most applications will use a single one of these patterns
-# or some derivative, here we include several for exploration purposes
-ask_approaches = {
-    "rtr": RetrieveThenReadApproach(search_client, AZURE_OPENAI_GPT_DEPLOYMENT, KB_FIELDS_SOURCEPAGE, KB_FIELDS_CONTENT),
-    "rrr": ReadRetrieveReadApproach(search_client, AZURE_OPENAI_GPT_DEPLOYMENT, KB_FIELDS_SOURCEPAGE, KB_FIELDS_CONTENT),
-    "rda": ReadDecomposeAsk(search_client, AZURE_OPENAI_GPT_DEPLOYMENT, KB_FIELDS_SOURCEPAGE, KB_FIELDS_CONTENT)
-}
+CONTENT_CACHE_DIR = os.environ.get("CONTENT_CACHE_DIR") or os.path.join(tempfile.gettempdir(), "content-cache")
+CONTENT_CACHE_MAX_BYTES = int(os.environ.get("CONTENT_CACHE_MAX_BYTES") or 512 * 1024 * 1024)
+CONTENT_CACHE_REVALIDATE_SECONDS = int(os.environ.get("CONTENT_CACHE_REVALIDATE_SECONDS") or 300)
+SEARCH_CACHE_MAX_ENTRIES = int(os.environ.get("SEARCH_CACHE_MAX_ENTRIES") or 10000)
+SEARCH_CACHE_TTL_SECONDS = int(os.environ.get("SEARCH_CACHE_TTL_SECONDS") or 3600)
+SEARCH_CACHE_VERSION_CHECK_SECONDS = int(os.environ.get("SEARCH_CACHE_VERSION_CHECK_SECONDS") or 60)
+# Answers of the ask rtr approach, "memory" per worker, "disk" shared by the workers on a machine or "none"
+ANSWER_CACHE_BACKEND = os.environ.get("ANSWER_CACHE_BACKEND") or "memory"
+ANSWER_CACHE_DIR = os.environ.get("ANSWER_CACHE_DIR") or os.path.join(tempfile.gettempdir(), "answer-cache")
+ANSWER_CACHE_MAX_ENTRIES = int(os.environ.get("ANSWER_CACHE_MAX_ENTRIES") or 10000)
+ANSWER_CACHE_TTL_SECONDS = int(os.environ.get("ANSWER_CACHE_TTL_SECONDS") or 24 * 3600)
+# Search queries generated from the chat history by the chat rtr approach, 0 disables the cache
+QUERY_CACHE_MAX_ENTRIES = int(os.environ.get("QUERY_CACHE_MAX_ENTRIES") or 10000)
+QUERY_CACHE_TTL_SECONDS = int(os.environ.get("QUERY_CACHE_TTL_SECONDS") or 24 * 3600)
+# The chat rtr approach searches for guesses of the query while it is generated, see generate_keyword_query_and_search
+SPECULATIVE_SEARCH = os.environ.get("SPECULATIVE_SEARCH") == "1"
+# MULTI_QUERY_SEARCH=1 makes the chat rtr approach search for several variants of the query at once and fuse the
+# results. The variants only use the semantic ranker when the request does, unless MULTI_QUERY_SEMANTIC=1
+MULTI_QUERY_SEARCH = os.environ.get("MULTI_QUERY_SEARCH") == "1"
+MULTI_QUERY_SEMANTIC = os.environ.get("MULTI_QUERY_SEMANTIC") == "1"
+# PARALLEL_SUBQUESTIONS=1 makes the rda approach plan all its searches up front and run them at once, instead of one
+# search per round trip to the LLM
+PARALLEL_SUBQUESTIONS = os.environ.get("PARALLEL_SUBQUESTIONS") == "1"
+# The rda approach looks up terms in the sentences of all indexed sections kept in memory, rebuilt when the index
+# version changes. LOOKUP_INDEX=0 sends every lookup to Cognitive Search instead
+LOOKUP_INDEX = os.environ.get("LOOKUP_INDEX") != "0"
+# At most this many sections are fetched to build the lookup index, a larger index is only partly kept in memory
+LOOKUP_INDEX_MAX_SECTIONS = int(os.environ.get("LOOKUP_INDEX_MAX_SECTIONS") or 10000)
+# Questions this similar to a recent question (Jaccard similarity of their words) share its cached search and answer
+# in the rtr approaches, 0 disables matching similar questions
+NEAR_DUPLICATE_THRESHOLD = float(os.environ.get("NEAR_DUPLICATE_THRESHOLD") or 0.8)
+NEAR_DUPLICATE_MAX_QUESTIONS = int(os.environ.get("NEAR_DUPLICATE_MAX_QUESTIONS") or 10000)
+# Retries of failed Azure OpenAI requests, and how long a rate limited request may be asked to wait before it is retried
+OPENAI_MAX_RETRIES = int(os.environ.get("OPENAI_MAX_RETRIES") or 3)
+OPENAI_MAX_RETRY_AFTER_SECONDS = float(os.environ.get("OPENAI_MAX_RETRY_AFTER_SECONDS") or 30)
+# OPENAI_HEDGE=1 sends a request a second time when it is slower than 95% of recent requests, but at least the min delay
+OPENAI_HEDGE = os.environ.get("OPENAI_HEDGE") == "1"
+OPENAI_HEDGE_MIN_DELAY_SECONDS = float(os.environ.get("OPENAI_HEDGE_MIN_DELAY_SECONDS") or 1)
+# Requests to a deployment fail fast for a while after this many failed in a row
+OPENAI_CIRCUIT_FAILURES = int(os.environ.get("OPENAI_CIRCUIT_FAILURES") or 5)
+OPENAI_CIRCUIT_RESET_SECONDS = float(os.environ.get("OPENAI_CIRCUIT_RESET_SECONDS") or 30)
+# Every request is answered within this many seconds, the approaches cut short or cancel steps that would take longer.
+# Clients can ask for a shorter deadline with the deadline_seconds override
+REQUEST_DEADLINE_SECONDS = float(os.environ.get("REQUEST_DEADLINE_SECONDS") or 30)
+# Time the approaches get after the deadline to answer that they ran out of time, before the request fails with a 504
+DEADLINE_GRACE_SECONDS = 1
+# Written by prepdocs.py to the storage container every time it changed the index
+INDEX_VERSION_BLOB = "index-version.txt"
+WARMUP_TIMEOUT = 10
+OPENAI_TOKEN_CACHE_PATH = os.environ.get("OPENAI_TOKEN_CACHE_PATH") or os.path.join(tempfile.gettempdir(), "openai-token.json")
 
-chat_approaches = {
-    "rtr": ChatRetrieveThenReadApproach(search_client, AZURE_OPENAI_CHATGPT_DEPLOYMENT, KB_FIELDS_SOURCEPAGE, KB_FIELDS_CONTENT),
-    "rrr": ChatReadRetrieveReadApproach(search_client, AZURE_OPENAI_CHATGPT_DEPLOYMENT, KB_FIELDS_SOURCEPAGE, KB_FIELDS_CONTENT)
+# Concurrent requests and queued requests allowed per approach and worker, the agent approaches make several
+# LLM calls per request. Override with e.g. ADMISSION_LIMITS='{"chat:rrr": [4, 8]}'
+ADMISSION_LIMITS = {
+    "ask:rtr": (64, 128),
+    "ask:rrr": (8, 16),
+    "ask:rda": (8, 16),
+    "chat:rtr": (64, 128),
+    "chat:rrr": (8, 16),
+    **json.loads(os.environ.get("ADMISSION_LIMITS") or "{}")
 }
+ADMISSION_QUEUE_TIMEOUT = float(os.environ.get("ADMISSION_QUEUE_TIMEOUT") or 10)
+
+CONFIG_TOKEN_MANAGER = "token_manager"
+CONFIG_OPENAI_SESSION = "openai_session"
+CONFIG_READY = "ready"
+CONFIG_CREDENTIAL = "azure_credential"
+CONFIG_SEARCH_CLIENT = "search_client"
+CONFIG_BLOB_CLIENT = "blob_client"
+CONFIG_BLOB_CONTAINER_CLIENT = "blob_container_client"
+CONFIG_CONTENT_CACHE = "content_cache"
+CONFIG_INDEX_WATCHER = "index_watcher"
+CONFIG_ASK_APPROACHES = "ask_approaches"
+CONFIG_CHAT_APPROACHES = "chat_approaches"
+CONFIG_ADMISSION_LIMITERS = "admission_limiters"
+CONFIG_CASSETTE_RECORDER = "cassette_recorder"
+
+app = Quart(__name__)
+
+@app.before_serving
+async def setup_clients():
+    # Use the current user identity to authenticate with Azure OpenAI, Cognitive Search and Blob Storage (no secrets needed, 
+    # just use 'az login' locally, and managed identity when deployed on Azure). If you need to use keys, use separate AzureKeyCredential instances with the 
+    # keys for each service
+    # If you encounter a blocking error during a DefaultAzureCredntial resolution, you can exclude the problematic credential by using a parameter (ex. exclude_shared_token_cache_credential=True)
+    azure_credential = DefaultAzureCredential()
+
+    # Used by the OpenAI SDK
+    openai.api_type = "azure_ad"
+    openai.api_base = f"https://{AZURE_OPENAI_SERVICE}.openai.azure.com"
+    openai.api_version = "2023-06-01-preview"
+
+    # CASSETTE_MODE=record captures the search and OpenAI traffic to CASSETTE_PATH, replay serves it back from there
+    # without calling either service, so no token is needed. See cassette.py
+    recorder, player = cassette.from_environment()
+
+    # Sets openai.api_key and keeps it fresh in the background, requests never wait for a token
+    token_manager = OpenAITokenManager(azure_credential, OPENAI_TOKEN_CACHE_PATH)
+    if player:
+        token_manager.ready.set()
+    else:
+        token_manager.start()
+
+    # The OpenAI SDK opens a new connection for every call unless it is given a session to reuse
+    openai_session = aiohttp.ClientSession()
+
+    # Set up clients for Cognitive Search and Storage. The async clients keep a pooled connection per service
+    # so concurrent requests share sockets instead of each holding a worker thread while waiting on I/O
+    search_client = SearchClient(
+        endpoint=f"https://{AZURE_SEARCH_SERVICE}.search.windows.net",
+        index_name=AZURE_SEARCH_INDEX,
+        credential=azure_credential)
+    blob_client = BlobServiceClient(
+        account_url=f"https://{AZURE_STORAGE_ACCOUNT}.blob.core.windows.net", 
+        credential=azure_credential)
+    blob_container = blob_client.get_container_client(AZURE_STORAGE_CONTAINER)
+
+    # One check of the index version for everything that depends on the index. A replayed index never changes
+    index_search_client = search_client
+    index_watcher = IndexVersionWatcher(lambda: get_index_version(index_search_client, blob_container), SEARCH_CACHE_VERSION_CHECK_SECONDS) if not player else None
+
+    # The lookup index is built from the index itself, without recording. A replayed index has no sections to build it from
+    lookup_index = LookupIndex(index_search_client, KB_FIELDS_SOURCEPAGE, KB_FIELDS_CONTENT, max_sections=LOOKUP_INDEX_MAX_SECTIONS) if LOOKUP_INDEX and index_watcher else None
+    if lookup_index:
+        index_watcher.subscribe(lookup_index.update_index_version)
+
+    if recorder:
+        recorder.install()
+        search_client = recorder.wrap_search_client(search_client)
+    elif player:
+        player.install()
+        await search_client.close()
+        search_client = player.search_client()
+
+    # Repeated searches are answered from memory, until the index changes or they expire
+    if SEARCH_CACHE_MAX_ENTRIES > 0:
+        search_client = CachingSearchClient(search_client, SEARCH_CACHE_MAX_ENTRIES, SEARCH_CACHE_TTL_SECONDS)
+        if index_watcher:
+            index_watcher.subscribe(search_client.update_index_version)
+    if index_watcher:
+        index_watcher.start()
+
+    app.config[CONFIG_CREDENTIAL] = azure_credential
+    app.config[CONFIG_TOKEN_MANAGER] = token_manager
+    app.config[CONFIG_OPENAI_SESSION] = openai_session
+    app.config[CONFIG_SEARCH_CLIENT] = search_client
+    app.config[CONFIG_BLOB_CLIENT] = blob_client
+    app.config[CONFIG_BLOB_CONTAINER_CLIENT] = blob_container
+    app.config[CONFIG_CONTENT_CACHE] = ContentCache(CONTENT_CACHE_DIR, CONTENT_CACHE_MAX_BYTES)
+    app.config[CONFIG_INDEX_WATCHER] = index_watcher
+    app.config[CONFIG_CASSETTE_RECORDER] = recorder
+
+    near_duplicates = NearDuplicateIndex(NEAR_DUPLICATE_THRESHOLD, NEAR_DUPLICATE_MAX_QUESTIONS) if NEAR_DUPLICATE_THRESHOLD > 0 else None
+    answer_store = create_answer_store(ANSWER_CACHE_BACKEND, ANSWER_CACHE_DIR, ANSWER_CACHE_MAX_ENTRIES, ANSWER_CACHE_TTL_SECONDS)
+    # Shared by all approaches, so they all see the same health and response times of a deployment
+    completions = ResilientOpenAI(OPENAI_MAX_RETRIES, max_retry_after=OPENAI_MAX_RETRY_AFTER_SECONDS, hedge=OPENAI_HEDGE, hedge_min_delay=OPENAI_HEDGE_MIN_DELAY_SECONDS,
+                                  failure_threshold=OPENAI_CIRCUIT_FAILURES, reset_timeout=OPENAI_CIRCUIT_RESET_SECONDS)
+
+    # Various approaches to integrate GPT and external knowledge, most applications will use a single one of these patterns
+    # or some derivative, here we include several for exploration purposes. They are created on first use, or by the warm-up
+    app.config[CONFIG_ASK_APPROACHES] = LazyApproaches({
+        "rtr": "approaches.retrievethenread:RetrieveThenReadApproach",
+        "rrr": "approaches.readretrieveread:ReadRetrieveReadApproach",
+        "rda": "approaches.readdecomposeask:ReadDecomposeAsk"
+    }, search_client, AZURE_OPENAI_GPT_DEPLOYMENT, KB_FIELDS_SOURCEPAGE, KB_FIELDS_CONTENT, options={
+        "rtr": {"answer_cache": AnswerCache(answer_store, "ask:rtr") if answer_store else None, "near_duplicates": near_duplicates, "completions": completions},
+        "rrr": {"completions": completions},
+        "rda": {"completions": completions, "parallel_subquestions": PARALLEL_SUBQUESTIONS, "lookup_index": lookup_index}
+    })
+
+    app.config[CONFIG_CHAT_APPROACHES] = LazyApproaches({
+        "rtr": "approaches.chatretrievethenread:ChatRetrieveThenReadApproach",
+        "rrr": "approaches.chatreadretrieveread:ChatReadRetrieveReadApproach"
+    }, search_client, AZURE_OPENAI_CHATGPT_DEPLOYMENT, KB_FIELDS_SOURCEPAGE, KB_FIELDS_CONTENT, options={
+        "rtr": {"query_cache": TTLCache(QUERY_CACHE_MAX_ENTRIES, QUERY_CACHE_TTL_SECONDS) if QUERY_CACHE_MAX_ENTRIES > 0 else None,
+                "near_duplicates": near_duplicates, "speculative_search": SPECULATIVE_SEARCH, "multi_query_search": MULTI_QUERY_SEARCH,
+                "multi_query_semantic": MULTI_QUERY_SEMANTIC, "completions": completions},
+        "rrr": {"completions": completions}
+    })
+
+    app.config[CONFIG_ADMISSION_LIMITERS] = {
+        key: AdmissionLimiter(key, max_concurrency, max_queue, ADMISSION_QUEUE_TIMEOUT)
+        for key, (max_concurrency, max_queue) in ADMISSION_LIMITS.items()
+    }
+
+    app.config[CONFIG_READY] = False
+    app.add_background_task(warmup)
+
+# Changes whenever prepdocs.py added, removed or re-uploaded documents
+async def get_index_version(search_client, blob_container):
+    try:
+        marker_etag = (await blob_container.get_blob_client(INDEX_VERSION_BLOB).get_blob_properties()).etag
+    except ResourceNotFoundError:
+        marker_etag = None
+    return (await search_client.get_document_count(), marker_etag)
+
+# Runs after the app started taking traffic, /ready reports when it is done
+async def warmup():
+    await app.config[CONFIG_TOKEN_MANAGER].ready.wait()
+
+    # Open the pooled connections to each service, the responses themselves don't matter
+    async def open_connection(name, request):
+        try:
+            await asyncio.wait_for(request, timeout=WARMUP_TIMEOUT)
+        except Exception as e:
+            logging.warning(f"Warm-up request to {name} failed: {e!r}")
+
+    async def open_openai_connection():
+        async with app.config[CONFIG_OPENAI_SESSION].head(openai.api_base):
+            pass
+
+    # Creating the approaches up front also prepares their default prompts
+    async def load_approaches():
+        await app.config[CONFIG_ASK_APPROACHES].load_all()
+        await app.config[CONFIG_CHAT_APPROACHES].load_all()
+
+    # Token counts are estimated until the tokenizer is loaded, which doesn't hold up the warm-up if it has to be retried
+    start_loading_encoding()
+    await asyncio.gather(
+        open_connection("Cognitive Search", app.config[CONFIG_SEARCH_CLIENT].get_document_count()),
+        open_connection("Blob Storage", app.config[CONFIG_BLOB_CONTAINER_CLIENT].get_container_properties()),
+        open_connection("OpenAI", open_openai_connection()),
+        load_approaches())
+
+    app.config[CONFIG_READY] = True
+    logging.info("Warm-up completed")
 
-app = Flask(__name__)
+@app.after_serving
+async def close_clients():
+    await app.config[CONFIG_TOKEN_MANAGER].stop()
+    await stop_loading_encoding()
+    await app.config[CONFIG_OPENAI_SESSION].close()
+    if app.config[CONFIG_INDEX_WATCHER]:
+        await app.config[CONFIG_INDEX_WATCHER].close()
+    await app.config[CONFIG_SEARCH_CLIENT].close()
+    await app.config[CONFIG_BLOB_CLIENT].close()
+    await app.config[CONFIG_CREDENTIAL].close()
+
+@app.before_request
+async def use_openai_session():
+    openai.aiosession.set(app.config[CONFIG_OPENAI_SESSION])
+
+@app.before_request
+async def record_request():
+    recorder = app.config[CONFIG_CASSETTE_RECORDER]
+    if recorder and request.path in cassette.RECORDED_ROUTES and request.is_json:
+        recorder.record_request(request.path, await request.get_json())
+
+@app.route("/health")
+async def health():
+    return jsonify({"status": "ok"})
+
+@app.route("/ready")
+async def ready():
+    if not app.config[CONFIG_READY]:
+        return jsonify({"status": "warming up"}), 503
+    return jsonify({"status": "ready"})
+
+@app.route("/metrics")
+async def metrics():
+    return Response(generate_latest(), mimetype="text/plain; version=0.0.4")
 
 @app.route("/", defaults={"path": "index.html"})
 @app.route("/<path:path>")
-def static_file(path):
-    return app.send_static_file(path)
+async def static_file(path):
+    return await app.send_static_file(path)
 
 # Serve content files from blob storage from within the app to keep the example self-contained. 
 # *** NOTE *** this assumes that the content files are public, or at least that all users of the app
-# can access all the files. This is also slow and memory hungry.
+# can access all the files. Blobs are streamed in chunks and kept in a size bounded disk cache, so opening
+# the same citation again is served locally. Range and If-None-Match requests are answered using the blob's ETag.
 @app.route("/content/<path>")
-def content_file(path):
-    blob = blob_container.get_blob_client(path).download_blob()
-    if not blob.properties or not blob.properties.has_key("content_settings"):
-        abort(404)
-    mime_type = blob.properties["content_settings"]["content_type"]
+async def content_file(path):
+    blob_client = current_app.config[CONFIG_BLOB_CONTAINER_CLIENT].get_blob_client(path)
+    content_cache = current_app.config[CONFIG_CONTENT_CACHE]
+
+    properties = None
+    entry = await content_cache.get(path)
+    if entry and time.time() - entry.validated_on > CONTENT_CACHE_REVALIDATE_SECONDS:
+        # Revalidating only fetches the blob properties, the content is downloaded again only if it changed
+        properties = await get_blob_properties(blob_client)
+        if properties is None or properties.etag != entry.etag:
+            await content_cache.remove(path)
+            entry = None
+        else:
+            entry = await content_cache.revalidated(path, entry)
+
+    if entry:
+        etag, size, mime_type = entry.etag, entry.size, entry.content_type
+    else:
+        properties = properties or await get_blob_properties(blob_client)
+        if properties is None or not properties.has_key("content_settings"):
+            abort(404)
+        etag, size, mime_type = properties.etag, properties.size, properties.content_settings.content_type
     if mime_type == "application/octet-stream":
         mime_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
-    blob_file = io.BytesIO()
-    blob.readinto(blob_file)
-    blob_file.seek(0)
-    return send_file(blob_file, mimetype=mime_type, as_attachment=False, download_name=path)
+
+    if request.if_none_match.contains(etag.strip('"')):
+        response = Response("", status=304)
+        response.headers["ETag"] = etag
+        return response
+
+    status, start, length = 200, 0, size
+    if request.range:
+        byte_range = request.range.range_for_length(size)
+        if byte_range is None:
+            return Response("", status=416, headers={"Content-Range": f"bytes */{size}"})
+        start, length, status = byte_range[0], byte_range[1] - byte_range[0], 206
+
+    if entry:
+        body = content_cache.read(entry, start, length)
+    elif status == 206:
+        body = stream_blob(await blob_client.download_blob(offset=start, length=length), None)
+    else:
+        body = stream_blob(await blob_client.download_blob(), content_cache.writer(path, etag, mime_type, size))
+
+    response = Response(body, status=status, mimetype=mime_type)
+    response.headers["ETag"] = etag
+    response.headers["Accept-Ranges"] = "bytes"
+    response.headers["Content-Length"] = str(length)
+    if status == 206:
+        response.headers["Content-Range"] = f"bytes {start}-{start + length - 1}/{size}"
+    response.timeout = None
+    return response
+
+async def get_blob_properties(blob_client):
+    try:
+        return await blob_client.get_blob_properties()
+    except ResourceNotFoundError:
+        return None
+
+async def stream_blob(downloader, cache_writer):
+    completed = False
+    try:
+        async for chunk in downloader.chunks():
+            if cache_writer:
+                await cache_writer.write(chunk)
+            yield chunk
+        completed = True
+    finally:
+        if cache_writer and completed:
+            await cache_writer.commit()
+        elif cache_writer:
+            await cache_writer.abort()
 
 @app.route("/ask", methods=["POST"])
-def ask():
-    ensure_openai_token()
-    if not request.json:
+async def ask():
+    if not request.is_json:
         return jsonify({"error": "request must be json"}), 400
-    approach = request.json["approach"]
+    request_json = await request.get_json()
+    approach = request_json["approach"]
+    impl = await current_app.config[CONFIG_ASK_APPROACHES].get(approach)
+    if not impl:
+        return jsonify({"error": "unknown approach"}), 400
+    overrides = request_json.get("overrides") or {}
+    expires_at = request_deadline(overrides)
+    check_budgets(overrides)
+    await admit("ask", approach)
     try:
-        impl = ask_approaches.get(approach)
-        if not impl:
-            return jsonify({"error": "unknown approach"}), 400
-        r = impl.run(request.json["question"], request.json.get("overrides") or {})
+        with trace(f"ask:{approach}", overrides) as request_trace, deadline(expires_at):
+            r = await asyncio.wait_for(impl.run(request_json["question"], overrides), remaining() + DEADLINE_GRACE_SECONDS)
+        if overrides.get("trace"):
+            r["trace"] = request_trace.spans
         return jsonify(r)
+    except (CircuitOpenError, InvalidOverride):
+        raise
+    except asyncio.TimeoutError:
+        logging.warning("Deadline exceeded in /ask")
+        return jsonify({"error": "request took too long"}), 504
     except Exception as e:
         logging.exception("Exception in /ask")
         return jsonify({"error": str(e)}), 500
     
 @app.route("/chat", methods=["POST"])
-def chat():
-    ensure_openai_token()
-    if not request.json:
+async def chat():
+    if not request.is_json:
         return jsonify({"error": "request must be json"}), 400
-    approach = request.json["approach"]
+    request_json = await request.get_json()
+    approach = request_json["approach"]
+    impl = await current_app.config[CONFIG_CHAT_APPROACHES].get(approach)
+    if not impl:
+        return jsonify({"error": "unknown approach"}), 400
+    overrides = request_json.get("overrides") or {}
+    expires_at = request_deadline(overrides)
+    check_budgets(overrides)
+    await admit("chat", approach)
     try:
-        impl = chat_approaches.get(approach)
-        if not impl:
-            return jsonify({"error": "unknown approach"}), 400
-        r = impl.run(request.json["history"], request.json.get("overrides") or {})
+        with trace(f"chat:{approach}", overrides) as request_trace, deadline(expires_at):
+            r = await asyncio.wait_for(impl.run(request_json["history"], overrides), remaining() + DEADLINE_GRACE_SECONDS)
+        if overrides.get("trace"):
+            r["trace"] = request_trace.spans
         return jsonify(r)
+    except (CircuitOpenError, InvalidOverride):
+        raise
+    except asyncio.TimeoutError:
+        logging.warning("Deadline exceeded in /chat")
+        return jsonify({"error": "request took too long"}), 504
     except Exception as e:
         logging.exception("Exception in /chat")
         return jsonify({"error": str(e)}), 500
 
-def ensure_openai_token():
-    global openai_token
-    if openai_token.expires_on < int(time.time()) - 60:
-        openai_token = azure_credential.get_token("https://cognitiveservices.azure.com/.default")
-        openai.api_key = openai_token.token
-    
+@app.route("/ask_stream", methods=["POST"])
+async def ask_stream():
+    if not request.is_json:
+        return jsonify({"error": "request must be json"}), 400
+    request_json = await request.get_json()
+    impl = await current_app.config[CONFIG_ASK_APPROACHES].get(request_json["approach"])
+    if not impl:
+        return jsonify({"error": "unknown approach"}), 400
+    overrides = request_json.get("overrides") or {}
+    expires_at = request_deadline(overrides)
+    check_budgets(overrides)
+    await admit("ask", request_json["approach"])
+    return ndjson_response(impl.run_stream(request_json["question"], overrides), "/ask_stream", f"ask:{request_json['approach']}", overrides, expires_at)
+
+@app.route("/chat_stream", methods=["POST"])
+async def chat_stream():
+    if not request.is_json:
+        return jsonify({"error": "request must be json"}), 400
+    request_json = await request.get_json()
+    impl = await current_app.config[CONFIG_CHAT_APPROACHES].get(request_json["approach"])
+    if not impl:
+        return jsonify({"error": "unknown approach"}), 400
+    overrides = request_json.get("overrides") or {}
+    expires_at = request_deadline(overrides)
+    check_budgets(overrides)
+    await admit("chat", request_json["approach"])
+    return ndjson_response(impl.run_stream(request_json["history"], overrides), "/chat_stream", f"chat:{request_json['approach']}", overrides, expires_at)
+
+# The deadline starts when the request arrives, so time spent waiting for admission counts against it. Raises
+# InvalidOverride for a deadline_seconds that isn't a positive number
+def request_deadline(overrides: dict[str, Any]) -> float:
+    return time.monotonic() + min(positive_override(overrides, "deadline_seconds", REQUEST_DEADLINE_SECONDS, float), REQUEST_DEADLINE_SECONDS)
+
+# The budgets are only used deep in the approaches, a bad one is turned into a 400 before the request is admitted,
+# instead of failing it, or a stream, halfway
+def check_budgets(overrides: dict[str, Any]):
+    budget_override(overrides, 1)
+    budget_override(overrides, 1, "observation_token_budget")
+
+# Waits for a slot of the approach, or raises Overloaded. The slot is held until the request's task is done,
+# which for the streaming routes is after the last line was sent or the client disconnected
+async def admit(route: str, approach: str):
+    limiter = current_app.config[CONFIG_ADMISSION_LIMITERS][f"{route}:{approach}"]
+    granted = await limiter.acquire()
+    asyncio.current_task().add_done_callback(lambda _: limiter.release(granted))
+
+@app.errorhandler(Overloaded)
+async def overloaded(e: Overloaded):
+    response = jsonify({"error": str(e)})
+    response.status_code = 503
+    response.headers["Retry-After"] = str(e.retry_after)
+    return response
+
+@app.errorhandler(InvalidOverride)
+async def invalid_override(e: InvalidOverride):
+    return jsonify({"error": str(e)}), 400
+
+@app.errorhandler(CircuitOpenError)
+async def openai_unavailable(e: CircuitOpenError):
+    response = jsonify({"error": str(e)})
+    response.status_code = 503
+    response.headers["Retry-After"] = str(max(1, round(e.retry_after)))
+    return response
+
+# Streams one JSON object per line: first the supporting content, then answer deltas, and finally the checked answer.
+# The trace is attached to the final answer if it was requested. If the approach doesn't finish by the deadline (and
+# its grace period), the stream ends with an error
+def ndjson_response(events: AsyncGenerator[dict[str, Any], None], route: str, approach: str, overrides: dict[str, Any], expires_at: float) -> Response:
+    async def generate():
+        try:
+            with trace(approach, overrides) as request_trace, deadline(expires_at):
+                async for event in iterate_within_deadline(events, "response", DEADLINE_GRACE_SECONDS):
+                    if "answer" in event and overrides.get("trace"):
+                        event = {**event, "trace": request_trace.spans}
+                    yield json.dumps(event, ensure_ascii=False) + "\n"
+        except asyncio.TimeoutError:
+            logging.warning(f"Deadline exceeded in {route}")
+            yield json.dumps({"error": "request took too long"}) + "\n"
+        except CircuitOpenError as e:
+            # The status was sent with the first line, so the client learns when to retry from the error line
+            logging.warning(f"{route} failed fast: {e}")
+            yield json.dumps({"error": str(e), "retry_after": max(1, round(e.retry_after))}) + "\n"
+        except Exception as e:
+            logging.exception(f"Exception in {route}")
+            yield json.dumps({"error": str(e)}) + "\n"
+
+    response = Response(generate(), mimetype="application/x-ndjson")
+    response.timeout = None
+    return response
+
 if __name__ == "__main__":
     app.run()
@@ -1,6 +1,75 @@
-from typing import Any
+import asyncio
+import importlib
+import threading
+from dataclasses import dataclass, field
+from typing import Any, AsyncGenerator, Optional
 
 
 class Approach:
-    def run(self, q: str, overrides: dict[str, Any]) -> Any:
+    # Answer given when the request's deadline passed before an answer was generated
+    timeout_answer = "Sorry, answering took too long, please try again."
+
+    async def run(self, q: str, overrides: dict[str, Any]) -> Any:
         raise NotImplementedError
+
+    async def run_stream(self, q: str, overrides: dict[str, Any]) -> AsyncGenerator[dict[str, Any], None]:
+        # Approaches that can't stream their answer send the whole response as a single event
+        yield await self.run(q, overrides)
+
+    def warmup(self) -> None:
+        # Approaches can prepare anything that doesn't depend on the request here, e.g. default prompt templates
+        pass
+
+
+@dataclass
+class RequestContext:
+    """
+    State of one request to an approach. Approach instances are shared by all requests a worker serves at the same
+    time, so anything an approach learns while answering a request is kept here instead of on the instance.
+    """
+    overrides: dict[str, Any]
+    # Sources the answer is based on, returned as the data points
+    results: list[str] = field(default_factory=list)
+
+
+# Approaches are imported and created in worker threads, one at a time, since concurrent imports of the same modules
+# from several threads can fail
+creation_lock = threading.Lock()
+
+
+class LazyApproaches:
+    """
+    Approaches by key, created the first time they are used. Approach classes are given as "module:Class" so the
+    modules they depend on (LangChain for the agent based approaches) are only imported when an approach is needed.
+    All approaches are created with the same args, options has additional keyword arguments per key.
+
+    Importing and creating an approach, e.g. importing LangChain and building an agent, takes seconds. It is done in a
+    worker thread, so a request that needs an approach before the warm-up created it doesn't hold up the others.
+    """
+
+    def __init__(self, classes: dict[str, str], *args: Any, options: Optional[dict[str, dict[str, Any]]] = None):
+        self.classes = classes
+        self.args = args
+        self.options = options or {}
+        self.instances: dict[str, Approach] = {}
+
+    async def get(self, key: str) -> Optional[Approach]:
+        if key in self.instances:
+            return self.instances[key]
+        if key not in self.classes:
+            return None
+        return await asyncio.to_thread(self.create, key)
+
+    def create(self, key: str) -> Approach:
+        with creation_lock:
+            # Another request may have created it while this one waited for the lock
+            if key not in self.instances:
+                module_name, class_name = self.classes[key].split(":")
+                approach = getattr(importlib.import_module(module_name), class_name)(*self.args, **self.options.get(key, {}))
+                approach.warmup()
+                self.instances[key] = approach
+            return self.instances[key]
+
+    async def load_all(self):
+        for key in self.classes:
+            await self.get(key)
@@ -1,14 +1,20 @@
-import openai
-from approaches.approach import Approach
-from azure.search.documents import SearchClient
+import asyncio
+from agenttools import ToolMemo
+from approaches.approach import Approach, RequestContext
+from contextpacker import budget_override, pack_sources, record_prompt_size
+from deadline import within_deadline
+from azure.search.documents.aio import SearchClient
 from azure.search.documents.models import QueryType
 from langchain.chat_models import AzureChatOpenAI
 from langchain.callbacks.manager import CallbackManager
-from langchain.agents import Tool, AgentType, initialize_agent, ConversationalChatAgent
+from langchain.agents import Tool, AgentExecutor, ConversationalChatAgent
 from langchain.memory import ConversationBufferMemory
-from langchainadapters import HtmlCallbackHandler
+from openaiclient import ResilientOpenAI, langchain_llm, use_current_api_key
+from langchainadapters import HtmlCallbackHandler, TracingCallbackHandler
+from sections import merge_sections
 from text import nonewlines
-from typing import Any, Sequence
+from tracing import span
+from typing import Any, Optional, Sequence
 
 
 class ChatReadRetrieveReadApproach(Approach):
@@ -22,8 +28,6 @@ class ChatReadRetrieveReadApproach(Approach):
 
     [1] E. Karpas, et al. arXiv:2205.00445
     """
-    content: str = ""
-
     # A message sent from the perspective of the human
     human_message: str = """
 TOOLS
@@ -67,103 +71,108 @@ Here is the user's input (remember to respond with a markdown code snippet of a
     "For example, if the question is \ What color is the sky? \ and one of the information sources says \info123: the sky is blue whenever it's not cloudy\, then answer with \The sky is blue [info123]\ "  \
     "It's important to strictly follow the format where the name of the source is in square brackets at the end of the sentence, and only up to the prefix before the colon (\:\)."  \
     "If there are multiple sources, cite each one in their own square brackets. For example, use \[info343][ref-76]\ and not \[info343,ref-76]\."  \
-    "Never quote tool names or chat history as sources." \
-    f"{human_message}"
+    "Never quote tool names or chat history as sources."
 
 
     CognitiveSearchToolDescription = "Useful for searching for public information about DNB house insurance."
 
-    def __init__(self, search_client: SearchClient, chatgpt_deployment: str, sourcepage_field: str, content_field: str):
+    # Tokens of search results in one observation, shared evenly by the sources. Every iteration of the agent adds one
+    OBSERVATION_TOKEN_BUDGET = 300
+
+    def __init__(self, search_client: SearchClient, chatgpt_deployment: str, sourcepage_field: str, content_field: str,
+                 completions: Optional[ResilientOpenAI] = None):
         self.search_client = search_client
         self.chatgpt_deployment = chatgpt_deployment
         self.sourcepage_field = sourcepage_field
         self.content_field = content_field
+        self.completions = completions or ResilientOpenAI()
+        self.agent: Optional[ConversationalChatAgent] = None
 
-    def retrieve(self, q: str, overrides: dict[str, Any]) -> Any:
+    async def retrieve(self, q: str, context: RequestContext) -> Any:
+        overrides = context.overrides
         use_semantic_captions = True if overrides.get("semantic_captions") else False
         top = overrides.get("top") or 3
         exclude_category = overrides.get("exclude_category") or None
         filter = "category ne '{}'".format(exclude_category.replace("'", "''")) if exclude_category else None
 
-        if overrides.get("semantic_ranker"):
-            r = self.search_client.search(q,
-                                          filter=filter, 
-                                          query_type=QueryType.SEMANTIC, 
-                                          query_language="en-us", 
-                                          query_speller="lexicon", 
-                                          semantic_configuration_name="default", 
-                                          top = top,
-                                          query_caption="extractive|highlight-false" if use_semantic_captions else None)
-        else:
-            r = self.search_client.search(q, filter=filter, top=top)
-        if use_semantic_captions:
-            self.results = [doc[self.sourcepage_field] + ":" + nonewlines(" -.- ".join([c.text for c in doc['@search.captions']])) for doc in r]
-        else:
-             self.results = [doc[self.sourcepage_field] + ":" + nonewlines(doc[self.content_field][:250]) for doc in r]
-        self.content = "\n".join(self.results)
-        return self.content
+        with span("search"):
+            if overrides.get("semantic_ranker"):
+                r = await self.search_client.search(q,
+                                              filter=filter, 
+                                              query_type=QueryType.SEMANTIC, 
+                                              query_language="en-us", 
+                                              query_speller="lexicon", 
+                                              semantic_configuration_name="default", 
+                                              top = top,
+                                              query_caption="extractive|highlight-false" if use_semantic_captions else None)
+            else:
+                r = await self.search_client.search(q, filter=filter, top=top)
+            if use_semantic_captions:
+                results = [doc[self.sourcepage_field] + ":" + nonewlines(" -.- ".join([c.text for c in doc['@search.captions']])) async for doc in r]
+            else:
+                documents = merge_sections([doc async for doc in r], self.sourcepage_field, self.content_field)
+                results = [doc[self.sourcepage_field] + ":" + nonewlines(doc[self.content_field]) for doc in documents]
+        # Cut the sources to their share of the observation budget, instead of to a fixed number of characters
+        budget = budget_override(overrides, self.OBSERVATION_TOKEN_BUDGET, "observation_token_budget")
+        packed = pack_sources(results, budget, budget // max(1, len(results)))
+        record_prompt_size(observation=packed.tokens)
+        context.results = packed.sources
+        return "\n".join(packed.sources)
     
+    def warmup(self):
+        self.get_agent()
+
+    def get_agent(self) -> ConversationalChatAgent:
+        """
+        The agent with its prompt and LLM doesn't depend on the request, so it is built once and shared by the requests.
+        The tools are bound per request when the agent is run, the prompt only uses their names and descriptions.
+        """
+        if self.agent is None:
+            tools = [Tool(name="CognitiveSearch", func=lambda _: "Not implemented", description=self.CognitiveSearchToolDescription)]
+
+            # The input is left for LangChain to fill in, it formats the human message twice before using it as a template
+            temp_human_message=self.human_message.format(tools=tools, format_instructions=self.format_instructions.format(tool_names=", ".join([t.name for t in tools])), sources=self.sourcepage_field, input="{{{{input}}}}")
+
+            llm = langchain_llm(AzureChatOpenAI, self.completions.chat_completion, deployment_name=self.chatgpt_deployment, temperature=0)
+            self.agent = ConversationalChatAgent.from_llm_and_tools(llm=llm, tools=tools, system_message=self.system_message, human_message=temp_human_message)
+        use_current_api_key(self.agent.llm_chain.llm)
+        return self.agent
+
     def askUser(self, q: str) -> Any:
         return q
         
-    def run(self, history: Sequence[dict[str, str]], overrides: dict[str, Any]) -> Any:
-        # Not great to keep this as instance state, won't work with interleaving (e.g. if using async), but keeps the example simple
-        self.results = None
+    async def run(self, history: Sequence[dict[str, str]], overrides: dict[str, Any]) -> Any:
+        # The approach is shared by concurrent requests, what this request retrieves is kept in its own context
+        context = RequestContext(overrides)
 
         # Use to capture thought process during iterations
         cb_handler = HtmlCallbackHandler()
         cb_manager = CallbackManager(handlers=[cb_handler])
         
-        acs_tool = Tool(name="CognitiveSearch", 
-                        func=lambda q: self.retrieve(q, overrides), 
-                        description=self.CognitiveSearchToolDescription,
-                        callbacks=cb_manager)
+        # Repeated searches of this request are answered from the memo, and the agent is stopped once it goes in circles
+        memo = ToolMemo()
+        acs_tool = memo.tool("CognitiveSearch", self.CognitiveSearchToolDescription, lambda q: self.retrieve(q, context), cb_manager)
        
         tools: Sequence = [acs_tool]
 
-        temp_human_message=self.human_message.format(tools=tools, format_instructions=self.format_instructions.format(tool_names=", ".join([t.name for t in tools])), sources=self.sourcepage_field, input=history[-1].get("user"))
-
-        # memory = ConversationBufferMemory(memory_key = "chat_history", 
-        #                               input_key = "input",
-        #                               output_key = "output", 
-        #                               return_messages = True,
-        #                               human_prefix=human_message)
-
-        prompt = ConversationalChatAgent.create_prompt(
-            system_message=self.system_message,
-            human_message=temp_human_message,
+        # The memory belongs to the request, so it starts empty as it did when initialize_agent built everything per request
+        conversational_agent = AgentExecutor.from_agent_and_tools(
+            agent=self.get_agent(),
             tools=tools,
-            input_variables=["input", "agent_scratchpad", "chat_history"])
-
-        print(prompt)
-
-        llm = AzureChatOpenAI(deployment_name=self.chatgpt_deployment, 
-                              temperature=0, 
-                              openai_api_key=openai.api_key, 
-                              openai_api_base=openai.api_base, 
-                              openai_api_version=openai.api_version
-                              )
-
-        conversational_agent = initialize_agent(
-            agent=AgentType.CHAT_CONVERSATIONAL_REACT_DESCRIPTION,
-            tools=tools, 
-            llm=llm,
             verbose=True,
             max_iterations=5,
             memory=ConversationBufferMemory(memory_key = "chat_history", 
                                       input_key = "input",
                                       output_key = "output", 
-                                      return_messages = True),
-            agent_kwargs= {
-                "system_message": self.system_message,
-                "human_message": temp_human_message
-                }
-            )
-        print(history)
-        result = conversational_agent.run(history[-1].get("user"))
+                                      return_messages = True))
+        try:
+            # The memory starts empty, so a stalled agent is asked for its answer without chat history
+            result = await within_deadline(memo.run(conversational_agent, history[-1].get("user"), callbacks=[TracingCallbackHandler()], chat_history=[]), "agent")
+        except asyncio.TimeoutError:
+            result = self.timeout_answer
         
         
         # Remove references to tool names that might be confused with a citation
         result = result.replace("[CognitiveSearch]", "")
-        return {"data_points": self.results or [], "answer": result, "thoughts": cb_handler.get_and_reset_log()}
+        return {"data_points": context.results, "answer": result, "thoughts": cb_handler.get_and_reset_log()}
     
\ No newline at end of file
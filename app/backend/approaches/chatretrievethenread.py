@@ -1,13 +1,21 @@
-import time
+import asyncio
+import hashlib
 import re
-import concurrent.futures
-from typing import Any, Sequence
-import openai
-import openai.error
-from azure.search.documents import SearchClient
+from typing import Any, AsyncGenerator, Optional, Sequence
+from azure.search.documents.aio import SearchClient
 from azure.search.documents.models import QueryType
 from approaches.approach import Approach
+from contextpacker import budget_override, count_tokens, pack_history, pack_sources, record_prompt_size
+from deadline import expired, iterate_within_deadline, within_deadline
+from metrics import Counter
+from nearduplicates import NearDuplicateIndex, word_similarity
+from openaiclient import ResilientOpenAI
+from searchcache import TTLCache, normalize_query
+from sections import merge_sections
 from text import nonewlines
+from tracing import span
+
+query_cache_requests_total = Counter("query_rewrite_cache_requests_total", "Search queries taken from the query rewrite cache or generated", ["result"])
 
 class ChatRetrieveThenReadApproach(Approach):
     """
@@ -22,9 +30,22 @@ class ChatRetrieveThenReadApproach(Approach):
 
     DOCUMENT_SCORE_CUTOFF = 1
 
+    # Longest a completion may take, less if the request's deadline is closer
     CHATGPT_TIMEOUT = 600
-    CHATGPT_RETRY_WAIT = 1
-    CHATGPT_MAX_RETRIES = 3
+
+    # Tokens for the system prompt with the sources, the history and the question, which leaves room for the 1024 tokens
+    # of the answer. The history gets at most HISTORY_TOKEN_BUDGET of them, the latest turns first
+    PROMPT_TOKEN_BUDGET = 3000
+    HISTORY_TOKEN_BUDGET = 1000
+
+    # Weight of the rank of a section in each search of multi-query retrieval, 60 is what the paper introducing
+    # reciprocal rank fusion found to work well
+    RRF_K = 60
+
+    # With speculative search, results of a guessed query are used if the generated query has at least this share of
+    # words in common with it. If generating the query takes longer than the timeout, the results of the best guess are used
+    SPECULATIVE_QUERY_SIMILARITY = 0.5
+    SPECULATIVE_REWRITE_TIMEOUT = 5
 
 
     assistant_prompt = """
@@ -94,101 +115,206 @@ History:
     <<What is the cheapest alternative?>> <<What does it cover?>> <<How much does it cost?>>"""
 
 
-    def __init__(self, search_client: SearchClient, chatgpt_deployment: str, sourcepage_field: str, content_field: str):
+    def __init__(self, search_client: SearchClient, chatgpt_deployment: str, sourcepage_field: str, content_field: str,
+                 query_cache: Optional[TTLCache] = None, near_duplicates: Optional[NearDuplicateIndex] = None,
+                 speculative_search: bool = False, multi_query_search: bool = False, multi_query_semantic: bool = False,
+                 completions: Optional[ResilientOpenAI] = None):
         self.search_client = search_client
         self.chatgpt_deployment = chatgpt_deployment
         self.sourcepage_field = sourcepage_field
         self.content_field = content_field
-        self.executor = concurrent.futures.ThreadPoolExecutor()
+        self.query_cache = query_cache
+        self.near_duplicates = near_duplicates
+        self.speculative_search = speculative_search
+        self.multi_query_search = multi_query_search
+        self.multi_query_semantic = multi_query_semantic
+        self.completions = completions or ResilientOpenAI()
     
-    def run(self, history: Sequence[dict[str, str]], overrides: dict[str, Any]) -> Any:
-        start_time = time.time()
+    async def run(self, history: Sequence[dict[str, str]], overrides: dict[str, Any]) -> Any:
+        try:
+            context = await self.retrieve_context(history, overrides)
+        except asyncio.TimeoutError:
+            return {"data_points": "", "answer": self.timeout_answer, "thoughts": ""}
+        if context == None:
+            return {"data_points": "", "answer": "Could not generate query, please try again.", "thoughts": ""}
+        filtered_history, search_query, documents, source_list, prompt = context
+
+        answer = await self.generate_question_answer(prompt, filtered_history, overrides, self.CHATGPT_TIMEOUT)
+        if answer is not None:
+            self.answered(history)
+        if answer == None:
+            print("WARNING: Timeout before generating question answer")
+            answer = self.timeout_answer if expired() else "Sorry, I can't answer the question."
+            # answer = self.generate_question_answer(self.no_source, filtered_history[len(filtered_history)], overrides, self.CHATGPT_TIMEOUT)
+         
+            
+
+        print("Generated answer: ", answer)
 
-        print("Starting answering process")
-        print(f"Max time limit for chatGPT has been set to {self.CHATGPT_TIMEOUT} seconds")
+        answer = self.postprocess_answer(answer, documents, filtered_history, overrides)
 
+        return {"data_points": source_list, "answer": answer, "thoughts": self.format_thoughts(search_query, prompt)}
+
+    async def run_stream(self, history: Sequence[dict[str, str]], overrides: dict[str, Any]) -> AsyncGenerator[dict[str, Any], None]:
+        try:
+            context = await self.retrieve_context(history, overrides)
+        except asyncio.TimeoutError:
+            yield {"data_points": "", "answer": self.timeout_answer, "thoughts": ""}
+            return
+        if context == None:
+            yield {"data_points": "", "answer": "Could not generate query, please try again.", "thoughts": ""}
+            return
+        filtered_history, search_query, documents, source_list, prompt = context
+
+        # The supporting content is known before the answer, so send it right away
+        yield {"data_points": source_list, "thoughts": self.format_thoughts(search_query, prompt)}
+
+        answer = ""
+        async for delta in self.generate_question_answer_stream(prompt, filtered_history, overrides, self.CHATGPT_TIMEOUT):
+            answer += delta
+            yield {"delta": delta}
+
+        if answer == "":
+            print("WARNING: Timeout before generating question answer")
+            answer = self.timeout_answer if expired() else "Sorry, I can't answer the question."
+        else:
+            self.answered(history)
+
+        print("Generated answer: ", answer)
+
+        # Source checks need the whole answer, so the cleaned up answer is sent as the final event and replaces the streamed text
+        yield {"answer": self.postprocess_answer(answer, documents, filtered_history, overrides)}
+
+    async def retrieve_context(self, history, overrides):
         use_semantic_captions = True if overrides.get("semantic_captions") else False
         top = overrides.get("top") or 6
         exclude_category = overrides.get("exclude_category") or None
         filter = "category ne '{}'".format(exclude_category.replace("'", "''")) if exclude_category else None
-    
-        print("Beginning step 1: Generate keyword search query")
 
         filtered_history = self.clear_history(history)
+
+        # The query rewrite and the answer only see the latest turns that fit in the history budget
+        budget = budget_override(overrides, self.PROMPT_TOKEN_BUDGET)
+        filtered_history, history_tokens = pack_history(filtered_history, min(self.HISTORY_TOKEN_BUDGET, budget // 2), lambda turn: self.history_as_text([turn]))
         
-        step_time = time.time()
-        search_query = self.generate_keyword_query(filtered_history, overrides, self.CHATGPT_TIMEOUT)
-        print(f"Finished step 1 in {time.time() - step_time} seconds")
+        if overrides.get("speculative_search", self.speculative_search):
+            search_query, documents = await self.generate_keyword_query_and_search(filtered_history, top, filter, use_semantic_captions, overrides)
+        else:
+            with span("query_rewrite"):
+                search_query = await self.generate_keyword_query(filtered_history, overrides, self.CHATGPT_TIMEOUT)
+            documents = None
 
         if search_query == None:
-            return {"data_points": "", "answer": "Could not generate query, please try again.", "thoughts": ""}
+            # Out of time rather than out of luck
+            if expired():
+                raise asyncio.TimeoutError()
+            return None
 
         print(f" Original search query: {search_query}")
-      
-        print("Beginning step 2: Retrieve documents from search index")
 
-        step_time = time.time()
-        documents = self.retrieve_documents(search_query, top, filter, use_semantic_captions, overrides)
-        source_list = self.documents_to_sources(documents, use_semantic_captions)
-        sources = len(source_list) and "\n".join(source_list) or ""
+        if documents is None:
+            documents = await within_deadline(self.retrieve_documents(search_query, top, filter, use_semantic_captions, overrides, filtered_history[-1][self.USER]), "search")
+        template_tokens = count_tokens(self.format_assistant_prompt("", overrides))
+        packed = pack_sources(self.documents_to_sources(documents, use_semantic_captions), budget - template_tokens - history_tokens)
+        record_prompt_size(history=history_tokens, sources=packed.tokens, total=template_tokens + history_tokens + packed.tokens)
+        source_list = packed.sources
+        prompt = self.format_assistant_prompt("\n".join(source_list), overrides)
 
-        print(f"Finished step 2 in {time.time() - step_time} seconds")
-        print("Beginning step 3: Generate question answer")
+        return filtered_history, search_query, documents, source_list, prompt
 
-        step_time = time.time()
-        prompt = self.format_assistant_prompt(sources, overrides)
-        answer = self.generate_question_answer(prompt, filtered_history, overrides, self.CHATGPT_TIMEOUT)
-        if answer == None:
-            print("WARNING: Timeout before generating question answer")
-            answer = "Sorry, I can't answer the question."
-            # answer = self.generate_question_answer(self.no_source, filtered_history[len(filtered_history)], overrides, self.CHATGPT_TIMEOUT)
-         
-            
-
-        print("Generated answer: ", answer)
-
-        if not self.check_answer_sources(answer, documents, filtered_history):
+    def postprocess_answer(self, answer, documents, history, overrides):
+        if not self.check_answer_sources(answer, documents, history):
             print("WARNING: Generated question answer used sources incorrectly")
             answer = "Sorry, I do not have information related to your question."
             # prompt = self.no_source.format(question=filtered_history[-1])
-            # answer = self.generate_question_answer(prompt,[], overrides, self.CHATGPT_TIMEOUT)
-        
-
+            # answer = await self.generate_question_answer(prompt,[], overrides, self.CHATGPT_TIMEOUT)
 
-        print(f"Finished step 3 in {time.time() - step_time} seconds")
-        print(f"Answering process completed in {time.time() - start_time} seconds")
-
-        thoughts = f"Searched for:<br>{search_query}<br><br>Prompt:<br>" + prompt.replace('\n', '<br>')
         if overrides.get("suggest_followup_questions"):
             answer = self.remove_wrong_questions_format(answer,"Next Questions: ")
 
-        
-        return {"data_points": source_list, "answer": answer, "thoughts": thoughts}
+        return answer
+
+    def format_thoughts(self, search_query, prompt):
+        return f"Searched for:<br>{search_query}<br><br>Prompt:<br>" + prompt.replace('\n', '<br>')
+
+    async def generate_keyword_query(self, history, overrides, timeout):
+        history_text = self.history_as_text(history[:-1])
+        cache_key = self.keyword_query_key(history[-1][self.USER], history_text, overrides) if self.query_cache is not None else None
+        if cache_key:
+            search_query = self.query_cache.get(cache_key)
+            query_cache_requests_total.inc(result="miss" if search_query is None else "hit")
+            if search_query is not None:
+                return search_query
 
-    def generate_keyword_query(self, history, overrides, timeout):
         user_question = f"Generate search query for: {history[-1][self.USER]}"
-        prompt = self.query_prompt.format(history=self.history_as_text(history[:-1]))
+        prompt = self.query_prompt.format(history=history_text)
         messages = self.format_chat_messages(system_prompt=prompt, history=[], user_question=user_question, few_shot=self.query_prompt_few_shots)
-        future = self.executor.submit(self.get_completion, messages, overrides)
         try:
-            completion = future.result(timeout=timeout)
-            return completion.choices[0].message.content
-        except concurrent.futures.TimeoutError:
+            completion = await within_deadline(self.get_completion(messages, overrides), "query_rewrite", timeout)
+        except asyncio.TimeoutError:
             return None
 
-    def retrieve_documents(self, query, top, filter, use_semantic_captions, overrides):
-        if overrides.get("semantic_ranker"):
-            r = self.search_client.search(query, 
-                                          filter=filter,
-                                          query_type=QueryType.SEMANTIC, 
-                                          query_language="en-us", 
-                                          query_speller="lexicon", 
-                                          semantic_configuration_name="default", 
-                                          top=top,
-                                          query_caption="extractive|highlight-false" if use_semantic_captions else None)
-        
+        search_query = completion.choices[0].message.content
+        if cache_key:
+            self.query_cache.put(cache_key, search_query)
+        return search_query
+
+    # The rewrite only depends on the question and the history before it, which is kept as a short hash. Most repeated
+    # questions are first questions, where the history is empty and a near duplicate of a recent question shares its query
+    def keyword_query_key(self, question, history_text, overrides):
+        history_fingerprint = hashlib.sha256(history_text.encode("utf-8")).hexdigest()[:16] if history_text else ""
+        if not history_text and self.near_duplicates:
+            question = self.near_duplicates.match(question) or question
+        return (normalize_query(question), history_fingerprint, overrides.get("temperature") or 0)
+
+    # Only first questions share their query with near duplicates, follow-ups depend on the chat before them
+    def answered(self, history):
+        if self.near_duplicates and len(history) == 1:
+            self.near_duplicates.add(history[-1][self.USER])
+
+    async def generate_keyword_query_and_search(self, history, top, filter, use_semantic_captions, overrides):
+        """
+        Searches for guesses of the query while it is generated: the question itself, and the query generated for the same
+        question without any history, if that is cached. If the generated query is close enough to a guess, that guess'
+        results are used, which saves a search after the query generation. Returns the query and the documents found for
+        it, or None as documents if the query still has to be searched.
+        """
+        question = history[-1][self.USER]
+        guesses = [question]
+        if self.query_cache is not None:
+            first_question_query = self.query_cache.get(self.keyword_query_key(question, "", overrides))
+            if first_question_query is not None and len(history) == 1:
+                # The query is cached for this very question, there is nothing to guess
+                return await self.generate_keyword_query(history, overrides, self.CHATGPT_TIMEOUT), None
+            if first_question_query is not None and first_question_query != question:
+                guesses.append(first_question_query)
+
+        searches = {guess: asyncio.create_task(self.retrieve_documents(guess, top, filter, use_semantic_captions, overrides, question)) for guess in guesses}
+        try:
+            with span("query_rewrite", speculative=True):
+                search_query = await self.generate_keyword_query(history, overrides, self.SPECULATIVE_REWRITE_TIMEOUT)
+
+            if search_query is None:
+                # Better a search for a guess than no answer, the cached query is the better guess if there is one
+                print("WARNING: Timeout before generating search query, using the results of a guessed query")
+                return guesses[-1], await within_deadline(searches[guesses[-1]], "search")
+
+            guess = max(guesses, key=lambda guess: word_similarity(search_query, guess))
+            if word_similarity(search_query, guess) < self.SPECULATIVE_QUERY_SIMILARITY:
+                return search_query, None
+            return search_query, await within_deadline(searches[guess], "search")
+        finally:
+            for search in searches.values():
+                if not search.done():
+                    search.cancel()
+                # Failures of searches that aren't used don't matter
+                search.add_done_callback(lambda search: search.cancelled() or search.exception())
+
+    async def retrieve_documents(self, query, top, filter, use_semantic_captions, overrides, question=None):
+        if question is not None and overrides.get("multi_query", self.multi_query_search):
+            r = await self.search_query_variants(query, question, top, filter, use_semantic_captions, overrides)
         else:
-            r = self.search_client.search(query, filter=filter, top=top)
+            r = await self.search_documents(query, top, filter, bool(overrides.get("semantic_ranker")), use_semantic_captions)
 
         documents = []
         for doc in r:
@@ -201,11 +327,57 @@ History:
         
         return documents
 
+    async def search_documents(self, query, top, filter, semantic_ranker, use_semantic_captions):
+        with span("search"):
+            if semantic_ranker:
+                r = await self.search_client.search(query, 
+                                              filter=filter,
+                                              query_type=QueryType.SEMANTIC, 
+                                              query_language="en-us", 
+                                              query_speller="lexicon", 
+                                              semantic_configuration_name="default", 
+                                              top=top,
+                                              query_caption="extractive|highlight-false" if use_semantic_captions else None)
+            
+            else:
+                r = await self.search_client.search(query, filter=filter, top=top)
+            return [doc async for doc in r]
+
+    async def search_query_variants(self, query, question, top, filter, use_semantic_captions, overrides):
+        """
+        Searches for the generated query and the question as it was asked, with the configured ranking, and for the
+        generated query with the other ranking: keyword only when the semantic ranker is used, or the semantic ranker if
+        multi_query_semantic allows it (the free tier of the semantic ranker has a monthly quota). The searches run
+        concurrently and their results are fused by reciprocal rank. A section found by several searches is kept once,
+        with the highest of its search scores, and with the captions of the semantic search if there are any.
+        """
+        semantic_ranker = bool(overrides.get("semantic_ranker"))
+        variants = [(query, semantic_ranker), (question, semantic_ranker)]
+        if semantic_ranker or overrides.get("multi_query_semantic", self.multi_query_semantic):
+            variants.append((query, not semantic_ranker))
+        unique_variants = {}
+        for q, semantic in variants:
+            unique_variants.setdefault((normalize_query(q), semantic), (q, semantic))
+        variants = list(unique_variants.values())
+
+        results = await asyncio.gather(*[self.search_documents(q, top, filter, semantic, use_semantic_captions) for q, semantic in variants])
+
+        fused: dict[str, tuple[float, dict]] = {}
+        for documents in results:
+            for rank, doc in enumerate(documents):
+                rrf_score, kept = fused.get(doc["id"], (0, None))
+                if kept is not None:
+                    base = doc if doc.get("@search.captions") and not kept.get("@search.captions") else kept
+                    doc = {**base, "@search.score": max(kept["@search.score"], doc["@search.score"])}
+                fused[doc["id"]] = (rrf_score + 1 / (self.RRF_K + rank + 1), doc)
+        return [doc for _, doc in sorted(fused.values(), key=lambda entry: entry[0], reverse=True)[:top]]
+
     def documents_to_sources(self, documents, use_semantic_captions):
         if use_semantic_captions:
-            results = [doc[self.sourcepage_field] + ": " + nonewlines(" . ".join([c.text for c in doc['@search.captions']])) for doc in documents]
+            # Sections only found by a keyword search in multi-query retrieval have no captions
+            results = [doc[self.sourcepage_field] + ": " + nonewlines(" . ".join([c.text for c in doc['@search.captions']]) if doc.get('@search.captions') else doc[self.content_field]) for doc in documents]
         else:
-            results = [doc[self.sourcepage_field] + ": " + nonewlines(doc[self.content_field]) for doc in documents]
+            results = [doc[self.sourcepage_field] + ": " + nonewlines(doc[self.content_field]) for doc in merge_sections(documents, self.sourcepage_field, self.content_field)]
 
         return results
 
@@ -240,44 +412,42 @@ History:
 
         return prompt
 
-    def generate_question_answer(self, prompt, history, overrides, timeout):
+    async def generate_question_answer(self, prompt, history, overrides, timeout):
         messages = self.format_chat_messages(system_prompt=prompt, history=history, user_question=history[-1][self.USER])
-        future = self.executor.submit(self.get_completion, messages, overrides)
         try:
-            completion = future.result(timeout=timeout)
-            if completion:
-                return completion.choices[0].message.content
-            return None
-        except concurrent.futures.TimeoutError:
+            completion = await within_deadline(self.get_completion(messages, overrides), "llm", timeout)
+        except asyncio.TimeoutError:
             return None
+        return completion.choices[0].message.content
     
-    def get_completion(self, messages, overrides):
-        retries = 0
-        while retries <= self.CHATGPT_MAX_RETRIES:
-            if retries > 0:
-                print(f"Completion failed. Retry number {retries}")
-
-                # Wait a bit before retrying
-                time.sleep(self.CHATGPT_RETRY_WAIT)
-
-            try:
-                completion = openai.ChatCompletion.create(
+    async def generate_question_answer_stream(self, prompt, history, overrides, timeout):
+        messages = self.format_chat_messages(system_prompt=prompt, history=history, user_question=history[-1][self.USER])
+        try:
+            completion = await within_deadline(self.get_completion(messages, overrides, stream=True), "llm", timeout)
+        except asyncio.TimeoutError:
+            return
+        try:
+            async for chunk in iterate_within_deadline(completion, "llm_stream"):
+                # Azure sends content filter results as chunks without choices
+                if chunk.choices and chunk.choices[0].delta.get("content"):
+                    yield chunk.choices[0].delta.content
+        except asyncio.TimeoutError:
+            # The answer ends where it was when the deadline passed
+            return
+
+    # Retries, backoff and failing fast while the deployment is down are up to the completion client. Errors it gives up
+    # on are raised to the route, a CircuitOpenError becomes a 503 with Retry-After like for all other approaches
+    async def get_completion(self, messages, overrides, stream=False):
+        # When streaming only the time until the response starts is traced
+        with span("llm"):
+            return await self.completions.chat_completion.acreate(
                 engine=self.chatgpt_deployment,
                 messages=messages,
                 temperature=overrides.get("temperature") or 0,
                 max_tokens=1024,
                 n=1,
-                )
-
-                return completion
-            except openai.error.Timeout as e:
-                print(f"OpenAI API request timed out: {e}")
-            except openai.error.APIError as e:
-                print(f"OpenAI API returned an API Error: {e}")
-
-            retries += 1
-
-        return None
+                stream=stream,
+            )
 
 
     def format_chat_messages(self, system_prompt: str, history: Sequence[dict[str, str]], user_question: str, few_shot: Sequence[dict[str, str]] = []):
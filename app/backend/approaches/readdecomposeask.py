@@ -1,114 +1,219 @@
-import openai
+import asyncio
+import math
 import re
-from approaches.approach import Approach
-from azure.search.documents import SearchClient
+from agenttools import ToolMemo
+from approaches.approach import Approach, RequestContext
+from contextpacker import budget_override, pack_sources, record_prompt_size
+from deadline import within_deadline
+from azure.search.documents.aio import SearchClient
 from azure.search.documents.models import QueryType
 from langchain.llms.openai import AzureOpenAI
+from langchain.chains import LLMChain
 from langchain.prompts import PromptTemplate, BasePromptTemplate
 from langchain.callbacks.manager import CallbackManager
-from langchain.agents import Tool, AgentExecutor
+from langchain.agents import AgentExecutor
 from langchain.agents.react.base import ReActDocstoreAgent
-from langchainadapters import HtmlCallbackHandler
+from lookupindex import LookupIndex, lookups_total
+from openaiclient import ResilientOpenAI, langchain_llm, use_current_api_key
+from langchainadapters import HtmlCallbackHandler, TracingCallbackHandler
+from searchcache import TTLCache
+from sections import merge_sections
 from text import nonewlines
-from typing import Any, List, Optional
+from tracing import span
+from typing import Any, Optional
 
 class ReadDecomposeAsk(Approach):
-    def __init__(self, search_client: SearchClient, openai_deployment: str, sourcepage_field: str, content_field: str):
+    # Tokens of search results in one observation, shared evenly by the sources. Every Search action adds one
+    OBSERVATION_TOKEN_BUDGET = 300
+
+    # Agents kept for different prompt and temperature overrides
+    AGENT_CACHE_SIZE = 32
+
+    # Most searches and lookups a plan of parallel sub-questions may have
+    MAX_PLAN_ACTIONS = 4
+
+    def __init__(self, search_client: SearchClient, openai_deployment: str, sourcepage_field: str, content_field: str,
+                 completions: Optional[ResilientOpenAI] = None, parallel_subquestions: bool = False, lookup_index: Optional[LookupIndex] = None):
         self.search_client = search_client
         self.openai_deployment = openai_deployment
         self.sourcepage_field = sourcepage_field
         self.content_field = content_field
+        self.completions = completions or ResilientOpenAI()
+        self.parallel_subquestions = parallel_subquestions
+        self.lookup_index = lookup_index
+        self.agents = TTLCache(self.AGENT_CACHE_SIZE, math.inf)
+
+    def warmup(self):
+        self.get_agent({})
+
+    def get_agent(self, overrides: dict[str, Any]) -> ReActDocstoreAgent:
+        """
+        The agent with its prompt and LLM only depends on the prompt and temperature overrides, so it is built once for
+        every combination of them and shared by the requests. The tools are bound per request when the agent is run.
+        """
+        temperature = overrides.get("temperature") or 0.3
+        key = (overrides.get("prompt_template"), temperature)
+        agent = self.agents.get(key)
+        if agent is None:
+            llm = langchain_llm(AzureOpenAI, self.completions.completion, deployment_name=self.openai_deployment, temperature=temperature)
+            # Built like ReActDocstoreAgent.from_llm_and_tools does, but with our prompt
+            agent = ReActDocstoreAgent(llm_chain=LLMChain(llm=llm, prompt=self.create_prompt(overrides.get("prompt_template"))), allowed_tools=["Search", "Lookup"])
+            self.agents.put(key, agent)
+        use_current_api_key(agent.llm_chain.llm)
+        return agent
+
+    def create_prompt(self, prompt_prefix: Optional[str]) -> BasePromptTemplate:
+        return PromptTemplate.from_examples(
+            EXAMPLES, SUFFIX, ["input", "agent_scratchpad"], prompt_prefix + "\n\n" + PREFIX if prompt_prefix else PREFIX)
             
-    def search(self, q: str, overrides: dict[str, Any]) -> str:
+    async def search(self, q: str, context: RequestContext) -> str:
+        overrides = context.overrides
         use_semantic_captions = True if overrides.get("semantic_captions") else False
         top = overrides.get("top") or 3
         exclude_category = overrides.get("exclude_category") or None
         filter = "category ne '{}'".format(exclude_category.replace("'", "''")) if exclude_category else None
 
-        if overrides.get("semantic_ranker"):
-            r = self.search_client.search(q,
-                                          filter=filter,
-                                          query_type=QueryType.SEMANTIC, 
-                                          query_language="en-us", 
-                                          query_speller="lexicon", 
-                                          semantic_configuration_name="default", 
-                                          top = top,
-                                          query_caption="extractive|highlight-false" if use_semantic_captions else None) 
-            for dc in r: 
-                if dc["@search.score"] >= 1:
-                    print("score",dc["@search.score"])
-
-
-        else:
-            r = self.search_client.search(q, filter=filter, top=top)
-            print("here")
-            for dc in r: 
-                if dc["@search.score"] >= 1:
-                    print("score",dc["@search.score"])
+        with span("search"):
+            if overrides.get("semantic_ranker"):
+                r = await self.search_client.search(q,
+                                              filter=filter,
+                                              query_type=QueryType.SEMANTIC, 
+                                              query_language="en-us", 
+                                              query_speller="lexicon", 
+                                              semantic_configuration_name="default", 
+                                              top = top,
+                                              query_caption="extractive|highlight-false" if use_semantic_captions else None) 
+            else:
+                r = await self.search_client.search(q, filter=filter, top=top)
+            # Fetched within the span, the sections are merged from the list below
+            r = [doc async for doc in r]
 
-         
         if use_semantic_captions:
-            self.results = [doc[self.sourcepage_field] + ":" + nonewlines(" . ".join([c.text for c in doc['@search.captions']])) for doc in r]
+            results = [doc[self.sourcepage_field] + ":" + nonewlines(" . ".join([c.text for c in doc['@search.captions']])) for doc in r]
         else:
-            self.results = [doc[self.sourcepage_field] + ":" + nonewlines(doc[self.content_field]) for doc in r]
+            results = [doc[self.sourcepage_field] + ":" + nonewlines(doc[self.content_field]) for doc in merge_sections(r, self.sourcepage_field, self.content_field)]
+        # Every Search action adds its observation to the prompt, so the sources are cut to their share of the budget
+        budget = budget_override(overrides, self.OBSERVATION_TOKEN_BUDGET, "observation_token_budget")
+        packed = pack_sources(results, budget, budget // max(1, len(results)))
+        record_prompt_size(observation=packed.tokens)
+        # The answer can use the observations of all searches, which may run concurrently
+        context.results += [source for source in packed.sources if source not in context.results]
 
-        if len(self.results) > 0:
-            return "\n".join(self.results)
+        if len(packed.sources) > 0:
+            return "\n".join(packed.sources)
         return None
     
-    def lookup(self, q: str) -> Optional[str]:
-        self.search_client.suggest()
-        r = self.search_client.search(q,
-                                      top = 1,
-                                      include_total_count=True,
-                                      query_type=QueryType.SEMANTIC, 
-                                      query_language="en-us", 
-                                      query_speller="lexicon", 
-                                      semantic_configuration_name="default",
-                                      query_answer="extractive|count-1",
-                                      query_caption="extractive|highlight-false")
-        
-        answers = r.get_answers()
-        if answers and len(answers) > 0:
-            return answers[0].text
-        if r.get_count() > 0:
-            return "\n".join(d['content'] for d in r)
-        return None
+    async def lookup(self, q: str, context: RequestContext) -> Optional[str]:
+        # Terms are looked up in the sentences of the sections in memory, only terms not found there are sent to the semantic ranker
+        exclude_category = context.overrides.get("exclude_category") or None
+        filter = "category ne '{}'".format(exclude_category.replace("'", "''")) if exclude_category else None
+        if self.lookup_index:
+            with span("lookup"):
+                sentences = self.lookup_index.lookup(q, exclude_category)
+            if sentences:
+                lookups_total.inc(result="local")
+                context.results += [sentence for sentence in sentences if sentence not in context.results]
+                return "\n".join(sentences)
+        lookups_total.inc(result="remote")
+        with span("search"):
+            r = await self.search_client.search(q,
+                                          filter=filter,
+                                          top = 1,
+                                          include_total_count=True,
+                                          query_type=QueryType.SEMANTIC, 
+                                          query_language="en-us", 
+                                          query_speller="lexicon", 
+                                          semantic_configuration_name="default",
+                                          query_answer="extractive|count-1",
+                                          query_caption="extractive|highlight-false")
+            
+            answers = await r.get_answers()
+            if answers and len(answers) > 0:
+                return answers[0].text
+            if await r.get_count() > 0:
+                return "\n".join([d['content'] async for d in r])
+            return None
 
-    def run(self, q: str, overrides: dict[str, Any]) -> Any:
-        # Not great to keep this as instance state, won't work with interleaving (e.g. if using async), but keeps the example simple
-        self.results = None
+    async def run(self, q: str, overrides: dict[str, Any]) -> Any:
+        # The approach is shared by concurrent requests, what this request retrieves is kept in its own context
+        context = RequestContext(overrides)
+
+        if overrides.get("parallel_subquestions", self.parallel_subquestions):
+            try:
+                result, thoughts = await self.plan_and_answer(q, context)
+            except asyncio.TimeoutError:
+                result, thoughts = self.timeout_answer, ""
+            return {"data_points": context.results, "answer": cite_sources(result), "thoughts": thoughts}
 
         # Use to capture thought process during iterations
         cb_handler = HtmlCallbackHandler()
         cb_manager = CallbackManager(handlers=[cb_handler])
 
-        llm = AzureOpenAI(deployment_name=self.openai_deployment, temperature=overrides.get("temperature") or 0.3, openai_api_key=openai.api_key)
+        # Repeated searches and lookups of this request are answered from the memo, and the agent is stopped once it goes in circles
+        memo = ToolMemo()
         tools = [
-            Tool(name="Search", func=lambda q: self.search(q, overrides), description="useful for when you need to ask with search", callbacks=cb_manager),
-            Tool(name="Lookup", func=self.lookup, description="useful for when you need to ask with lookup", callbacks=cb_manager)
+            memo.tool("Search", "useful for when you need to ask with search", lambda q: self.search(q, context), cb_manager),
+            memo.tool("Lookup", "useful for when you need to ask with lookup", lambda q: self.lookup(q, context), cb_manager)
         ]
 
-        # Like results above, not great to keep this as a global, will interfere with interleaving
-        global prompt
+        chain = AgentExecutor.from_agent_and_tools(self.get_agent(overrides), tools, verbose=True, callback_manager=cb_manager)
+        try:
+            result = await within_deadline(memo.run(chain, q, callbacks=[TracingCallbackHandler()]), "agent")
+        except asyncio.TimeoutError:
+            result = self.timeout_answer
+
+        return {"data_points": context.results, "answer": cite_sources(result), "thoughts": cb_handler.get_and_reset_log()}
+
+    async def plan_and_answer(self, q: str, context: RequestContext) -> tuple[str, str]:
+        """
+        Answers the question in three steps instead of a loop of one search or lookup after the other: one completion
+        splits the question into independent actions, those all run concurrently, and one more completion answers the
+        question from all observations. Questions that compare or combine several facts, e.g. what car and house insurance
+        each cover, then take two completions whatever the number of facts.
+        """
+        overrides = context.overrides
+        with span("llm", purpose="plan"):
+            completion = await within_deadline(self.completions.completion.acreate(
+                engine=self.openai_deployment,
+                prompt=PLAN_PROMPT.format(max_actions=self.MAX_PLAN_ACTIONS, question=q),
+                temperature=0,
+                max_tokens=200,
+                n=1,
+                stop=["\n\n"]), "llm")
+        plan = completion.choices[0].text
+        # A question the model couldn't split is searched as it is
+        actions = parse_plan(plan)[:self.MAX_PLAN_ACTIONS] or [("Search", q)]
+
+        # An action that finds nothing is observed as such, one that fails fails the request like in the agent loop and
+        # the other actions are cancelled
+        tasks = [asyncio.ensure_future(self.search(query, context) if action == "Search" else self.lookup(query, context)) for action, query in actions]
+        try:
+            observations = await within_deadline(asyncio.gather(*tasks), "search")
+        finally:
+            for task in tasks:
+                task.cancel()
+
+        observations_text = "\n\n".join(f"{action}[{query}]:\n{observation or 'Nothing found.'}" for (action, query), observation in zip(actions, observations))
         prompt_prefix = overrides.get("prompt_template")
-        prompt = PromptTemplate.from_examples(
-            EXAMPLES, SUFFIX, ["input", "agent_scratchpad"], prompt_prefix + "\n\n" + PREFIX if prompt_prefix else PREFIX)
+        prompt = (prompt_prefix + "\n\n" if prompt_prefix else "") + SYNTHESIS_PROMPT.format(observations=observations_text, question=q)
+        with span("llm", purpose="synthesis"):
+            completion = await within_deadline(self.completions.completion.acreate(
+                engine=self.openai_deployment,
+                prompt=prompt,
+                temperature=overrides.get("temperature") or 0.3,
+                max_tokens=1024,
+                n=1), "llm")
 
-        agent = ReAct.from_llm_and_tools(llm, tools)
-        chain = AgentExecutor.from_agent_and_tools(agent, tools, verbose=True, callback_manager=cb_manager)
-        result = chain.run(q)
+        thoughts = "Plan:<br>" + plan.strip().replace("\n", "<br>") + "<br><br>Prompt:<br>" + prompt.replace("\n", "<br>")
+        return completion.choices[0].text.strip(), thoughts
 
-        # Replace substrings of the form <file.ext> with [file.ext] so that the frontend can render them as links, match them with a regex to avoid 
-        # generalizing too much and disrupt HTML snippets if present
-        result = re.sub(r"<([a-zA-Z0-9_ \-\.]+)>", r"[\1]", result)
+# Replace substrings of the form <file.ext> with [file.ext] so that the frontend can render them as links, match them with a regex to avoid 
+# generalizing too much and disrupt HTML snippets if present
+def cite_sources(answer: str) -> str:
+    return re.sub(r"<([a-zA-Z0-9_ \-\.]+)>", r"[\1]", answer)
 
-        return {"data_points": self.results or [], "answer": result, "thoughts": cb_handler.get_and_reset_log()}
-    
-class ReAct(ReActDocstoreAgent):
-    @classmethod
-    def create_prompt(cls, tools: List[Tool]) -> BasePromptTemplate:
-        return prompt
+def parse_plan(plan: str) -> list[tuple[str, str]]:
+    return [(match.group(1), match.group(2).strip()) for match in re.finditer(r"^\s*(Search|Lookup)\[(.+)\]\s*$", plan, re.MULTILINE)]
     
 # Modified version of langchain's ReAct prompt that includes instructions and examples for how to cite information sources
 EXAMPLES = [
@@ -223,3 +328,30 @@ PREFIX = "Answer questions as shown in the following examples, by splitting the
 "Observations are prefixed by their source name in angled brackets, source names MUST be included with the actions in the answers." \
 "All questions must be answered from the results from search or look up actions, only facts resulting from those can be used in an answer. " \
 "Answer questions as truthfully as possible, and ONLY answer the questions using the information from observations, do not speculate or your own knowledge."
+
+PLAN_PROMPT = "Split the question into the searches and lookups needed to answer it, like in the examples. Each action must be " \
+"answerable on its own, without the result of another action. Search[query] searches the DNB insurance documents, " \
+"Lookup[term] looks up the meaning of a term. Write one action per line and no more than {max_actions} actions." + """
+
+Question: Is a broken window covered by both the house insurance and the contents insurance?
+Actions:
+Search[house insurance broken window]
+Search[contents insurance broken window]
+
+Question: What is egenandel and how large is it for car insurance?
+Actions:
+Lookup[egenandel]
+Search[car insurance deductible]
+
+Question: {question}
+Actions:
+"""
+
+SYNTHESIS_PROMPT = "Answer the question using ONLY the information from the observations below, do not speculate or use your own knowledge. " \
+"Observations from search are prefixed by their source name, include the source name in angled brackets after every fact taken from it, e.g. <info1.pdf>. " \
+"If the observations don't answer the question, say that you don't know." + """
+
+{observations}
+
+Question: {question}
+Answer:"""
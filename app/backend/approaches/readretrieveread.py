@@ -1,14 +1,22 @@
-import openai
-from approaches.approach import Approach
-from azure.search.documents import SearchClient
+import asyncio
+import math
+from agenttools import ToolMemo
+from approaches.approach import Approach, RequestContext
+from contextpacker import budget_override, pack_sources, record_prompt_size
+from deadline import within_deadline
+from azure.search.documents.aio import SearchClient
 from azure.search.documents.models import QueryType
 from langchain.llms.openai import AzureOpenAI
 from langchain.callbacks.manager import CallbackManager, Callbacks
 from langchain.chains import LLMChain
 from langchain.agents import Tool, ZeroShotAgent, AgentExecutor
-from langchainadapters import HtmlCallbackHandler
+from openaiclient import ResilientOpenAI, langchain_llm, use_current_api_key
+from langchainadapters import HtmlCallbackHandler, TracingCallbackHandler
+from searchcache import TTLCache
+from sections import merge_sections
 from text import nonewlines
-from typing import Any
+from tracing import span
+from typing import Any, Optional
 
 class ReadRetrieveReadApproach(Approach):
     """
@@ -54,70 +62,107 @@ Final Answer: Based on my observations, I now know the final answer to the origi
 
     CognitiveSearchToolDescription = "Useful for searching for public information about DNB insurance car insurance, etc."
 
-    def __init__(self, search_client: SearchClient, openai_deployment: str, sourcepage_field: str, content_field: str):
+    # Tokens of search results in one observation, shared evenly by the sources. Every iteration of the agent adds one
+    OBSERVATION_TOKEN_BUDGET = 300
+
+    # Agents kept for different prompt and temperature overrides
+    AGENT_CACHE_SIZE = 32
+
+    def __init__(self, search_client: SearchClient, openai_deployment: str, sourcepage_field: str, content_field: str,
+                 completions: Optional[ResilientOpenAI] = None):
         self.search_client = search_client
         self.openai_deployment = openai_deployment
         self.sourcepage_field = sourcepage_field
         self.content_field = content_field
+        self.completions = completions or ResilientOpenAI()
+        self.agents = TTLCache(self.AGENT_CACHE_SIZE, math.inf)
+
+    def warmup(self):
+        self.get_agent({})
+
+    def get_agent(self, overrides: dict[str, Any]) -> ZeroShotAgent:
+        """
+        The agent with its prompt and LLM only depends on the overrides of the prompt and the temperature, so it is built
+        once for every combination of them and shared by the requests. The tools are bound per request when the agent
+        is run, the prompt only uses their names and descriptions.
+        """
+        temperature = overrides.get("temperature") or 0
+        key = (overrides.get("prompt_template_prefix"), overrides.get("prompt_template_suffix"), temperature)
+        agent = self.agents.get(key)
+        if agent is None:
+            tools = [Tool(name="CognitiveSearch", func=lambda _: "Not implemented", description=self.CognitiveSearchToolDescription)]
+            llm = langchain_llm(AzureOpenAI, self.completions.completion, deployment_name=self.openai_deployment, temperature=temperature)
+            agent = ZeroShotAgent(llm_chain=LLMChain(llm=llm, prompt=self.create_prompt(tools, overrides)), allowed_tools=[tool.name for tool in tools])
+            self.agents.put(key, agent)
+        use_current_api_key(agent.llm_chain.llm)
+        return agent
 
-    def retrieve(self, q: str, overrides: dict[str, Any]) -> Any:
+    def create_prompt(self, tools, overrides: dict[str, Any]):
+        return ZeroShotAgent.create_prompt(
+            tools=tools,
+            prefix=overrides.get("prompt_template_prefix") or self.template_prefix,
+            suffix=overrides.get("prompt_template_suffix") or self.template_suffix,
+            input_variables = ["input", "agent_scratchpad"])
+
+    async def retrieve(self, q: str, context: RequestContext) -> Any:
+        overrides = context.overrides
         use_semantic_captions = True if overrides.get("semantic_captions") else False
         top = overrides.get("top") or 3
         exclude_category = overrides.get("exclude_category") or None
         filter = "category ne '{}'".format(exclude_category.replace("'", "''")) if exclude_category else None
 
-        if overrides.get("semantic_ranker"):
-            r = self.search_client.search(q,
-                                          filter=filter, 
-                                          query_type=QueryType.SEMANTIC, 
-                                          query_language="en-us", 
-                                          query_speller="lexicon", 
-                                          semantic_configuration_name="default", 
-                                          top = top,
-                                          query_caption="extractive|highlight-false" if use_semantic_captions else None)
-        else:
-            r = self.search_client.search(q, filter=filter, top=top)
-        if use_semantic_captions:
-            self.results = [doc[self.sourcepage_field] + ":" + nonewlines(" -.- ".join([c.text for c in doc['@search.captions']])) for doc in r]
-        else:
-            self.results = [doc[self.sourcepage_field] + ":" + nonewlines(doc[self.content_field][:250]) for doc in r]
-        content = "\n".join(self.results)
-        return content
+        with span("search"):
+            if overrides.get("semantic_ranker"):
+                r = await self.search_client.search(q,
+                                              filter=filter, 
+                                              query_type=QueryType.SEMANTIC, 
+                                              query_language="en-us", 
+                                              query_speller="lexicon", 
+                                              semantic_configuration_name="default", 
+                                              top = top,
+                                              query_caption="extractive|highlight-false" if use_semantic_captions else None)
+            else:
+                r = await self.search_client.search(q, filter=filter, top=top)
+            if use_semantic_captions:
+                results = [doc[self.sourcepage_field] + ":" + nonewlines(" -.- ".join([c.text for c in doc['@search.captions']])) async for doc in r]
+            else:
+                documents = merge_sections([doc async for doc in r], self.sourcepage_field, self.content_field)
+                results = [doc[self.sourcepage_field] + ":" + nonewlines(doc[self.content_field]) for doc in documents]
+        # Cut the sources to their share of the observation budget, instead of to a fixed number of characters
+        budget = budget_override(overrides, self.OBSERVATION_TOKEN_BUDGET, "observation_token_budget")
+        packed = pack_sources(results, budget, budget // max(1, len(results)))
+        record_prompt_size(observation=packed.tokens)
+        context.results = packed.sources
+        return "\n".join(packed.sources)
         
-    def run(self, q: str, overrides: dict[str, Any], ask_user: str) -> Any:
+    async def run(self, q: str, overrides: dict[str, Any], ask_user: str = None) -> Any:
         
         if bool(ask_user):
             return ask_user
-        # Not great to keep this as instance state, won't work with interleaving (e.g. if using async), but keeps the example simple
-        self.results = None
+        # The approach is shared by concurrent requests, what this request retrieves is kept in its own context
+        context = RequestContext(overrides)
 
         # Use to capture thought process during iterations
         cb_handler = HtmlCallbackHandler()
         cb_manager = CallbackManager(handlers=[cb_handler])
         
-        acs_tool = Tool(name="CognitiveSearch", 
-                        func=lambda q: self.retrieve(q, overrides), 
-                        description=self.CognitiveSearchToolDescription,
-                        callbacks=cb_manager)
+        # Repeated searches of this request are answered from the memo, and the agent is stopped once it goes in circles
+        memo = ToolMemo()
+        acs_tool = memo.tool("CognitiveSearch", self.CognitiveSearchToolDescription, lambda q: self.retrieve(q, context), cb_manager)
        
         tools = [acs_tool]
 
-        prompt = ZeroShotAgent.create_prompt(
-            tools=tools,
-            prefix=overrides.get("prompt_template_prefix") or self.template_prefix,
-            suffix=overrides.get("prompt_template_suffix") or self.template_suffix,
-            input_variables = ["input", "agent_scratchpad"])
-        print(prompt)
-        llm = AzureOpenAI(deployment_name=self.openai_deployment, temperature=overrides.get("temperature") or 0, openai_api_key=openai.api_key)
-        chain = LLMChain(llm = llm, prompt = prompt)
         agent_exec = AgentExecutor.from_agent_and_tools(
-            agent = ZeroShotAgent(llm_chain = chain, tools = tools),
+            agent = self.get_agent(overrides),
             tools = tools, 
             verbose = True, 
             callback_manager = cb_manager)
-        result = agent_exec.run(q)
+        try:
+            result = await within_deadline(memo.run(agent_exec, q, callbacks=[TracingCallbackHandler()]), "agent")
+        except asyncio.TimeoutError:
+            result = self.timeout_answer
                 
         # Remove references to tool names that might be confused with a citation
         result = result.replace("[CognitiveSearch]", "")
 
-        return {"data_points": self.results or [], "answer": result, "thoughts": cb_handler.get_and_reset_log()}
+        return {"data_points": context.results, "answer": result, "thoughts": cb_handler.get_and_reset_log()}
@@ -1,10 +1,16 @@
-import openai
+import asyncio
 from approaches.approach import Approach
-from azure.search.documents import SearchClient
+from answercache import AnswerCache
+from contextpacker import budget_override, count_tokens, pack_sources, record_prompt_size
+from deadline import iterate_within_deadline, within_deadline
+from nearduplicates import NearDuplicateIndex
+from openaiclient import ResilientOpenAI
+from azure.search.documents.aio import SearchClient
 from azure.search.documents.models import QueryType
+from sections import merge_sections
 from text import nonewlines
-from typing import Any
-from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from tracing import span
+from typing import Any, AsyncGenerator, Optional
 
 
 class RetrieveThenReadApproach(Approach):
@@ -48,69 +54,156 @@ Sources:
 Answer:
 """
 
-    def __init__(self, search_client: SearchClient, openai_deployment: str, sourcepage_field: str, content_field: str):
+    timeout_answer = "Request took too long to generate, pleasre try again:=)"
+
+    # Tokens for the whole prompt, the model's context has room for this and the 1024 tokens of the answer
+    PROMPT_TOKEN_BUDGET = 3000
+
+    # Longest the completion may take, less if the request's deadline is closer
+    COMPLETION_TIMEOUT = 4
+
+    def __init__(self, search_client: SearchClient, openai_deployment: str, sourcepage_field: str, content_field: str,
+                 answer_cache: Optional[AnswerCache] = None, near_duplicates: Optional[NearDuplicateIndex] = None,
+                 completions: Optional[ResilientOpenAI] = None):
         self.search_client = search_client
         self.openai_deployment = openai_deployment
         self.sourcepage_field = sourcepage_field
         self.content_field = content_field
+        self.answer_cache = answer_cache
+        self.near_duplicates = near_duplicates
+        self.completions = completions or ResilientOpenAI()
 
 
 
-    def run(self, q: str, overrides: dict[str, Any]) -> Any:
-        use_semantic_captions = True if overrides.get("semantic_captions") else False
-        top = overrides.get("top") or 3
-        exclude_category = overrides.get("exclude_category") or None
-        filter = "category ne '{}'".format(exclude_category.replace("'", "''")) if exclude_category else None
-
-        if overrides.get("semantic_ranker"):
-            r = self.search_client.search(q, 
-                                          filter=filter,
-                                          query_type=QueryType.SEMANTIC, 
-                                          query_language="en-us", 
-                                          query_speller="lexicon", 
-                                          semantic_configuration_name="default", 
-                                          top=top, 
-                                          query_caption="extractive|highlight-false" if use_semantic_captions else None)
-        else:
-            r = self.search_client.search(q, filter=filter, top=top)
-        if use_semantic_captions:
-            results = [doc[self.sourcepage_field] + ": " + nonewlines(" . ".join([c.text for c in doc['@search.captions']])) for doc in r]
-        else:
-            results = [doc[self.sourcepage_field] + ": " + nonewlines(doc[self.content_field]) for doc in r]
-        content = "\n".join(results)
-
-        prompt = (overrides.get("prompt_template") or self.template).format(q=q, retrieved=content)
+    async def run(self, q: str, overrides: dict[str, Any]) -> Any:
+        try:
+            results, prompt = await within_deadline(self.retrieve(q, overrides), "search")
+        except asyncio.TimeoutError:
+            return {"data_points": [], "answer": self.timeout_answer, "thoughts": ""}
 
-        
-        #Setting max time limit for OpenAI search
-        max_time_limit = 4
+        cache_key = self.answer_cache_key(q, results, overrides)
+        cached_answer = await self.answer_cache.get(cache_key) if cache_key else None
+        if cached_answer is not None:
+            return {"data_points": results, "answer": cached_answer, "thoughts": self.format_thoughts(q, prompt)}
 
 
-        #Start the threading, if the get_completion method takes to long(max_time_limit) the TimeoutError is triggered.
+        #Wait for the completion, if the get_completion method takes to long (COMPLETION_TIMEOUT or until the deadline) the TimeoutError is triggered and the request is cancelled.
         try:
-            with ThreadPoolExecutor() as executor:
-                future = executor.submit(self.get_completion, prompt, overrides)
-                completion = future.result(timeout=max_time_limit)
+            completion = await within_deadline(self.get_completion(prompt, overrides), "llm", self.COMPLETION_TIMEOUT)
         
-        except TimeoutError:
+        except asyncio.TimeoutError:
             #Custom response for when it takes to long
-            return {"data_points": results, "answer": "Request took too long to generate, pleasre try again:=)", "thoughts": f"Question:<br>{q}<br><br>Prompt:<br>" + prompt.replace('\n', '<br>')}
+            return {"data_points": results, "answer": self.timeout_answer, "thoughts": self.format_thoughts(q, prompt)}
         
         #Regular response for when timeouts doesnt happen.
-        return {"data_points": results, "answer": completion.choices[0].text, "thoughts": f"Question:<br>{q}<br><br>Prompt:<br>" + prompt.replace('\n', '<br>')}
+        if cache_key:
+            await self.answer_cache.put(cache_key, completion.choices[0].text)
+        self.answered(q)
+        return {"data_points": results, "answer": completion.choices[0].text, "thoughts": self.format_thoughts(q, prompt)}
 
+    async def run_stream(self, q: str, overrides: dict[str, Any]) -> AsyncGenerator[dict[str, Any], None]:
+        try:
+            results, prompt = await within_deadline(self.retrieve(q, overrides), "search")
+        except asyncio.TimeoutError:
+            yield {"answer": self.timeout_answer}
+            return
+        yield {"data_points": results, "thoughts": self.format_thoughts(q, prompt)}
+
+        cache_key = self.answer_cache_key(q, results, overrides)
+        cached_answer = await self.answer_cache.get(cache_key) if cache_key else None
+        if cached_answer is not None:
+            yield {"answer": cached_answer}
+            return
+
+        #Same time limit as in run until the first token arrives, the rest of the answer only has to arrive before the deadline
+        try:
+            completion = await within_deadline(self.get_completion(prompt, overrides, stream=True), "llm", self.COMPLETION_TIMEOUT)
+        except asyncio.TimeoutError:
+            yield {"answer": self.timeout_answer}
+            return
 
-    #Query for the completion from OpenAI
-    def get_completion(self, prompt, overrides):
-        return openai.Completion.create(
-            engine = self.openai_deployment,
-            prompt = prompt,
-            temperature = overrides.get("temperature") or 0.3,
-            max_tokens = 1024,
-            n = 1,
-            stop = ["\n"]
+        answer = ""
+        try:
+            async for chunk in iterate_within_deadline(completion, "llm_stream"):
+                if chunk.choices and chunk.choices[0].text:
+                    answer += chunk.choices[0].text
+                    yield {"delta": chunk.choices[0].text}
+        except asyncio.TimeoutError:
+            # The answer is cut off, it is sent as far as it got but not cached
+            yield {"answer": answer or self.timeout_answer}
+            return
+        if cache_key and answer:
+            await self.answer_cache.put(cache_key, answer)
+        if answer:
+            self.answered(q)
+        yield {"answer": answer}
+
+    async def retrieve(self, q: str, overrides: dict[str, Any]) -> tuple[list[str], str]:
+        use_semantic_captions = True if overrides.get("semantic_captions") else False
+        top = overrides.get("top") or 3
+        exclude_category = overrides.get("exclude_category") or None
+        filter = "category ne '{}'".format(exclude_category.replace("'", "''")) if exclude_category else None
 
-        )
+        # The results are fetched while iterating, so that is part of the search span
+        with span("search"):
+            if overrides.get("semantic_ranker"):
+                r = await self.search_client.search(q, 
+                                              filter=filter,
+                                              query_type=QueryType.SEMANTIC, 
+                                              query_language="en-us", 
+                                              query_speller="lexicon", 
+                                              semantic_configuration_name="default", 
+                                              top=top, 
+                                              query_caption="extractive|highlight-false" if use_semantic_captions else None)
+            else:
+                r = await self.search_client.search(q, filter=filter, top=top)
+            if use_semantic_captions:
+                results = [doc[self.sourcepage_field] + ": " + nonewlines(" . ".join([c.text for c in doc['@search.captions']])) async for doc in r]
+            else:
+                documents = merge_sections([doc async for doc in r], self.sourcepage_field, self.content_field)
+                results = [doc[self.sourcepage_field] + ": " + nonewlines(doc[self.content_field]) for doc in documents]
+
+        # The most relevant sources that fit next to the template and question, only those are returned as data points
+        template = overrides.get("prompt_template") or self.template
+        fixed_tokens = count_tokens(template) + count_tokens(q)
+        packed = pack_sources(results, budget_override(overrides, self.PROMPT_TOKEN_BUDGET) - fixed_tokens)
+        record_prompt_size(sources=packed.tokens, total=fixed_tokens + packed.tokens)
+
+        prompt = template.format(q=q, retrieved="\n".join(packed.sources))
+
+        return packed.sources, prompt
+
+    # The same question answered from the same sources with the same prompt and temperature gets the same answer. A
+    # paraphrase of a recent question shares its answer, but only if its own search found the very same sources, so a
+    # question that differs in what it asks about (the kitchen instead of the bathroom) is answered on its own
+    def answer_cache_key(self, q: str, results: list[str], overrides: dict[str, Any]) -> Optional[str]:
+        if not self.answer_cache:
+            return None
+        similar_q = self.near_duplicates.match(q) if self.near_duplicates else None
+        return self.answer_cache.key(similar_q or q, results, overrides.get("prompt_template") or self.template, self.openai_deployment, overrides.get("temperature") or 0.3)
+
+    # Paraphrases of questions that were answered can share their cached answer
+    def answered(self, q: str):
+        if self.near_duplicates:
+            self.near_duplicates.add(q)
+
+    def format_thoughts(self, q: str, prompt: str) -> str:
+        return f"Question:<br>{q}<br><br>Prompt:<br>" + prompt.replace('\n', '<br>')
+
+
+    #Query for the completion from OpenAI, when streaming only the time until the response starts is traced
+    async def get_completion(self, prompt, overrides, stream=False):
+        with span("llm"):
+            return await self.completions.completion.acreate(
+                engine = self.openai_deployment,
+                prompt = prompt,
+                temperature = overrides.get("temperature") or 0.3,
+                max_tokens = 1024,
+                n = 1,
+                stop = ["\n"],
+                stream = stream
+
+            )
        
     """
         #Setting the starttime for the counter
@@ -0,0 +1,158 @@
+import os
+import argparse
+import asyncio
+import contextlib
+import importlib
+import json
+import statistics
+import sys
+import time
+import tracemalloc
+import openai
+from contextpacker import load_encoding
+from fakebackends import FakeOpenAI, FakeSearchClient, make_documents
+
+# Same settings as the app, the calls never leave the process
+openai.api_type = "azure_ad"
+openai.api_base = "https://benchmark.openai.azure.com"
+openai.api_version = "2023-06-01-preview"
+
+APPROACHES = {
+    "ask:rtr": "approaches.retrievethenread:RetrieveThenReadApproach",
+    "ask:rrr": "approaches.readretrieveread:ReadRetrieveReadApproach",
+    "ask:rda": "approaches.readdecomposeask:ReadDecomposeAsk",
+    "chat:rtr": "approaches.chatretrievethenread:ChatRetrieveThenReadApproach",
+    "chat:rrr": "approaches.chatreadretrieveread:ChatReadRetrieveReadApproach"
+}
+
+QUESTIONS = ["Does my house insurance cover water damage?", "What is the deductible for a fire claim?",
+             "How long do I have to report theft?", "Is storm damage to the garden covered?"]
+
+parser = argparse.ArgumentParser(
+    description="Run the approaches against in-process stand-ins for Cognitive Search and Azure OpenAI and report CPU time, allocations and throughput per request. No network access is needed.",
+    epilog="Example: benchmark.py --approaches ask:rtr chat:rtr --tops 3 6 --history-lengths 1 5 10 --json results.json"
+    )
+parser.add_argument("--approaches", nargs="+", choices=APPROACHES.keys(), default=list(APPROACHES.keys()), help="Approaches to run, all by default")
+parser.add_argument("--tops", nargs="+", type=int, default=[3, 6], help="Values of the top override to run each approach with")
+parser.add_argument("--history-lengths", nargs="+", type=int, default=[1, 5, 10], help="Number of turns in the history sent to the chat approaches")
+parser.add_argument("--iterations", type=int, default=20, help="Requests measured per case")
+parser.add_argument("--warmup", type=int, default=2, help="Requests run before measuring each case")
+parser.add_argument("--concurrency", type=int, default=1, help="Requests in flight while measuring throughput")
+parser.add_argument("--documents", type=int, default=20, help="Number of documents in the fake search index")
+parser.add_argument("--content-length", type=int, default=1000, help="Characters of content per document")
+parser.add_argument("--answer-words", type=int, default=50, help="Words in each generated answer")
+parser.add_argument("--search-latency", type=float, default=0.0, help="Simulated latency of each search call in seconds")
+parser.add_argument("--openai-latency", type=float, default=0.0, help="Simulated latency of each OpenAI call in seconds")
+parser.add_argument("--json", help="Write the results to this file")
+parser.add_argument("--baseline", help="Results of an earlier run (from --json) to compare the CPU time with")
+parser.add_argument("--max-regression", type=float, default=0.2, help="Fail if the median CPU time of a case grows by more than this fraction over the baseline")
+parser.add_argument("--verbose", "-v", action="store_true", help="Show the output of the approaches")
+args = parser.parse_args()
+
+def create_approach(key, search_client):
+    module_name, class_name = APPROACHES[key].split(":")
+    approach = getattr(importlib.import_module(module_name), class_name)(search_client, "benchmark", "sourcepage", "content")
+    approach.warmup()
+    return approach
+
+def make_request(key, history_length, i):
+    question = QUESTIONS[i % len(QUESTIONS)]
+    if not key.startswith("chat:"):
+        return question
+    history = [{"user": QUESTIONS[(i + turn) % len(QUESTIONS)], "assistant": f"Yes, that is covered [Insurance-{turn % 3}.pdf]. <<What does it cost?>>"}
+               for turn in range(history_length - 1)]
+    return history + [{"user": question}]
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+async def run_case(approach, key, top, history_length):
+    overrides = {"top": top}
+    requests = [make_request(key, history_length, i) for i in range(args.iterations)]
+    for i in range(args.warmup):
+        await approach.run(make_request(key, history_length, i), overrides)
+
+    # CPU time per request, measured one request at a time so it only includes the work of that request
+    cpu_times = []
+    for request in requests:
+        start = time.process_time()
+        await approach.run(request, overrides)
+        cpu_times.append(time.process_time() - start)
+
+    # Peak memory allocated while answering a request
+    allocations = []
+    tracemalloc.start()
+    for request in requests:
+        before, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        await approach.run(request, overrides)
+        allocations.append(tracemalloc.get_traced_memory()[1] - before)
+    tracemalloc.stop()
+
+    # Throughput with the configured number of requests in flight
+    semaphore = asyncio.Semaphore(args.concurrency)
+    async def limited(request):
+        async with semaphore:
+            await approach.run(request, overrides)
+    start = time.perf_counter()
+    await asyncio.gather(*[limited(request) for request in requests])
+    elapsed = time.perf_counter() - start
+
+    return {
+        "approach": key,
+        "top": top,
+        "history_length": history_length if key.startswith("chat:") else None,
+        "cpu_ms_median": statistics.median(cpu_times) * 1000,
+        "cpu_ms_p95": percentile(cpu_times, 95) * 1000,
+        "peak_kib_median": statistics.median(allocations) / 1024,
+        "requests_per_second": len(requests) / elapsed
+    }
+
+def case_name(result):
+    history = f" history={result['history_length']}" if result["history_length"] is not None else ""
+    return f"{result['approach']} top={result['top']}{history}"
+
+async def main():
+    documents = make_documents(args.documents, args.content_length)
+    search_client = FakeSearchClient(documents, args.search_latency)
+    fake_openai = FakeOpenAI(documents[0]["sourcepage"], args.openai_latency, args.answer_words)
+    fake_openai.install()
+    # Token counts are part of the cost of building prompts, the app counts them with the tokenizer once warmed up
+    try:
+        await asyncio.wait_for(load_encoding(), 30)
+    except asyncio.TimeoutError:
+        print("Could not load the tokenizer, token counts are estimated")
+
+    results = []
+    print(f"{'case':<36} {'cpu ms median':>14} {'cpu ms p95':>11} {'peak KiB':>9} {'req/s':>9}")
+    for key in args.approaches:
+        approach = create_approach(key, search_client)
+        for top in args.tops:
+            for history_length in (args.history_lengths if key.startswith("chat:") else [None]):
+                # The approaches and LangChain print their progress, which is only wanted when debugging
+                with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(sys.stdout if args.verbose else devnull):
+                    result = await run_case(approach, key, top, history_length)
+                results.append(result)
+                print(f"{case_name(result):<36} {result['cpu_ms_median']:>14.2f} {result['cpu_ms_p95']:>11.2f} {result['peak_kib_median']:>9.1f} {result['requests_per_second']:>9.1f}")
+    fake_openai.uninstall()
+    return results
+
+results = asyncio.run(main())
+
+if args.json:
+    with open(args.json, "w") as f:
+        json.dump(results, f, indent=2)
+
+if args.baseline:
+    with open(args.baseline) as f:
+        baseline = {case_name(result): result for result in json.load(f)}
+    regressions = []
+    for result in results:
+        previous = baseline.get(case_name(result))
+        if previous and result["cpu_ms_median"] > previous["cpu_ms_median"] * (1 + args.max_regression):
+            regressions.append(f"{case_name(result)}: {previous['cpu_ms_median']:.2f} ms -> {result['cpu_ms_median']:.2f} ms")
+    if regressions:
+        print("CPU time regressions over the baseline:")
+        print("\n".join(regressions))
+        exit(1)
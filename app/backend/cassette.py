@@ -0,0 +1,237 @@
+import asyncio
+import collections
+import hashlib
+import json
+import logging
+import os
+import time
+from types import SimpleNamespace
+from typing import Any, AsyncIterator, Optional
+import openai
+import openai.error
+from openai.openai_object import OpenAIObject
+from metrics import Counter
+from searchcache import SearchResults
+
+replay_misses_total = Counter("cassette_replay_misses_total", "Requests without an exact match in the replayed cassette", ["service"])
+
+# Connection settings and credentials passed to the OpenAI SDK, they don't change the response
+IGNORED_OPENAI_ARGUMENTS = {"api_key", "api_base", "api_type", "api_version", "organization", "request_timeout", "headers"}
+
+# Routes whose requests are recorded, so the traffic can be sent again with replay.py
+RECORDED_ROUTES = {"/ask", "/chat", "/ask_stream", "/chat_stream"}
+
+def request_key(service: str, request: dict[str, Any]) -> str:
+    return hashlib.sha256((service + json.dumps(request, sort_keys=True, default=str)).encode("utf-8")).hexdigest()
+
+def to_json(value: Any) -> Any:
+    # Search results contain caption and answer objects, they are kept with the attributes the approaches read
+    if isinstance(value, dict):
+        return {k: to_json(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [to_json(v) for v in value]
+    if hasattr(value, "text") and not isinstance(value, str):
+        return {"text": value.text, "highlights": getattr(value, "highlights", None), "key": getattr(value, "key", None), "score": getattr(value, "score", None)}
+    return value
+
+def caption_objects(document: dict[str, Any]) -> dict[str, Any]:
+    if document.get("@search.captions"):
+        return {**document, "@search.captions": [SimpleNamespace(**c) for c in document["@search.captions"]]}
+    return document
+
+class Cassette:
+    """
+    Requests to Cognitive Search and Azure OpenAI and their responses, stored as one JSON object per line. Each
+    interaction keeps how long the service took to answer, and streamed responses the time of every chunk, so a
+    replay can reproduce the original latencies. Lines are appended with a single write, so several workers can
+    record into the same file.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def append(self, interaction: dict[str, Any]):
+        line = json.dumps(interaction, ensure_ascii=False, default=str) + "\n"
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(line)
+
+    def load(self) -> list[dict[str, Any]]:
+        with open(self.path, encoding="utf-8") as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+class CassetteRecorder:
+    """
+    Records what the app sends to Cognitive Search and Azure OpenAI. The search client is wrapped, and the OpenAI
+    SDK's Completion.acreate and ChatCompletion.acreate are replaced, which also covers the LangChain LLMs of the agent
+    approaches. Incoming /ask and /chat requests are recorded as well, so the traffic itself can be replayed.
+    """
+
+    def __init__(self, cassette: Cassette):
+        self.cassette = cassette
+        self.originals = None
+
+    def install(self):
+        self.originals = (openai.Completion.acreate, openai.ChatCompletion.acreate)
+        completion, chat_completion = self.originals
+        openai.Completion.acreate = lambda **kwargs: self.record_openai("completion", completion, kwargs)
+        openai.ChatCompletion.acreate = lambda **kwargs: self.record_openai("chat_completion", chat_completion, kwargs)
+
+    def uninstall(self):
+        if self.originals:
+            openai.Completion.acreate, openai.ChatCompletion.acreate = self.originals
+            self.originals = None
+
+    def wrap_search_client(self, search_client) -> "RecordingSearchClient":
+        return RecordingSearchClient(search_client, self)
+
+    def record_request(self, route: str, body: Any):
+        self.cassette.append({"service": "http", "route": route, "at": time.time(), "request": body})
+
+    def record(self, service: str, request: dict[str, Any], elapsed: float, **result: Any):
+        self.cassette.append({"service": service, "key": request_key(service, request), "request": request, "elapsed": round(elapsed, 4), **result})
+
+    async def record_openai(self, service: str, create, kwargs: dict[str, Any]):
+        request = {k: v for k, v in kwargs.items() if k not in IGNORED_OPENAI_ARGUMENTS}
+        start = time.monotonic()
+        try:
+            response = await create(**kwargs)
+        except openai.error.OpenAIError as e:
+            self.record(service, request, time.monotonic() - start, error={"type": type(e).__name__, "message": str(e)})
+            raise
+        if kwargs.get("stream"):
+            return self.record_stream(service, request, start, time.monotonic() - start, response)
+        self.record(service, request, time.monotonic() - start, response=response.to_dict_recursive())
+        return response
+
+    async def record_stream(self, service: str, request: dict[str, Any], start: float, elapsed: float, response) -> AsyncIterator[OpenAIObject]:
+        # The interaction is only written once the stream is complete, a stream the client abandoned is not replayable
+        chunks = []
+        async for chunk in response:
+            chunks.append({"at": round(time.monotonic() - start, 4), "chunk": chunk.to_dict_recursive()})
+            yield chunk
+        self.record(service, request, elapsed, chunks=chunks)
+
+class RecordingSearchClient:
+    """Passes every search to the real client and records the materialized results, answers and total count."""
+
+    def __init__(self, search_client, recorder: CassetteRecorder):
+        self.search_client = search_client
+        self.recorder = recorder
+
+    async def search(self, search_text: str, **kwargs: Any) -> SearchResults:
+        start = time.monotonic()
+        r = await self.search_client.search(search_text, **kwargs)
+        documents = [doc async for doc in r]
+        answers = await r.get_answers()
+        count = await r.get_count()
+        elapsed = time.monotonic() - start
+
+        documents, answers = to_json(documents), to_json(answers)
+        self.recorder.record("search", {"search_text": search_text, **kwargs}, elapsed, response={"documents": documents, "answers": answers, "count": count})
+        return replay_search_results(documents, answers, count)
+
+    def __getattr__(self, name: str) -> Any:
+        # get_document_count, close... are passed through unrecorded
+        return getattr(self.search_client, name)
+
+def replay_search_results(documents: list[dict[str, Any]], answers: Optional[list], count: Optional[int]) -> SearchResults:
+    return SearchResults([caption_objects(doc) for doc in documents],
+                             [SimpleNamespace(**a) for a in answers] if answers is not None else None,
+                             count)
+
+class CassettePlayer:
+    """
+    Serves the recorded responses instead of calling Cognitive Search and Azure OpenAI. Responses wait as long as the
+    service originally took, multiplied by speed, so 0 answers right away. A request that was recorded several times
+    gets its recordings in turn. Requests without an exact match, e.g. because a prompt changed between the recorded
+    and the replayed version of an approach, get the next recording of the same service unless strict is set.
+    """
+
+    def __init__(self, cassette: Cassette, speed: float = 1.0, strict: bool = False):
+        self.speed = speed
+        self.strict = strict
+        self.originals = None
+        self.by_key: dict[str, collections.deque] = collections.defaultdict(collections.deque)
+        self.by_service: dict[str, collections.deque] = collections.defaultdict(collections.deque)
+        for interaction in cassette.load():
+            if interaction["service"] != "http":
+                self.by_key[interaction["key"]].append(interaction)
+                self.by_service[interaction["service"]].append(interaction)
+
+    def install(self):
+        self.originals = (openai.Completion.acreate, openai.ChatCompletion.acreate)
+        openai.Completion.acreate = lambda **kwargs: self.replay_openai("completion", kwargs)
+        openai.ChatCompletion.acreate = lambda **kwargs: self.replay_openai("chat_completion", kwargs)
+        openai.api_key = openai.api_key or "replay"
+
+    def uninstall(self):
+        if self.originals:
+            openai.Completion.acreate, openai.ChatCompletion.acreate = self.originals
+            self.originals = None
+
+    def search_client(self) -> "ReplaySearchClient":
+        return ReplaySearchClient(self)
+
+    def next_interaction(self, service: str, request: dict[str, Any]) -> dict[str, Any]:
+        recordings = self.by_key.get(request_key(service, request))
+        if not recordings:
+            replay_misses_total.inc(service=service)
+            recordings = self.by_service.get(service)
+            if self.strict or not recordings:
+                raise LookupError(f"No recorded {service} response for {json.dumps(request, default=str)[:200]}")
+            logging.debug(f"No exact {service} match in the cassette, using the next recording")
+        interaction = recordings[0]
+        recordings.rotate(-1)
+        return interaction
+
+    async def wait(self, seconds: float):
+        if self.speed > 0:
+            await asyncio.sleep(seconds * self.speed)
+
+    async def replay_openai(self, service: str, kwargs: dict[str, Any]):
+        interaction = self.next_interaction(service, {k: v for k, v in kwargs.items() if k not in IGNORED_OPENAI_ARGUMENTS})
+        await self.wait(interaction["elapsed"])
+        if "error" in interaction:
+            raise getattr(openai.error, interaction["error"]["type"], openai.error.OpenAIError)(interaction["error"]["message"])
+        if "chunks" in interaction:
+            return self.replay_stream(interaction)
+        return OpenAIObject.construct_from(interaction["response"])
+
+    async def replay_stream(self, interaction: dict[str, Any]) -> AsyncIterator[OpenAIObject]:
+        previous = interaction["elapsed"]
+        for chunk in interaction["chunks"]:
+            await self.wait(chunk["at"] - previous)
+            previous = chunk["at"]
+            yield OpenAIObject.construct_from(chunk["chunk"])
+
+class ReplaySearchClient:
+    """Stands in for the async SearchClient and answers every search from the cassette."""
+
+    def __init__(self, player: CassettePlayer):
+        self.player = player
+
+    async def search(self, search_text: str, **kwargs: Any) -> SearchResults:
+        interaction = self.player.next_interaction("search", {"search_text": search_text, **kwargs})
+        await self.player.wait(interaction["elapsed"])
+        response = interaction["response"]
+        return replay_search_results(response["documents"], response["answers"], response["count"])
+
+    async def get_document_count(self) -> int:
+        return 0
+
+    async def close(self):
+        pass
+
+def recorded_requests(path: str) -> list[dict[str, Any]]:
+    return [interaction for interaction in Cassette(path).load() if interaction["service"] == "http"]
+
+def from_environment() -> tuple[Optional[CassetteRecorder], Optional[CassettePlayer]]:
+    mode = os.environ.get("CASSETTE_MODE")
+    if not mode:
+        return None, None
+    cassette = Cassette(os.environ.get("CASSETTE_PATH") or "cassette.jsonl")
+    if mode == "record":
+        return CassetteRecorder(cassette), None
+    if mode == "replay":
+        return None, CassettePlayer(cassette, float(os.environ.get("CASSETTE_REPLAY_SPEED") or 1), os.environ.get("CASSETTE_STRICT") == "1")
+    raise ValueError(f"Unknown CASSETTE_MODE {mode}, use record or replay")
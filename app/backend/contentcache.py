@@ -0,0 +1,149 @@
+import asyncio
+import hashlib
+import json
+import os
+import time
+import aiofiles
+import aiofiles.os
+from dataclasses import dataclass
+from typing import AsyncIterator, Optional
+
+CHUNK_SIZE = 64 * 1024
+
+@dataclass
+class ContentCacheEntry:
+    path: str
+    etag: str
+    content_type: str
+    size: int
+    validated_on: float
+
+class ContentCache:
+    """
+    Size bounded on-disk LRU cache for the source pages served by /content. Every entry is a data file plus a small
+    JSON file with the blob's etag and content type. Entries are written to a temporary file and moved into place when
+    complete, so several workers on the same machine can share the directory. The data file's modification time
+    is used as the last access time for eviction.
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def _base_path(self, name: str) -> str:
+        return os.path.join(self.directory, hashlib.sha256(name.encode("utf-8")).hexdigest())
+
+    # The cache is used from the event loop, so all file operations go through aiofiles or a worker thread
+    async def get(self, name: str) -> Optional[ContentCacheEntry]:
+        return await asyncio.to_thread(self._get, self._base_path(name))
+
+    def _get(self, base_path: str) -> Optional[ContentCacheEntry]:
+        try:
+            with open(base_path + ".json") as f:
+                metadata = json.load(f)
+            os.utime(base_path + ".data")
+        except (OSError, ValueError):
+            return None
+        return ContentCacheEntry(path=base_path + ".data", **metadata)
+
+    async def revalidated(self, name: str, entry: ContentCacheEntry) -> ContentCacheEntry:
+        entry.validated_on = time.time()
+        await self._write_metadata(self._base_path(name), entry)
+        return entry
+
+    async def remove(self, name: str):
+        base_path = self._base_path(name)
+        for path in (base_path + ".json", base_path + ".data"):
+            try:
+                await aiofiles.os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    async def read(self, entry: ContentCacheEntry, start: int, length: int) -> AsyncIterator[bytes]:
+        async with aiofiles.open(entry.path, "rb") as f:
+            await f.seek(start)
+            remaining = length
+            while remaining > 0:
+                chunk = await f.read(min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+
+    def writer(self, name: str, etag: str, content_type: str, size: int) -> Optional["ContentCacheWriter"]:
+        if size > self.max_bytes:
+            return None
+        return ContentCacheWriter(self, self._base_path(name), ContentCacheEntry(self._base_path(name) + ".data", etag, content_type, size, time.time()))
+
+    async def _write_metadata(self, base_path: str, entry: ContentCacheEntry):
+        tmp_path = f"{base_path}.json.{os.getpid()}.tmp"
+        async with aiofiles.open(tmp_path, "w") as f:
+            await f.write(json.dumps({"etag": entry.etag, "content_type": entry.content_type, "size": entry.size, "validated_on": entry.validated_on}))
+        await aiofiles.os.replace(tmp_path, base_path + ".json")
+
+    async def _commit(self, base_path: str, tmp_path: str, entry: ContentCacheEntry):
+        await aiofiles.os.replace(tmp_path, base_path + ".data")
+        await self._write_metadata(base_path, entry)
+        # Scanning the directory takes a while once it holds many entries
+        await asyncio.to_thread(self._evict)
+
+    def _evict(self):
+        files = []
+        for file in os.scandir(self.directory):
+            if file.name.endswith(".data"):
+                try:
+                    stat = file.stat()
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, file.path[:-len(".data")]))
+
+        total = sum(size for _, size, _ in files)
+        for _, size, base_path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            for path in (base_path + ".json", base_path + ".data"):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            total -= size
+
+class ContentCacheWriter:
+    """
+    Collects the chunks of a blob while they are streamed to the client. The entry only becomes visible once all
+    bytes were written, an interrupted download is thrown away.
+    """
+
+    def __init__(self, cache: ContentCache, base_path: str, entry: ContentCacheEntry):
+        self.cache = cache
+        self.base_path = base_path
+        self.entry = entry
+        self.tmp_path = f"{base_path}.data.{os.getpid()}.{id(self)}.tmp"
+        self.written = 0
+        self.file = None
+
+    async def write(self, chunk: bytes):
+        if self.file is None:
+            self.file = await aiofiles.open(self.tmp_path, "wb")
+        await self.file.write(chunk)
+        self.written += len(chunk)
+
+    async def commit(self):
+        if self.written != self.entry.size:
+            await self.abort()
+            return
+        if self.file is None:
+            # An empty blob has no chunks
+            self.file = await aiofiles.open(self.tmp_path, "wb")
+        await self.file.close()
+        await self.cache._commit(self.base_path, self.tmp_path, self.entry)
+
+    async def abort(self):
+        if self.file is None:
+            return
+        await self.file.close()
+        try:
+            await aiofiles.os.remove(self.tmp_path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,132 @@
+import asyncio
+import functools
+import logging
+import time
+from dataclasses import dataclass
+from typing import Any, Callable, Optional, Sequence
+from metrics import Histogram
+from overrides import positive_override
+from tracing import current_trace
+try:
+    import tiktoken
+except ImportError:
+    # Token counts are then estimated from the length of the text
+    tiktoken = None
+
+prompt_tokens = Histogram("prompt_tokens", "Tokens in the parts of the prompts sent to the model, after packing", ["approach", "part"],
+                          buckets=(64, 128, 256, 512, 1024, 1536, 2048, 3072, 4096, 8192))
+
+# Tokenizer of the gpt-35-turbo and gpt-4 models. The davinci models use a slightly different one, counts for
+# English and Norwegian text are close enough to size a budget
+ENCODING = "cl100k_base"
+
+# Used when tiktoken isn't available or its encoding isn't loaded yet
+CHARS_PER_TOKEN = 4
+
+# A source cut shorter than this is more likely to confuse the model than to help it, it is dropped instead
+MIN_SOURCE_TOKENS = 48
+
+# Loaded by the app's warm-up, token counts are estimated until then
+_encoding = None
+_loading: Optional[asyncio.Task] = None
+
+async def load_encoding(retry_delay: float = 5, max_retry_delay: float = 300):
+    """
+    Loads the encoding in a worker thread, since tiktoken downloads it the first time it is used. A failed download
+    is retried with exponential backoff, so a network hiccup at startup doesn't leave the process on estimates.
+    """
+    global _encoding
+    while tiktoken and _encoding is None:
+        try:
+            _encoding = await asyncio.to_thread(tiktoken.get_encoding, ENCODING)
+        except Exception as e:
+            logging.warning(f"Could not load the {ENCODING} encoding, estimating token counts until a retry in {retry_delay:.0f}s succeeds: {e!r}")
+            await asyncio.sleep(retry_delay)
+            retry_delay = min(max_retry_delay, retry_delay * 2)
+    # Counts estimated until now are not kept
+    count_tokens.cache_clear()
+
+def start_loading_encoding():
+    global _loading
+    _loading = asyncio.create_task(load_encoding())
+
+async def stop_loading_encoding():
+    if _loading:
+        _loading.cancel()
+        try:
+            await _loading
+        except asyncio.CancelledError:
+            pass
+
+# Sources are indexed sections that are retrieved again and again, so their counts are kept
+@functools.lru_cache(maxsize=20000)
+def count_tokens(text: str) -> int:
+    encoding = _encoding
+    if encoding is None:
+        return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+    return len(encoding.encode(text, disallowed_special=()))
+
+def truncate_tokens(text: str, max_tokens: int) -> str:
+    encoding = _encoding
+    if encoding is None:
+        return text[:max_tokens * CHARS_PER_TOKEN]
+    return encoding.decode(encoding.encode(text, disallowed_special=())[:max_tokens])
+
+@dataclass
+class PackedSources:
+    sources: list[str]
+    tokens: int
+    dropped: int
+    truncated: int
+
+def pack_sources(sources: Sequence[str], budget: int, max_tokens_per_source: Optional[int] = None) -> PackedSources:
+    """
+    Fills the budget with as many sources as fit, in the order search ranked them. A source that doesn't fit anymore
+    is cut to what is left, unless that would leave less than MIN_SOURCE_TOKENS of it, and sources after one that was
+    dropped are dropped as well. Sources are also cut to max_tokens_per_source, but never below MIN_SOURCE_TOKENS.
+    The top source is always kept, cut to MIN_SOURCE_TOKENS if the budget is too small even for that.
+    """
+    if sources and budget < MIN_SOURCE_TOKENS:
+        # E.g. a long template or a small prompt_token_budget, an answer without sources would only be a refusal
+        logging.warning(f"A budget of {budget} tokens leaves no room for sources, the top source is kept and cut to {MIN_SOURCE_TOKENS} tokens")
+    packed, tokens, truncated = [], 0, 0
+    for source in sources:
+        limit = budget - tokens if max_tokens_per_source is None else min(budget - tokens, max(max_tokens_per_source, MIN_SOURCE_TOKENS))
+        if not packed:
+            limit = max(limit, MIN_SOURCE_TOKENS)
+        source_tokens = count_tokens(source)
+        if source_tokens > limit:
+            if limit < MIN_SOURCE_TOKENS:
+                break
+            source = truncate_tokens(source, limit)
+            source_tokens = count_tokens(source)
+            truncated += 1
+        packed.append(source)
+        tokens += source_tokens
+    return PackedSources(packed, tokens, len(sources) - len(packed), truncated)
+
+def pack_history(history: Sequence[dict[str, str]], budget: int, render: Callable[[dict[str, str]], str]) -> tuple[list[dict[str, str]], int]:
+    """
+    Keeps the latest turns of the chat history that fit in the budget, always including the last one with the current
+    question. render gives the text a turn adds to the prompt.
+    """
+    kept, tokens = [], 0
+    for i, turn in enumerate(reversed(history)):
+        turn_tokens = count_tokens(render(turn))
+        if i > 0 and tokens + turn_tokens > budget:
+            break
+        kept.append(turn)
+        tokens += turn_tokens
+    return list(reversed(kept)), tokens
+
+def record_prompt_size(**parts: int):
+    request_trace = current_trace.get()
+    approach = request_trace.tags["approach"] if request_trace else ""
+    for part, tokens in parts.items():
+        prompt_tokens.observe(tokens, approach=approach, part=part)
+    if request_trace:
+        request_trace.spans.append({"step": "prompt_tokens", "start": round(time.monotonic() - request_trace.start, 4), "duration": 0, **parts})
+
+# Raises InvalidOverride for a budget that isn't a positive number
+def budget_override(overrides: dict[str, Any], default: int, name: str = "prompt_token_budget") -> int:
+    return positive_override(overrides, name, default, int)
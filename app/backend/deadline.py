@@ -0,0 +1,76 @@
+import asyncio
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import AsyncIterator, Awaitable, Iterator, Optional, TypeVar
+from metrics import Counter
+from tracing import current_trace
+
+T = TypeVar("T")
+
+deadline_exceeded_total = Counter("deadline_exceeded_total", "Steps cut short because the request ran out of time", ["approach", "step"])
+
+# Monotonic time by which the current request has to be answered, None outside of a request with a deadline
+current_deadline: ContextVar[Optional[float]] = ContextVar("current_deadline", default=None)
+
+@contextmanager
+def deadline(expires_at: float) -> Iterator[None]:
+    token = current_deadline.set(expires_at)
+    try:
+        yield
+    finally:
+        current_deadline.reset(token)
+
+def remaining() -> Optional[float]:
+    expires_at = current_deadline.get()
+    return None if expires_at is None else max(0.0, expires_at - time.monotonic())
+
+# Timers can fire a little early, this little time left is as good as none
+def expired() -> bool:
+    left = remaining()
+    return left is not None and left < 0.01
+
+# The time a step may take: at most its own timeout, and no longer than what is left of the request's deadline
+def step_timeout(timeout: Optional[float] = None) -> Optional[float]:
+    left = remaining()
+    if left is None:
+        return timeout
+    return left if timeout is None else min(timeout, left)
+
+def exceeded(step: str):
+    request_trace = current_trace.get()
+    deadline_exceeded_total.inc(approach=request_trace.tags["approach"] if request_trace else "", step=step)
+
+async def within_deadline(awaitable: Awaitable[T], step: str, timeout: Optional[float] = None) -> T:
+    """
+    Waits for the step to finish within step_timeout(timeout), otherwise cancels it and raises asyncio.TimeoutError.
+    Cancelling closes the connection of an OpenAI or search request that is still waiting for its response, so
+    nothing keeps running after the request was answered.
+    """
+    try:
+        return await asyncio.wait_for(awaitable, step_timeout(timeout))
+    except asyncio.TimeoutError:
+        exceeded(step)
+        raise
+
+async def iterate_within_deadline(iterator: AsyncIterator[T], step: str, grace: float = 0) -> AsyncIterator[T]:
+    """
+    Yields the items of the iterator, e.g. the chunks of a streamed completion, until the deadline passed. The
+    iterator is then closed and asyncio.TimeoutError raised, with whatever was yielded until then still usable.
+    grace is added to what is left of the deadline.
+    """
+    try:
+        while True:
+            left = remaining()
+            try:
+                item = await asyncio.wait_for(anext(iterator), None if left is None else left + grace)
+            except StopAsyncIteration:
+                return
+            except asyncio.TimeoutError:
+                exceeded(step)
+                raise
+            yield item
+    finally:
+        aclose = getattr(iterator, "aclose", None)
+        if aclose:
+            await aclose()
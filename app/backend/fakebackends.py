@@ -0,0 +1,131 @@
+import asyncio
+import json
+import random
+from typing import Any, AsyncIterator
+import openai
+from openai.openai_object import OpenAIObject
+from searchcache import SearchResults
+
+# In-process stand-ins for Cognitive Search and Azure OpenAI, so the approaches can be run without network access,
+# e.g. to measure the overhead of the approach code itself. Latencies are simulated with asyncio.sleep.
+
+WORDS = "insurance covers damage caused by water fire theft storm to the house and contents when the policy holder " \
+        "reports it within the deadline deductible applies for each claim unless agreed otherwise".split()
+
+def make_documents(count: int, content_length: int, seed: int = 0) -> list[dict[str, Any]]:
+    rng = random.Random(seed)
+    documents = []
+    for i in range(count):
+        content = ""
+        while len(content) < content_length:
+            content += " ".join(rng.choice(WORDS) for _ in range(12)) + ". "
+        documents.append({
+            "id": f"doc-{i}",
+            "content": content[:content_length],
+            "category": None,
+            "sourcepage": f"Insurance-{i}.pdf",
+            "sourcefile": "Insurance.pdf",
+            "@search.score": 2.0 + rng.random(),
+            "@search.captions": [],
+        })
+    return documents
+
+class FakeSearchClient:
+    """Answers every query with the first top documents of a fixed set, after the configured latency."""
+
+    def __init__(self, documents: list[dict[str, Any]], latency: float = 0.0):
+        self.documents = documents
+        self.latency = latency
+        self.calls = 0
+        # Options of the last search, e.g. to check its filter
+        self.last_options: dict[str, Any] = {}
+
+    async def search(self, search_text: str, **kwargs: Any) -> SearchResults:
+        self.calls += 1
+        self.last_options = kwargs
+        await asyncio.sleep(self.latency)
+        return SearchResults(self.documents[:kwargs.get("top") or 3], count=len(self.documents))
+
+    async def get_document_count(self) -> int:
+        return len(self.documents)
+
+    async def close(self):
+        pass
+
+class FakeOpenAI:
+    """
+    Replaces the OpenAI SDK's Completion.acreate and ChatCompletion.acreate with scripted replies, so each of the
+    approaches takes its usual path: the agents first call their search tool and then finish, answers cite the first
+    source and the chat approach gets a keyword query. Streaming responses send the reply word by word.
+    """
+
+    def __init__(self, source: str, latency: float = 0.0, answer_words: int = 50):
+        self.source = source
+        self.latency = latency
+        self.answer_words = answer_words
+        self.calls = 0
+        self.originals = None
+
+    def install(self):
+        self.originals = (openai.Completion.acreate, openai.ChatCompletion.acreate)
+        openai.Completion.acreate = self.completion
+        openai.ChatCompletion.acreate = self.chat_completion
+        openai.api_key = openai.api_key or "fake"
+
+    def uninstall(self):
+        if self.originals:
+            openai.Completion.acreate, openai.ChatCompletion.acreate = self.originals
+            self.originals = None
+
+    def answer(self) -> str:
+        return " ".join(WORDS[i % len(WORDS)] for i in range(self.answer_words)) + f" [{self.source}]"
+
+    def reply(self, prompt: str) -> str:
+        if "Action: Finish[" in prompt:
+            # ReAct prompt of ReadDecomposeAsk, the examples finish as well so only look at the question being answered
+            if "Observation:" in prompt.split("\nQuestion:")[-1]:
+                return f"Thought: I know the answer\nAction: Finish[{self.answer()[:-len(self.source) - 3]} <{self.source}>]"
+            return "Thought: I need to search\nAction: Search[insurance coverage]"
+        if prompt.endswith("Actions:\n"):
+            # Plan of parallel sub-questions of ReadDecomposeAsk
+            return "Search[insurance coverage]\nLookup[deductible]"
+        if "Begin!" in prompt:
+            # Zero shot agent of ReadRetrieveReadApproach
+            if "Observation:" in prompt.split("Begin!")[-1]:
+                return f" I now know the final answer\nFinal Answer: {self.answer()}"
+            return " I need to search\nAction: CognitiveSearch\nAction Input: insurance coverage"
+        return " " + self.answer()
+
+    def chat_reply(self, messages: list[dict[str, str]]) -> str:
+        last = messages[-1]["content"]
+        if "TOOL RESPONSE" in last:
+            return "```json\n" + json.dumps({"action": "Final Answer", "action_input": self.answer()}) + "\n```"
+        if "TOOLS" in last:
+            return "```json\n" + json.dumps({"action": "CognitiveSearch", "action_input": "insurance coverage"}) + "\n```"
+        if last.startswith("Generate search query"):
+            return "insurance coverage"
+        return self.answer()
+
+    async def completion(self, prompt: Any, stream: bool = False, **kwargs: Any) -> Any:
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        text = self.reply(prompt[0] if isinstance(prompt, list) else prompt)
+        if stream:
+            return self.stream(text, lambda word: {"text": word})
+        return OpenAIObject.construct_from({
+            "choices": [{"text": text, "index": 0, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}})
+
+    async def chat_completion(self, messages: list[dict[str, str]], stream: bool = False, **kwargs: Any) -> Any:
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        text = self.chat_reply(messages)
+        if stream:
+            return self.stream(text, lambda word: {"delta": {"content": word}})
+        return OpenAIObject.construct_from({
+            "choices": [{"message": {"role": "assistant", "content": text}, "index": 0, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}})
+
+    async def stream(self, text: str, choice) -> AsyncIterator[OpenAIObject]:
+        for word in text.split(" "):
+            yield OpenAIObject.construct_from({"choices": [{"index": 0, **choice(word + " ")}]})
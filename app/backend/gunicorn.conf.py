@@ -0,0 +1,14 @@
+import multiprocessing
+
+# The app is an ASGI (Quart) application, so gunicorn only manages the worker processes and each
+# worker runs an event loop through uvicorn. A handful of workers can then serve many concurrent
+# requests since waiting on Cognitive Search and OpenAI no longer blocks a worker.
+max_requests = 1000
+max_requests_jitter = 50
+log_file = "-"
+bind = "0.0.0.0"
+
+timeout = 600
+num_cpus = multiprocessing.cpu_count()
+workers = (num_cpus * 2) + 1
+worker_class = "uvicorn.workers.UvicornWorker"
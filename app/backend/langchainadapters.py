@@ -1,6 +1,9 @@
+import time
 from typing import Any, Dict, List, Optional, Union
+from uuid import UUID
 from langchain.callbacks.base import BaseCallbackHandler
 from langchain.schema import AgentAction, AgentFinish, LLMResult
+from tracing import current_trace
 
 def ch(text: Union[str, object]) -> str:
     s = text if isinstance(text, str) else str(text)
@@ -31,7 +34,8 @@ class HtmlCallbackHandler (BaseCallbackHandler):
         self, serialized: Dict[str, Any], inputs: Dict[str, Any], **kwargs: Any
     ) -> None:
         """Print out that we are entering a chain."""
-        class_name = serialized["name"]
+        # Newer LangChain versions identify the chain by its import path instead of a name
+        class_name = serialized.get("name") or serialized.get("id", ["chain"])[-1]
         self.html += f"Entering chain: {ch(class_name)}<br>"
 
     def on_chain_end(self, outputs: Dict[str, Any], **kwargs: Any) -> None:
@@ -86,3 +90,40 @@ class HtmlCallbackHandler (BaseCallbackHandler):
     ) -> None:
         """Run on agent end."""
         self.html += f"<span style='color:{color}'>{ch(finish.log)}</span><br>"
+
+
+class TracingCallbackHandler (BaseCallbackHandler):
+    """Records every LLM call and tool invocation of an agent as a span of the request being traced."""
+
+    # Handlers that don't run inline are called from a thread pool, where the request's trace isn't available
+    run_inline = True
+
+    def __init__(self):
+        self.trace = current_trace.get()
+        self.started: Dict[UUID, tuple[str, float]] = {}
+
+    def start(self, run_id: UUID, step: str):
+        self.started[run_id] = (step, time.monotonic())
+
+    def end(self, run_id: UUID, **attributes: Any):
+        if run_id in self.started and self.trace:
+            step, start = self.started.pop(run_id)
+            self.trace.record(step, start, time.monotonic(), **attributes)
+
+    def on_llm_start(self, serialized: Dict[str, Any], prompts: List[str], *, run_id: UUID, **kwargs: Any) -> None:
+        self.start(run_id, "llm")
+
+    def on_llm_end(self, response: LLMResult, *, run_id: UUID, **kwargs: Any) -> None:
+        self.end(run_id)
+
+    def on_llm_error(self, error: Exception, *, run_id: UUID, **kwargs: Any) -> None:
+        self.end(run_id, error=type(error).__name__)
+
+    def on_tool_start(self, serialized: Dict[str, Any], input_str: str, *, run_id: UUID, **kwargs: Any) -> None:
+        self.start(run_id, f"tool:{serialized.get('name')}")
+
+    def on_tool_end(self, output: str, *, run_id: UUID, **kwargs: Any) -> None:
+        self.end(run_id)
+
+    def on_tool_error(self, error: Exception, *, run_id: UUID, **kwargs: Any) -> None:
+        self.end(run_id, error=type(error).__name__)
@@ -0,0 +1,92 @@
+import argparse
+import asyncio
+import json
+import random
+import statistics
+import time
+import aiohttp
+
+parser = argparse.ArgumentParser(
+    description="Drive multi-turn chat sessions against /chat at a target request rate and report latency percentiles per approach and turn. Every turn sends the whole history so far, with the answers the app gave to the earlier turns.",
+    epilog="Example: loadtest.py --url http://localhost:5000 --rps 5 --duration 120 --turns 8 --approaches rtr rrr --json run.json"
+    )
+parser.add_argument("--url", default="http://localhost:5000", help="Base URL of the app")
+parser.add_argument("--rps", type=float, default=2.0, help="Target requests per second over all sessions")
+parser.add_argument("--duration", type=float, default=60, help="Seconds during which new sessions are started")
+parser.add_argument("--turns", type=int, default=5, help="Most turns in a session")
+parser.add_argument("--min-turns", type=int, help="Fewest turns in a session, by default every session has --turns turns")
+parser.add_argument("--think-time", type=float, default=0.0, help="Seconds a user waits between receiving an answer and asking the next question")
+parser.add_argument("--approaches", nargs="+", default=["rtr"], help="Chat approaches to spread the sessions over")
+parser.add_argument("--overrides", default="{}", help="Overrides sent with every request, as JSON")
+parser.add_argument("--seed", type=int, default=0, help="Seed for the generated sessions")
+parser.add_argument("--json", help="Write every request's approach, turn, status and latency to this file")
+args = parser.parse_args()
+
+# First questions of a session, in the languages customers ask in, and follow-ups that only make sense with the history
+QUESTIONS = ["What does house insurance cover?", "Hva dekker husforsikringen?", "Does my content insurance cover theft from my car?",
+             "Hva koster bilforsikring?", "Is water damage covered by the house insurance?", "What is the deductible for contents insurance?",
+             "Dekker innboforsikringen sykkel?", "What is the difference between kasko and partial kasko?"]
+FOLLOW_UPS = ["What does it cost?", "Hva er egenandelen?", "Does that also apply abroad?", "What is not covered?",
+              "How do I report a claim?", "Kan du forklare det nærmere?", "Is there an upper limit?", "What about my garage?"]
+
+# Used as the answer of a turn that failed, cited so the app keeps it in the history like a real answer
+FAILED_ANSWER = "I could not find that in the terms [Insurance-0.pdf]."
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+async def run_session(session, rng, results):
+    approach = rng.choice(args.approaches)
+    turns = rng.randint(args.min_turns or args.turns, args.turns)
+    overrides = json.loads(args.overrides)
+    history = []
+    for turn in range(1, turns + 1):
+        question = rng.choice(QUESTIONS) if turn == 1 else rng.choice(FOLLOW_UPS)
+        history.append({"user": question})
+        start = time.perf_counter()
+        try:
+            async with session.post(args.url + "/chat", json={"approach": approach, "history": history, "overrides": overrides}) as response:
+                status = response.status
+                body = await response.json(content_type=None) if status == 200 else {}
+        except aiohttp.ClientError:
+            status, body = 0, {}
+        results.append({"approach": approach, "turn": turn, "status": status, "seconds": time.perf_counter() - start})
+        history[-1]["assistant"] = body.get("answer") or FAILED_ANSWER
+        if args.think_time:
+            await asyncio.sleep(args.think_time)
+
+async def main():
+    rng = random.Random(args.seed)
+    results = []
+    # Sessions are started at a fixed rate whatever the latency of the app, so a slow app sees a growing number of
+    # open sessions like it would in production
+    average_turns = ((args.min_turns or args.turns) + args.turns) / 2
+    interval = average_turns / args.rps
+    async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=None)) as session:
+        sessions = []
+        start = time.perf_counter()
+        while time.perf_counter() - start < args.duration:
+            sessions.append(asyncio.create_task(run_session(session, random.Random(rng.random()), results)))
+            await asyncio.sleep(interval)
+        await asyncio.gather(*sessions)
+        elapsed = time.perf_counter() - start
+    return results, elapsed
+
+results, elapsed = asyncio.run(main())
+
+print(f"{len(results)} requests in {elapsed:.1f}s, {len(results) / elapsed:.2f} requests per second")
+print(f"{'approach':<10} {'turn':>5} {'requests':>9} {'errors':>7} {'rejected':>9} {'p50 s':>8} {'p95 s':>8} {'p99 s':>8}")
+for approach in args.approaches:
+    for turn in range(1, args.turns + 1):
+        case = [r for r in results if r["approach"] == approach and r["turn"] == turn]
+        if not case:
+            continue
+        seconds = [r["seconds"] for r in case if r["status"] == 200] or [0.0]
+        errors = len([r for r in case if r["status"] not in (200, 503)])
+        rejected = len([r for r in case if r["status"] == 503])
+        print(f"{approach:<10} {turn:>5} {len(case):>9} {errors:>7} {rejected:>9} {statistics.median(seconds):>8.3f} {percentile(seconds, 95):>8.3f} {percentile(seconds, 99):>8.3f}")
+
+if args.json:
+    with open(args.json, "w") as f:
+        json.dump(results, f, indent=2)
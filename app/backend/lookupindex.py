@@ -0,0 +1,98 @@
+import asyncio
+import logging
+import re
+from typing import Any, Hashable, Optional
+from metrics import Counter, Gauge
+from sections import PREFACE
+from text import nonewlines
+
+lookups_total = Counter("lookup_index_lookups_total", "Lookups of the agents, by whether the local index answered them or they were left to the semantic answers of Cognitive Search", ["result"])
+lookup_index_sentences = Gauge("lookup_index_sentences", "Sentences of the indexed sections in the local lookup index")
+
+def words(text: str) -> list[str]:
+    return re.findall(r"\w+", re.sub(r"<[^>]+>", " ", text).lower())
+
+class LookupIndex:
+    """
+    The sentences of all indexed sections, by the words in them, so the Lookup action of the agents is answered in
+    process instead of with a semantic search. A lookup returns the sentences that contain every word of the term, the
+    ones with the term as a phrase first, then the shortest. Words found in more than max_word_share of the sentences
+    hardly tell them apart and are ignored, unless the term has no other words.
+
+    The index is built from a search for all sections, at most max_sections of them, when the app starts and rebuilt
+    when the index version changes. The sentences are indexed in a worker thread, so requests are served meanwhile.
+    Until then, or when nothing matches, lookups go to Cognitive Search as before.
+    """
+
+    # Lookups return at most this many sentences, cut to this many characters each e.g. for sentences that are tables
+    MAX_SENTENCES = 3
+    MAX_SENTENCE_LENGTH = 400
+
+    def __init__(self, search_client, sourcepage_field: str, content_field: str, max_word_share: float = 0.2, max_sections: int = 10000):
+        self.search_client = search_client
+        self.sourcepage_field = sourcepage_field
+        self.content_field = content_field
+        self.max_word_share = max_word_share
+        self.max_sections = max_sections
+        # Source page, category, sentence and its words
+        self.sentences: list[tuple[str, Optional[str], str, str]] = []
+        self.postings: dict[str, set[int]] = {}
+        self.index_version: Optional[Hashable] = None
+
+    async def build(self, documents: list[dict[str, Any]]):
+        # Replaced at once on the event loop, lookups never see a half built index
+        self.sentences, self.postings = await asyncio.to_thread(self.index_sentences, documents)
+        lookup_index_sentences.set(len(self.sentences))
+
+    def index_sentences(self, documents: list[dict[str, Any]]) -> tuple[list[tuple[str, Optional[str], str, str]], dict[str, set[int]]]:
+        sentences, postings, seen = [], {}, set()
+        for doc in documents:
+            # prepdocs.py starts every section with the same kind of preface, which would match every lookup
+            content = PREFACE.sub("", nonewlines(doc[self.content_field]))
+            for sentence in re.split(r"(?<=[.!?])\s+", content):
+                sentence = sentence.strip()[:self.MAX_SENTENCE_LENGTH]
+                # Sections overlap, so most sentences at their edges are in two of them
+                if not sentence or sentence in seen:
+                    continue
+                seen.add(sentence)
+                sentence_words = words(sentence)
+                for word in set(sentence_words):
+                    postings.setdefault(word, set()).add(len(sentences))
+                sentences.append((doc[self.sourcepage_field], doc.get("category"), sentence, " " + " ".join(sentence_words) + " "))
+        return sentences, postings
+
+    async def load(self):
+        # The results are fetched page by page as they are iterated
+        r = await self.search_client.search("*", select=[self.sourcepage_field, self.content_field, "category"], top=self.max_sections, include_total_count=True)
+        documents = [doc async for doc in r]
+        count = await r.get_count()
+        if count > len(documents):
+            logging.warning(f"Lookup index limited to {len(documents)} of the {count} sections in the search index")
+        await self.build(documents)
+        logging.info(f"Lookup index built with {len(self.sentences)} sentences")
+
+    def lookup(self, term: str, exclude_category: Optional[str] = None) -> list[str]:
+        term_words = list(dict.fromkeys(words(term)))
+        if not term_words or any(word not in self.postings for word in term_words):
+            return []
+        common = len(self.sentences) * self.max_word_share
+        selective = [word for word in term_words if len(self.postings[word]) <= common] or term_words
+        matches = set.intersection(*(self.postings[word] for word in selective))
+
+        phrase = " " + " ".join(term_words) + " "
+        def rank(i: int) -> tuple[bool, int]:
+            return (phrase not in self.sentences[i][3], len(self.sentences[i][2]))
+        results = []
+        for i in sorted(matches, key=rank):
+            sourcepage, category, sentence, _ = self.sentences[i]
+            if exclude_category is None or category != exclude_category:
+                results.append(f"{sourcepage}:{sentence}")
+                if len(results) == self.MAX_SENTENCES:
+                    break
+        return results
+
+    # Called by the IndexVersionWatcher with the current version of the index
+    async def update_index_version(self, version: Hashable):
+        if version != self.index_version:
+            await self.load()
+            self.index_version = version
@@ -0,0 +1,107 @@
+import collections
+import hashlib
+import random
+import re
+from typing import Optional
+from metrics import Counter
+from searchcache import normalize_query
+
+near_duplicate_questions_total = Counter("near_duplicate_questions_total", "Questions matched against recent questions, by whether a recent question was the same, similar or none", ["result"])
+
+# Words that never change what a question asks for
+IGNORED_WORDS = {"the", "a", "an"}
+
+# Words that turn a question around, two questions only match if they have the same ones. The same goes for numbers
+NEGATIONS = {"not", "no", "never", "without", "except", "t", "ikke", "aldri", "ingen", "uten", "unntatt"}
+
+# Mersenne prime larger than any 32 bit word hash, for the MinHash permutations
+PRIME = (1 << 61) - 1
+
+def question_words(question: str) -> frozenset[str]:
+    return frozenset(word for word in re.findall(r"\w+", normalize_query(question)) if word not in IGNORED_WORDS)
+
+def must_match(words: frozenset[str]) -> frozenset[str]:
+    return frozenset(word for word in words if word in NEGATIONS or word.isdigit())
+
+# Jaccard similarity of the words of two texts, 0 if they differ in a negation or number
+def word_similarity(a: str, b: str) -> float:
+    a_words, b_words = question_words(a), question_words(b)
+    if not a_words or not b_words or must_match(a_words) != must_match(b_words):
+        return 0.0
+    return len(a_words & b_words) / len(a_words | b_words)
+
+def word_hash(word: str) -> int:
+    return int.from_bytes(hashlib.blake2b(word.encode("utf-8"), digest_size=4).digest(), "little")
+
+class NearDuplicateIndex:
+    """
+    Recent questions, indexed with MinHash LSH over their words so that a new question can be matched with a recent
+    question that is worded almost the same, e.g. "What does house insurance cover?" and "what does the house insurance
+    cover". Questions whose signatures agree in at least one band are candidates, and a candidate only matches if the
+    Jaccard similarity of the two word sets is at least threshold and both have the same negations and numbers. The
+    matched question is used in place of the new one in cache keys, so paraphrased questions share cached search
+    queries and answers. Only questions that were answered are added, matching a question doesn't add it.
+
+    At most max_entries questions are kept, the least recently matched ones are forgotten first.
+    """
+
+    def __init__(self, threshold: float = 0.8, max_entries: int = 10000, bands: int = 16, rows: int = 4):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.bands = bands
+        self.rows = rows
+        rng = random.Random(0)
+        self.permutations = [(rng.randrange(1, PRIME), rng.randrange(0, PRIME)) for _ in range(bands * rows)]
+        # Question by its word set, and the band keys it was stored under
+        self.questions: collections.OrderedDict[frozenset[str], tuple[str, list[tuple]]] = collections.OrderedDict()
+        self.buckets: dict[tuple, set[frozenset[str]]] = collections.defaultdict(set)
+
+    def band_keys(self, words: frozenset[str]) -> list[tuple]:
+        hashes = [word_hash(word) for word in words]
+        signature = [min((a * h + b) % PRIME for h in hashes) for a, b in self.permutations]
+        return [(band, *signature[band * self.rows:(band + 1) * self.rows]) for band in range(self.bands)]
+
+    # Returns the recent question this one duplicates, if any. The question itself is only remembered by add
+    def match(self, question: str) -> Optional[str]:
+        words = question_words(question)
+        if not words:
+            return None
+        if words in self.questions:
+            near_duplicate_questions_total.inc(result="same")
+            self.questions.move_to_end(words)
+            return self.questions[words][0]
+
+        candidates = set().union(*[self.buckets.get(key, ()) for key in self.band_keys(words)])
+        best, best_similarity = None, self.threshold
+        for candidate in candidates:
+            if must_match(candidate) != must_match(words):
+                continue
+            similarity = len(words & candidate) / len(words | candidate)
+            if similarity >= best_similarity:
+                best, best_similarity = candidate, similarity
+        if best is not None:
+            near_duplicate_questions_total.inc(result="similar")
+            self.questions.move_to_end(best)
+            return self.questions[best][0]
+
+        near_duplicate_questions_total.inc(result="none")
+        return None
+
+    # Remembers a question that was answered, so later questions can match it
+    def add(self, question: str):
+        words = question_words(question)
+        if not words or words in self.questions:
+            return
+        band_keys = self.band_keys(words)
+        self.questions[words] = (question, band_keys)
+        for key in band_keys:
+            self.buckets[key].add(words)
+        while len(self.questions) > self.max_entries:
+            self.forget(next(iter(self.questions)))
+
+    def forget(self, words: frozenset[str]):
+        _, band_keys = self.questions.pop(words)
+        for key in band_keys:
+            self.buckets[key].discard(words)
+            if not self.buckets[key]:
+                del self.buckets[key]
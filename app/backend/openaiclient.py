@@ -0,0 +1,253 @@
+import asyncio
+import collections
+import logging
+import random
+import time
+from typing import Any, Optional
+import openai
+import openai.error
+from deadline import remaining
+from metrics import Counter, Gauge
+
+openai_requests_total = Counter("openai_requests_total", "Requests sent to Azure OpenAI by the completion client, by outcome", ["deployment", "outcome"])
+openai_hedges_total = Counter("openai_hedges_total", "Duplicate requests sent because the first one was slow, by which of the two answered first", ["deployment", "winner"])
+circuit_open = Gauge("openai_circuit_open", "1 while calls to the deployment fail fast because it is unhealthy", ["deployment"])
+
+# The request was fine, sending it again may well succeed
+RETRYABLE_ERRORS = (openai.error.Timeout, openai.error.APIError, openai.error.APIConnectionError,
+                    openai.error.ServiceUnavailableError, openai.error.TryAgain, openai.error.RateLimitError)
+
+class CircuitOpenError(openai.error.OpenAIError):
+    def __init__(self, deployment: str, retry_after: float):
+        super().__init__(f"Azure OpenAI deployment {deployment} is unavailable, retry in {retry_after:.0f}s")
+        self.deployment = deployment
+        self.retry_after = retry_after
+
+class CircuitBreaker:
+    """
+    Opens after failure_threshold calls in a row failed with a server error or timeout, calls then fail right away
+    with CircuitOpenError for reset_timeout seconds. After that a single call is let through as a probe: if it succeeds
+    the breaker closes again, if it fails the breaker stays open for another reset_timeout. Any response from the
+    service, including a rate limit or a rejected request, shows it is up.
+    """
+
+    def __init__(self, deployment: str, failure_threshold: int, reset_timeout: float):
+        self.deployment = deployment
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.probing = False
+        circuit_open.set(0, deployment=deployment)
+
+    def allow(self) -> bool:
+        if self.opened_at is None:
+            return True
+        if self.probing or time.monotonic() - self.opened_at < self.reset_timeout:
+            return False
+        self.probing = True
+        return True
+
+    def retry_after(self) -> float:
+        return max(0, self.opened_at + self.reset_timeout - time.monotonic()) if self.opened_at else 0
+
+    def succeeded(self):
+        if self.opened_at is not None:
+            logging.info(f"Azure OpenAI deployment {self.deployment} is available again")
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        circuit_open.set(0, deployment=self.deployment)
+
+    def failed(self):
+        self.failures += 1
+        if self.probing or (self.opened_at is None and self.failures >= self.failure_threshold):
+            logging.warning(f"Azure OpenAI deployment {self.deployment} failed {self.failures} times in a row, failing fast for {self.reset_timeout}s")
+            self.opened_at = time.monotonic()
+            self.probing = False
+            circuit_open.set(1, deployment=self.deployment)
+
+    # The call was abandoned before it got an answer, so it tells nothing about the deployment
+    def abandoned(self):
+        self.probing = False
+
+class ResilientOpenAI:
+    """
+    Sends completion and chat completion requests for all approaches, retrying the ones that failed for reasons that
+    may go away: timeouts, server and connection errors and rate limits. Retries wait with exponential backoff and full
+    jitter, a rate limited request waits as long as the Retry-After header of the response asks, unless that is longer
+    than max_retry_after. Nothing is retried if the wait would outlast the request's deadline. Each deployment has a
+    CircuitBreaker, so while a deployment is down requests fail right away instead of each waiting through its retries.
+
+    With hedging, a request that is still unanswered after the 95th percentile of recent response times of the deployment
+    (but at least hedge_min_delay) is sent a second time, the first answer is used and the other request is cancelled.
+    Streamed requests are answered once the response starts, so their percentile is tracked separately. Nothing is
+    hedged while the deployment rate limits requests, that would only add to its load.
+
+    completion and chat_completion can stand in for openai.Completion and openai.ChatCompletion, e.g. as the client of
+    a LangChain LLM. The openai functions are looked up on every call, so the fakes and cassettes installed over them
+    are used as well.
+    """
+
+    # Response times kept per deployment, and how many of them are needed before requests are hedged
+    LATENCY_SAMPLES = 200
+    MIN_LATENCY_SAMPLES = 20
+
+    # No hedging for this long after the deployment rate limited a request
+    RATE_LIMIT_COOLDOWN = 10
+
+    def __init__(self, max_retries: int = 3, backoff_base: float = 0.5, backoff_max: float = 8, max_retry_after: float = 30,
+                 hedge: bool = False, hedge_min_delay: float = 1, failure_threshold: int = 5, reset_timeout: float = 30):
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.max_retry_after = max_retry_after
+        self.hedge = hedge
+        self.hedge_min_delay = hedge_min_delay
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.breakers: dict[str, CircuitBreaker] = {}
+        self.latencies: dict[tuple[str, bool], collections.deque[float]] = collections.defaultdict(lambda: collections.deque(maxlen=self.LATENCY_SAMPLES))
+        self.rate_limited_at: dict[str, float] = {}
+        self.completion = ResilientResource(self, "Completion")
+        self.chat_completion = ResilientResource(self, "ChatCompletion")
+
+    def breaker(self, deployment: str) -> CircuitBreaker:
+        if deployment not in self.breakers:
+            self.breakers[deployment] = CircuitBreaker(deployment, self.failure_threshold, self.reset_timeout)
+        return self.breakers[deployment]
+
+    async def acreate(self, resource: str, **kwargs: Any) -> Any:
+        deployment = kwargs.get("engine") or kwargs.get("deployment_id") or ""
+        breaker = self.breaker(deployment)
+        for attempt in range(self.max_retries + 1):
+            if not breaker.allow():
+                openai_requests_total.inc(deployment=deployment, outcome="circuit_open")
+                raise CircuitOpenError(deployment, breaker.retry_after())
+
+            start = time.monotonic()
+            try:
+                result = await self.send(resource, kwargs, deployment)
+            except asyncio.CancelledError:
+                breaker.abandoned()
+                raise
+            except RETRYABLE_ERRORS as e:
+                if isinstance(e, openai.error.RateLimitError):
+                    openai_requests_total.inc(deployment=deployment, outcome="rate_limited")
+                    self.rate_limited_at[deployment] = time.monotonic()
+                    breaker.succeeded()
+                else:
+                    openai_requests_total.inc(deployment=deployment, outcome="error")
+                    breaker.failed()
+                # No point waiting for a retry that can't be answered before the request's deadline
+                wait = self.retry_wait(e, attempt)
+                left = remaining()
+                if attempt == self.max_retries or wait is None or (left is not None and wait >= left):
+                    raise
+                logging.warning(f"Azure OpenAI request to {deployment} failed with {e!r}, retry {attempt + 1} in {wait:.2f}s")
+                await asyncio.sleep(wait)
+            except openai.error.OpenAIError:
+                # Rejected requests fail the same way when sent again
+                openai_requests_total.inc(deployment=deployment, outcome="rejected")
+                breaker.succeeded()
+                raise
+            else:
+                openai_requests_total.inc(deployment=deployment, outcome="success")
+                breaker.succeeded()
+                self.latencies[(deployment, bool(kwargs.get("stream")))].append(time.monotonic() - start)
+                return result
+
+    # Seconds to wait before the next attempt, None if a rate limited request would have to wait too long
+    def retry_wait(self, error: Exception, attempt: int) -> Optional[float]:
+        if isinstance(error, openai.error.RateLimitError):
+            retry_after = parse_retry_after(error)
+            if retry_after is not None:
+                # A little jitter, so the requests that were rate limited together aren't all sent again together
+                return retry_after + random.uniform(0, self.backoff_base) if retry_after <= self.max_retry_after else None
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def hedge_delay(self, deployment: str, stream: bool) -> Optional[float]:
+        latencies = self.latencies[(deployment, stream)]
+        if not self.hedge or len(latencies) < self.MIN_LATENCY_SAMPLES:
+            return None
+        if time.monotonic() - self.rate_limited_at.get(deployment, -self.RATE_LIMIT_COOLDOWN) < self.RATE_LIMIT_COOLDOWN:
+            return None
+        return max(self.hedge_min_delay, sorted(latencies)[int(len(latencies) * 0.95)])
+
+    async def send(self, resource: str, kwargs: dict[str, Any], deployment: str) -> Any:
+        create = getattr(openai, resource).acreate
+        delay = self.hedge_delay(deployment, bool(kwargs.get("stream")))
+        if delay is None:
+            return await create(**kwargs)
+
+        requests, winner = [asyncio.create_task(create(**kwargs))], None
+        try:
+            done, _ = await asyncio.wait(requests, timeout=delay)
+            if not done:
+                requests.append(asyncio.create_task(create(**kwargs)))
+            # The first answer wins, an error only counts once both requests failed
+            pending, error = set(requests), None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for request in done:
+                    if request.exception() is None:
+                        if len(requests) > 1:
+                            openai_hedges_total.inc(deployment=deployment, winner="first" if request is requests[0] else "hedge")
+                        winner = request
+                        return request.result()
+                    error = request.exception()
+            raise error
+        finally:
+            for request in requests:
+                if request is not winner:
+                    request.cancel()
+                    request.add_done_callback(discard)
+
+# Cleans up after a request that lost the race. Errors don't matter, but a streamed response that already started holds
+# on to its connection until its generator is closed
+def discard(request: asyncio.Task):
+    if request.cancelled() or request.exception() is not None:
+        return
+    aclose = getattr(request.result(), "aclose", None)
+    if aclose:
+        # The event loop only keeps weak references to tasks
+        closing = asyncio.create_task(aclose())
+        closing_streams.add(closing)
+        closing.add_done_callback(closing_streams.discard)
+
+closing_streams: set[asyncio.Task] = set()
+
+class ResilientResource:
+    def __init__(self, client: ResilientOpenAI, resource: str):
+        self.client = client
+        self.resource = resource
+
+    async def acreate(self, **kwargs: Any) -> Any:
+        return await self.client.acreate(self.resource, **kwargs)
+
+def langchain_llm(llm_class: type, client: ResilientResource, **kwargs: Any) -> Any:
+    """
+    Creates a LangChain LLM, e.g. AzureOpenAI or AzureChatOpenAI, that sends its requests through client. Retries are
+    left to the client, so LangChain makes a single attempt. LangChain sets its own client while validating the
+    arguments, which is why the client is only replaced afterwards.
+    """
+    llm = llm_class(openai_api_key=openai.api_key, openai_api_base=openai.api_base, openai_api_version=openai.api_version, max_retries=1, **kwargs)
+    llm.client = client
+    return llm
+
+# The token is refreshed in the background, an LLM that is kept around has to be given the current one before it is used
+def use_current_api_key(llm: Any):
+    llm.openai_api_key = openai.api_key
+
+# Azure OpenAI sends retry-after-ms as well as the standard Retry-After in seconds
+def parse_retry_after(error: openai.error.OpenAIError) -> Optional[float]:
+    headers = {name.lower(): value for name, value in (error.headers or {}).items()}
+    try:
+        if "retry-after-ms" in headers:
+            return float(headers["retry-after-ms"]) / 1000
+        if "retry-after" in headers:
+            return float(headers["retry-after"])
+    except ValueError:
+        # Retry-After can also be a date, which Azure OpenAI doesn't send
+        pass
+    return None
@@ -0,0 +1,23 @@
+from typing import Any, Callable, TypeVar
+
+T = TypeVar("T", int, float)
+
+class InvalidOverride(ValueError):
+    """An override sent with the request that can't be used, the app answers the request with 400."""
+
+def positive_override(overrides: dict[str, Any], name: str, default: T, parse: Callable[[Any], T]) -> T:
+    """
+    The override as a positive number parsed with parse, or default when it isn't set. Anything else raises
+    InvalidOverride, instead of failing later in the request.
+    """
+    value = overrides.get(name)
+    if value is None or value == "":
+        return default
+    try:
+        number = parse(value)
+    except (TypeError, ValueError, OverflowError):
+        number = None
+    # bool is an int, but true is hardly meant as 1
+    if isinstance(value, bool) or number is None or not number > 0:
+        raise InvalidOverride(f"{name} must be a positive number")
+    return number
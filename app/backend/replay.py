@@ -0,0 +1,62 @@
+import argparse
+import asyncio
+import json
+import statistics
+import time
+import aiohttp
+from cassette import recorded_requests
+
+parser = argparse.ArgumentParser(
+    description="Send the /ask and /chat requests recorded in a cassette to a running app, with their original spacing, and report the latency per route and approach. Run the app with CASSETTE_MODE=replay to serve the search and OpenAI responses from the same cassette.",
+    epilog="Example: replay.py cassette.jsonl --url http://localhost:5000 --speed 10 --json run.json"
+    )
+parser.add_argument("cassette", help="Cassette recorded with CASSETTE_MODE=record")
+parser.add_argument("--url", default="http://localhost:5000", help="Base URL of the app")
+parser.add_argument("--speed", type=float, default=1.0, help="Send the requests this many times faster than they were recorded, 0 sends all of them at once")
+parser.add_argument("--limit", type=int, help="Only send the first requests of the cassette")
+parser.add_argument("--json", help="Write the latency of every request to this file")
+args = parser.parse_args()
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+async def send(session, recorded):
+    start = time.perf_counter()
+    first_line = None
+    async with session.post(args.url + recorded["route"], json=recorded["request"]) as response:
+        # Streaming routes answer line by line, the first line is the supporting content
+        async for _ in response.content:
+            if first_line is None:
+                first_line = time.perf_counter() - start
+        status = response.status
+    return {
+        "case": f"{recorded['route']}:{recorded['request'].get('approach')}",
+        "status": status,
+        "seconds": time.perf_counter() - start,
+        "first_line_seconds": first_line
+    }
+
+async def main():
+    requests = recorded_requests(args.cassette)[:args.limit]
+    if not requests:
+        return []
+    async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=None)) as session:
+        start, first_at = time.perf_counter(), requests[0]["at"]
+        async def scheduled(recorded):
+            if args.speed > 0:
+                await asyncio.sleep(max(0, (recorded["at"] - first_at) / args.speed - (time.perf_counter() - start)))
+            return await send(session, recorded)
+        return await asyncio.gather(*[scheduled(recorded) for recorded in requests])
+
+results = asyncio.run(main())
+
+print(f"{'case':<24} {'requests':>9} {'errors':>7} {'p50 s':>8} {'p95 s':>8} {'p99 s':>8} {'max s':>8}")
+for case in sorted({r["case"] for r in results}):
+    seconds = [r["seconds"] for r in results if r["case"] == case]
+    errors = len([r for r in results if r["case"] == case and r["status"] != 200])
+    print(f"{case:<24} {len(seconds):>9} {errors:>7} {statistics.median(seconds):>8.3f} {percentile(seconds, 95):>8.3f} {percentile(seconds, 99):>8.3f} {max(seconds):>8.3f}")
+
+if args.json:
+    with open(args.json, "w") as f:
+        json.dump(results, f, indent=2)
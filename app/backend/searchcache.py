@@ -0,0 +1,175 @@
+import asyncio
+import collections
+import json
+import logging
+import re
+import time
+from typing import Any, AsyncIterator, Awaitable, Callable, Hashable, Optional
+from metrics import Counter, Gauge
+
+cache_requests_total = Counter("search_cache_requests_total", "Searches answered from the search result cache or sent to Cognitive Search", ["result"])
+cache_entries = Gauge("search_cache_entries", "Search results currently kept in the cache")
+cache_invalidations_total = Counter("search_cache_invalidations_total", "Times the search result cache was cleared because the index changed")
+
+class SearchResults:
+    """
+    Search results that were already fetched, e.g. from the cache or a cassette, with the same async interface as the
+    results of the async SearchClient.
+    """
+
+    def __init__(self, documents: list[dict[str, Any]], answers: Optional[list] = None, count: Optional[int] = None):
+        self.documents = documents
+        self.answers = answers
+        self.count = count
+
+    async def __aiter__(self) -> AsyncIterator[dict[str, Any]]:
+        for doc in self.documents:
+            yield doc
+
+    async def get_answers(self) -> Optional[list]:
+        return self.answers
+
+    async def get_count(self) -> int:
+        return len(self.documents) if self.count is None else self.count
+
+def normalize_query(q: str) -> str:
+    # The index analyzers ignore case, punctuation and extra whitespace, so these variations give the same results
+    return re.sub(r"\s+", " ", q).strip().rstrip("?!. ").lower()
+
+class TTLCache:
+    """
+    LRU cache of at most max_entries values, each value expires ttl seconds after it was added. The least recently used
+    entries are evicted first once the cache is full.
+    """
+
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries: collections.OrderedDict[Hashable, tuple[float, Any]] = collections.OrderedDict()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        expires_on, value = entry
+        if expires_on < time.monotonic():
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return value
+
+    def put(self, key: Hashable, value: Any):
+        self.entries[key] = (time.monotonic() + self.ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+class CachingSearchClient:
+    """
+    Answers repeated searches from a TTLCache in front of the SearchClient, shared by all approaches. Searches are keyed
+    on the normalized query text and all other search arguments (filter, top, semantic ranker and caption settings...).
+    Concurrent searches for the same key wait for the first one instead of each calling Cognitive Search. The results
+    are materialized before they are cached, including the semantic answers and the total count.
+
+    When it is updated by an IndexVersionWatcher, the cache is cleared as soon as the index version changes, e.g. after
+    prepdocs.py re-indexed the documents.
+    """
+
+    def __init__(self, search_client, max_entries: int, ttl: float):
+        self.search_client = search_client
+        self.cache = TTLCache(max_entries, ttl)
+        self.pending: dict[str, asyncio.Future] = {}
+        self.index_version: Optional[Hashable] = None
+
+    async def search(self, search_text: str, **kwargs: Any) -> SearchResults:
+        key = json.dumps([normalize_query(search_text or ""), kwargs], sort_keys=True, default=str)
+        cached = self.cache.get(key)
+        if cached is None and key in self.pending:
+            # Resolves to None if that search failed, this one is then sent on its own
+            cached = await asyncio.shield(self.pending[key])
+        if cached is not None:
+            cache_requests_total.inc(result="hit")
+            return SearchResults(*cached)
+
+        cache_requests_total.inc(result="miss")
+        pending = self.pending[key] = asyncio.get_running_loop().create_future()
+        version = self.index_version
+        try:
+            r = await self.search_client.search(search_text, **kwargs)
+            cached = ([doc async for doc in r], await r.get_answers(), await r.get_count())
+        finally:
+            if self.pending.get(key) is pending:
+                del self.pending[key]
+            pending.set_result(cached)
+
+        # Results fetched while the index changed may be stale already
+        if version == self.index_version:
+            self.cache.put(key, cached)
+            cache_entries.set(len(self.cache))
+        return SearchResults(*cached)
+
+    def invalidate(self):
+        self.cache.clear()
+        cache_entries.set(0)
+        cache_invalidations_total.inc()
+
+    # Called by the IndexVersionWatcher with the current version of the index
+    async def update_index_version(self, version: Hashable):
+        if self.index_version is not None and version != self.index_version:
+            logging.info(f"Search index changed to version {version}, clearing the search result cache")
+            self.invalidate()
+        self.index_version = version
+
+    async def close(self):
+        await self.search_client.close()
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.search_client, name)
+
+class IndexVersionWatcher:
+    """
+    Checks the version of the search index every interval seconds and passes it to every listener, e.g. the search
+    cache and the lookup index, so they all share one check. Listeners get the version on every check, not only when it
+    changed, so one that failed to catch up with a change tries again next time.
+    """
+
+    def __init__(self, get_version: Callable[[], Awaitable[Hashable]], interval: float):
+        self.get_version = get_version
+        self.interval = interval
+        self.listeners: list[Callable[[Hashable], Awaitable[None]]] = []
+        self.task: Optional[asyncio.Task] = None
+
+    def subscribe(self, listener: Callable[[Hashable], Awaitable[None]]):
+        self.listeners.append(listener)
+
+    def start(self):
+        if self.listeners:
+            self.task = asyncio.create_task(self.watch_loop())
+
+    async def watch_loop(self):
+        while True:
+            try:
+                version = await self.get_version()
+            except Exception as e:
+                logging.warning(f"Failed to check the search index version: {e!r}")
+            else:
+                # Concurrently, so clearing the cache doesn't wait until the lookup index is rebuilt
+                results = await asyncio.gather(*[listener(version) for listener in self.listeners], return_exceptions=True)
+                for result in results:
+                    if isinstance(result, Exception):
+                        logging.warning(f"Failed to update to search index version {version}: {result!r}")
+            await asyncio.sleep(self.interval)
+
+    async def close(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
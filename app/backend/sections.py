@@ -0,0 +1,76 @@
+import re
+from typing import Any
+
+# prepdocs.py starts every section of a file with this, see create_sections_for_file
+PREFACE = re.compile(r"^This sections is about [^.]*\. ")
+
+# Shortest text two sections must share to be treated as overlapping, prepdocs.py overlaps them by about 100 characters
+MIN_OVERLAP = 20
+
+def overlap(a: str, b: str) -> int:
+    # Length of the longest end of a that b starts with
+    head = b[:MIN_OVERLAP]
+    start = a.find(head)
+    while start != -1:
+        if b.startswith(a[start:]):
+            return len(a) - start
+        start = a.find(head, start + 1)
+    return 0
+
+def merge_sections(documents: list[dict[str, Any]], sourcepage_field: str, content_field: str) -> list[dict[str, Any]]:
+    """
+    Removes text the model would otherwise see twice from search results, keeping their ranking order. prepdocs.py
+    splits a file into sections that overlap, so when neighbouring sections of a file are both found, the shared text
+    is only kept once: sections of the same page are merged into one at the rank of the better one, a section of
+    another page loses the shared text so each page can still be cited. The preface prepdocs.py adds to every section
+    is only kept on the first section with that preface. Returns copies, the documents are not changed.
+    """
+    merged: list[dict[str, Any]] = []
+    prefaces = set()
+    for doc in documents:
+        content = doc[content_field]
+        preface = PREFACE.match(content)
+        if preface:
+            content = content[preface.end():]
+        doc = {**doc, content_field: content}
+
+        for kept in merged:
+            if not doc.get("sourcefile") or kept.get("sourcefile") != doc.get("sourcefile"):
+                continue
+            kept_content = kept[content_field]
+            if content in kept_content:
+                doc = None
+                break
+            same_page = kept[sourcepage_field] == doc[sourcepage_field]
+            if kept_content in content and same_page:
+                kept[content_field] = content
+                doc = None
+                break
+            shared = overlap(kept_content, content)
+            if shared:
+                if same_page:
+                    kept[content_field] = kept_content + content[shared:]
+                    doc = None
+                    break
+                content = doc[content_field] = content[shared:]
+                continue
+            shared = overlap(content, kept_content)
+            if shared:
+                if same_page:
+                    kept[content_field] = content + kept_content[shared:]
+                    doc = None
+                    break
+                content = doc[content_field] = content[:-shared]
+
+        if doc is not None and content.strip():
+            merged.append(doc)
+            if preface:
+                doc["_preface"] = preface.group(0)
+
+    # The prefaces are put back once the sections are final, so they don't get in the way of finding overlaps
+    for doc in merged:
+        preface = doc.pop("_preface", None)
+        if preface and preface not in prefaces:
+            prefaces.add(preface)
+            doc[content_field] = preface + doc[content_field]
+    return merged
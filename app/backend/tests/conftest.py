@@ -0,0 +1,38 @@
+import os
+import sys
+import time
+import openai
+import pytest
+
+# The backend modules import each other as top-level modules, like they do when the app is run from app/backend
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fakebackends import FakeOpenAI, FakeSearchClient, make_documents
+from openaiclient import ResilientOpenAI
+
+@pytest.fixture
+def documents():
+    return make_documents(10, 500)
+
+@pytest.fixture
+def search_client(documents):
+    return FakeSearchClient(documents)
+
+@pytest.fixture
+def fake_openai(documents, monkeypatch):
+    # Same settings as the app, the calls never leave the process
+    monkeypatch.setattr(openai, "api_type", "azure_ad")
+    monkeypatch.setattr(openai, "api_base", "https://test.openai.azure.com")
+    monkeypatch.setattr(openai, "api_version", "2023-06-01-preview")
+    monkeypatch.setattr(openai, "api_key", "test")
+    fake = FakeOpenAI(documents[0]["sourcepage"])
+    fake.install()
+    yield fake
+    fake.uninstall()
+
+# A client whose circuit for the deployment the approaches are created with in the tests is open
+@pytest.fixture
+def open_circuit():
+    completions = ResilientOpenAI()
+    completions.breaker("test").opened_at = time.monotonic()
+    return completions
@@ -0,0 +1,66 @@
+import asyncio
+import pytest
+from admission import AdmissionLimiter, Overloaded
+
+def test_requests_over_the_limit_wait_in_order():
+    async def run():
+        limiter = AdmissionLimiter("test", 1, 10, 5)
+        granted, order = await limiter.acquire(), []
+        async def request(i):
+            order.append(i)
+            limiter.release(await limiter.acquire())
+        requests = [asyncio.create_task(request(i)) for i in range(3)]
+        await asyncio.sleep(0)
+        assert len(limiter.waiters) == 3
+        limiter.release(granted)
+        await asyncio.gather(*requests)
+        return order, limiter.running
+
+    order, running = asyncio.run(run())
+    assert order == [0, 1, 2]
+    assert running == 0
+
+def test_full_queue_rejects_right_away():
+    async def run():
+        limiter = AdmissionLimiter("test", 1, 1, 5)
+        await limiter.acquire()
+        waiting = asyncio.create_task(limiter.acquire())
+        await asyncio.sleep(0)
+        with pytest.raises(Overloaded) as e:
+            await limiter.acquire()
+        waiting.cancel()
+        return e.value
+
+    error = asyncio.run(run())
+    assert error.approach == "test"
+    assert error.retry_after >= 1
+
+def test_queue_timeout_rejects():
+    async def run():
+        limiter = AdmissionLimiter("test", 1, 1, 0.01)
+        await limiter.acquire()
+        with pytest.raises(Overloaded):
+            await limiter.acquire()
+        return limiter.waiters
+
+    assert not asyncio.run(run())
+
+def test_slot_of_a_cancelled_waiter_is_not_lost():
+    async def run():
+        limiter = AdmissionLimiter("test", 1, 10, 5)
+        granted = await limiter.acquire()
+        first = asyncio.create_task(limiter.acquire())
+        second = asyncio.create_task(limiter.acquire())
+        await asyncio.sleep(0)
+        # The first waiter is handed the slot, but its client goes away before it runs. Depending on the Python
+        # version it either still gets the slot or passes it on
+        limiter.release(granted)
+        first.cancel()
+        try:
+            limiter.release(await first)
+        except asyncio.CancelledError:
+            pass
+        limiter.release(await second)
+        return limiter.running
+
+    assert asyncio.run(run()) == 0
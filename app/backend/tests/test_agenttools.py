@@ -0,0 +1,95 @@
+import asyncio
+import pytest
+
+from langchain.agents import AgentExecutor, ZeroShotAgent
+from langchain.chains import LLMChain
+from langchain.llms.fake import FakeListLLM
+from agenttools import NO_ANSWER, AgentStalled, ToolMemo
+
+class Search:
+    def __init__(self, observations=None):
+        self.observations = observations or {}
+        self.calls = []
+
+    async def __call__(self, q):
+        self.calls.append(q)
+        return self.observations.get(q, f"Results for {q}")
+
+def test_similar_inputs_are_answered_from_the_memo():
+    async def run():
+        memo, search = ToolMemo(max_stalls=5), Search()
+        first = await memo.call("Search", "car insurance coverage", search)
+        again = await memo.call("Search", "Car insurance coverage?", search)
+        other = await memo.call("Search", "boat insurance coverage", search)
+        return memo, search, first, again, other
+
+    memo, search, first, again, other = asyncio.run(run())
+    assert search.calls == ["car insurance coverage", "boat insurance coverage"]
+    assert again == first
+    assert other == "Results for boat insurance coverage"
+    assert (memo.tool_calls, memo.stalls) == (3, 1)
+
+def test_inputs_are_memoized_per_tool():
+    async def run():
+        memo, search, lookup = ToolMemo(), Search(), Search({"deductible": "The deductible is 4000 NOK."})
+        await memo.call("Search", "deductible", search)
+        await memo.call("Lookup", "deductible", lookup)
+        return memo, search, lookup
+
+    memo, search, lookup = asyncio.run(run())
+    assert search.calls == lookup.calls == ["deductible"]
+    assert memo.stalls == 0
+
+def test_known_observations_make_no_progress():
+    async def run():
+        memo = ToolMemo(max_stalls=2)
+        search = Search({"water damage": "Covered", "flooding": "Covered", "leaks": "Covered"})
+        await memo.call("Search", "water damage", search)
+        await memo.call("Search", "flooding", search)
+        await memo.call("Search", "leaks", search)
+
+    with pytest.raises(AgentStalled):
+        asyncio.run(run())
+
+def create_executor(memo, responses, search):
+    tools = [memo.tool("Search", "Searches the documents", search)]
+    llm = FakeListLLM(responses=responses)
+    prompt = ZeroShotAgent.create_prompt(tools, input_variables=["input", "agent_scratchpad"])
+    agent = ZeroShotAgent(llm_chain=LLMChain(llm=llm, prompt=prompt), allowed_tools=["Search"])
+    return AgentExecutor.from_agent_and_tools(agent=agent, tools=tools, max_iterations=10)
+
+SEARCH = " I need to search\nAction: Search\nAction Input: {}"
+
+def test_stalled_agent_is_asked_for_its_answer():
+    async def run():
+        memo, search = ToolMemo(max_stalls=2), Search()
+        responses = [SEARCH.format("water damage"), SEARCH.format("Water damage?"), SEARCH.format("water damage"),
+                     " I now know the final answer\nFinal Answer: Water damage is covered."]
+        answer = await memo.run(create_executor(memo, responses, search), "Is water damage covered?")
+        return memo, search, answer
+
+    memo, search, answer = asyncio.run(run())
+    assert answer == "Water damage is covered."
+    assert search.calls == ["water damage"]
+    assert memo.iterations == 3
+    # The call that stopped the agent never returned
+    assert [observation for _, observation in memo.steps] == ["Results for water damage"] * 2
+
+def test_answer_of_a_stalled_agent_without_the_agents_format():
+    async def run():
+        memo = ToolMemo(max_stalls=1)
+        responses = [SEARCH.format("water damage"), SEARCH.format("water damage"), " "]
+        return await memo.run(create_executor(memo, responses, Search()), "Is water damage covered?")
+
+    assert asyncio.run(run()) == NO_ANSWER
+
+def test_agent_that_finishes_is_not_stopped():
+    async def run():
+        memo, search = ToolMemo(), Search()
+        responses = [SEARCH.format("water damage"), " I now know the final answer\nFinal Answer: Yes."]
+        answer = await memo.run(create_executor(memo, responses, search), "Is water damage covered?")
+        return memo, answer
+
+    memo, answer = asyncio.run(run())
+    assert answer == "Yes."
+    assert (memo.iterations, memo.tool_calls, memo.stalls) == (2, 1, 0)
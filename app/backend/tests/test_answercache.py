@@ -0,0 +1,82 @@
+import asyncio
+import os
+import threading
+import pytest
+import answercache
+from answercache import AnswerCache, DiskAnswerStore, MemoryAnswerStore, create_answer_store
+
+def test_memory_store():
+    async def run():
+        store = MemoryAnswerStore(10, 60)
+        assert await store.get("key") is None
+        await store.put("key", "answer")
+        assert await store.get("key") == "answer"
+    asyncio.run(run())
+
+def test_disk_store_is_shared(tmp_path):
+    async def run():
+        await DiskAnswerStore(str(tmp_path), 10, 60).put("key", "svar på spørsmålet")
+        assert await DiskAnswerStore(str(tmp_path), 10, 60).get("key") == "svar på spørsmålet"
+        assert await DiskAnswerStore(str(tmp_path), 10, 60).get("other") is None
+    asyncio.run(run())
+
+def test_disk_store_expires_answers(tmp_path, monkeypatch):
+    store = DiskAnswerStore(str(tmp_path), 10, 60)
+    asyncio.run(store.put("key", "answer"))
+    now = answercache.time.time()
+    monkeypatch.setattr(answercache.time, "time", lambda: now + 61)
+    assert asyncio.run(store.get("key")) is None
+
+def test_disk_store_ignores_broken_files(tmp_path):
+    store = DiskAnswerStore(str(tmp_path), 10, 60)
+    (tmp_path / "key.json").write_text("{not json")
+    assert asyncio.run(store.get("key")) is None
+
+def test_disk_store_evicts_least_recently_used(tmp_path, monkeypatch):
+    monkeypatch.setattr(DiskAnswerStore, "EVICT_EVERY", 3)
+    store = DiskAnswerStore(str(tmp_path), 2, 60)
+    async def run():
+        for i, key in enumerate(["a", "b"]):
+            await store.put(key, key)
+            os.utime(tmp_path / f"{key}.json", (i, i))
+        # Reading "a" makes "b" the least recently used
+        assert await store.get("a") == "a"
+        await store.put("c", "c")
+    asyncio.run(run())
+    assert sorted(os.listdir(tmp_path)) == ["a.json", "c.json"]
+
+def test_disk_store_reads_and_writes_off_the_event_loop(tmp_path, monkeypatch):
+    threads = []
+    monkeypatch.setattr(answercache.json, "load", lambda f, load=answercache.json.load: threads.append(threading.current_thread()) or load(f))
+    monkeypatch.setattr(answercache.json, "dump", lambda *args, dump=answercache.json.dump, **kwargs: threads.append(threading.current_thread()) or dump(*args, **kwargs))
+    store = DiskAnswerStore(str(tmp_path), 10, 60)
+    async def run():
+        await store.put("key", "answer")
+        return await store.get("key")
+    assert asyncio.run(run()) == "answer"
+    assert len(threads) == 2 and threading.main_thread() not in threads
+
+def test_answer_cache_key():
+    cache = AnswerCache(MemoryAnswerStore(10, 60), "ask:rtr")
+    key = cache.key("What is covered?", ["a.pdf: x", "b.pdf: y"], "template", "davinci", 0.3)
+    assert cache.key("what is covered", ["b.pdf: y", "a.pdf: x"], "template", "davinci", 0.3) == key
+    assert cache.key("What is covered?", ["a.pdf: x", "b.pdf: changed"], "template", "davinci", 0.3) != key
+    assert cache.key("What is covered?", ["a.pdf: x", "b.pdf: y"], "other template", "davinci", 0.3) != key
+    assert cache.key("What is covered?", ["a.pdf: x", "b.pdf: y"], "template", "gpt-35", 0.3) != key
+    assert cache.key("What is covered?", ["a.pdf: x", "b.pdf: y"], "template", "davinci", 0.7) != key
+
+def test_answer_cache():
+    async def run():
+        cache = AnswerCache(MemoryAnswerStore(10, 60), "ask:rtr")
+        key = cache.key("q", ["source"], "template", "davinci", 0.3)
+        assert await cache.get(key) is None
+        await cache.put(key, "answer")
+        assert await cache.get(key) == "answer"
+    asyncio.run(run())
+
+def test_create_answer_store(tmp_path):
+    assert isinstance(create_answer_store("memory", str(tmp_path), 10, 60), MemoryAnswerStore)
+    assert isinstance(create_answer_store("disk", str(tmp_path), 10, 60), DiskAnswerStore)
+    assert create_answer_store("none", str(tmp_path), 10, 60) is None
+    with pytest.raises(ValueError):
+        create_answer_store("redis", str(tmp_path), 10, 60)
@@ -0,0 +1,32 @@
+import asyncio
+import pytest
+import app as backend
+
+class Approaches:
+    async def get(self, key):
+        return object()
+
+@pytest.fixture
+def client(monkeypatch):
+    # Only what the routes use before they call the approach, the app isn't started
+    monkeypatch.setitem(backend.app.config, backend.CONFIG_ASK_APPROACHES, Approaches())
+    monkeypatch.setitem(backend.app.config, backend.CONFIG_CHAT_APPROACHES, Approaches())
+    monkeypatch.setitem(backend.app.config, backend.CONFIG_OPENAI_SESSION, None)
+    monkeypatch.setitem(backend.app.config, backend.CONFIG_CASSETTE_RECORDER, None)
+    return backend.app.test_client()
+
+@pytest.mark.parametrize("route", ["/ask", "/chat", "/ask_stream", "/chat_stream"])
+@pytest.mark.parametrize("deadline_seconds", ["soon", 0, -5])
+def test_invalid_deadline_is_a_bad_request(client, route, deadline_seconds):
+    async def run():
+        r = await client.post(route, json={"approach": "rtr", "question": "q", "history": [], "overrides": {"deadline_seconds": deadline_seconds}})
+        return r.status_code, await r.get_json()
+    assert asyncio.run(run()) == (400, {"error": "deadline_seconds must be a positive number"})
+
+@pytest.mark.parametrize("route", ["/ask", "/ask_stream"])
+@pytest.mark.parametrize("name", ["prompt_token_budget", "observation_token_budget"])
+def test_invalid_budget_is_a_bad_request(client, route, name):
+    async def run():
+        r = await client.post(route, json={"approach": "rtr", "question": "q", "overrides": {name: "lots"}})
+        return r.status_code, await r.get_json()
+    assert asyncio.run(run()) == (400, {"error": f"{name} must be a positive number"})
@@ -0,0 +1,29 @@
+import asyncio
+import threading
+from approaches.approach import LazyApproaches
+from approaches.retrievethenread import RetrieveThenReadApproach
+
+def create_approaches(search_client):
+    return LazyApproaches({"rtr": "approaches.retrievethenread:RetrieveThenReadApproach"}, search_client, "test", "sourcepage", "content")
+
+def test_approaches_are_created_once_outside_the_event_loop(search_client, monkeypatch):
+    threads = []
+    monkeypatch.setattr(RetrieveThenReadApproach, "warmup", lambda self: threads.append(threading.current_thread()))
+    approaches = create_approaches(search_client)
+    async def run():
+        return await asyncio.gather(approaches.get("rtr"), approaches.get("rtr"), approaches.get("rtr"))
+
+    first, *others = asyncio.run(run())
+    assert isinstance(first, RetrieveThenReadApproach)
+    assert all(other is first for other in others)
+    assert first.search_client is search_client
+    assert threads and threads[0] is not threading.main_thread()
+    assert len(threads) == 1
+
+def test_unknown_approach(search_client):
+    assert asyncio.run(create_approaches(search_client).get("rrr")) is None
+
+def test_load_all(search_client):
+    approaches = create_approaches(search_client)
+    asyncio.run(approaches.load_all())
+    assert list(approaches.instances) == ["rtr"]
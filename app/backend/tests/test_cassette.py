@@ -0,0 +1,55 @@
+import asyncio
+import openai
+import openai.error
+import pytest
+from approaches.chatretrievethenread import ChatRetrieveThenReadApproach
+from approaches.retrievethenread import RetrieveThenReadApproach
+from cassette import Cassette, CassettePlayer, CassetteRecorder, recorded_requests
+
+QUESTION = "Does my house insurance cover water damage?"
+
+async def ask_and_chat(search_client):
+    ask = await RetrieveThenReadApproach(search_client, "test", "sourcepage", "content").run(QUESTION, {"top": 3})
+    chat = [event async for event in ChatRetrieveThenReadApproach(search_client, "test", "sourcepage", "content").run_stream([{"user": QUESTION}], {"top": 3})]
+    return ask, chat
+
+def test_replay_answers_like_the_recording(tmp_path, search_client, fake_openai):
+    cassette = Cassette(str(tmp_path / "cassette.jsonl"))
+    recorder = CassetteRecorder(cassette)
+    recorder.install()
+    recorder.record_request("/ask", {"question": QUESTION})
+    recorded = asyncio.run(ask_and_chat(recorder.wrap_search_client(search_client)))
+    recorder.uninstall()
+    calls, searches = fake_openai.calls, search_client.calls
+
+    player = CassettePlayer(cassette, speed=0, strict=True)
+    player.install()
+    try:
+        replayed = asyncio.run(ask_and_chat(player.search_client()))
+    finally:
+        player.uninstall()
+    assert replayed == recorded
+    assert (fake_openai.calls, search_client.calls) == (calls, searches)
+    assert recorded_requests(cassette.path)[0]["request"] == {"question": QUESTION}
+
+def test_errors_are_replayed(tmp_path, monkeypatch):
+    async def rate_limited(**kwargs):
+        raise openai.error.RateLimitError("slow down")
+    monkeypatch.setattr(openai.Completion, "acreate", rate_limited)
+    cassette = Cassette(str(tmp_path / "cassette.jsonl"))
+    recorder = CassetteRecorder(cassette)
+    recorder.install()
+    with pytest.raises(openai.error.RateLimitError):
+        asyncio.run(openai.Completion.acreate(engine="test", prompt="q", api_key="secret"))
+    recorder.uninstall()
+
+    player = CassettePlayer(cassette, speed=0, strict=True)
+    player.install()
+    try:
+        # The API key isn't part of the recorded request
+        with pytest.raises(openai.error.RateLimitError):
+            asyncio.run(openai.Completion.acreate(engine="test", prompt="q", api_key="other"))
+        with pytest.raises(LookupError):
+            asyncio.run(openai.Completion.acreate(engine="test", prompt="other"))
+    finally:
+        player.uninstall()
@@ -0,0 +1,35 @@
+import asyncio
+import openai
+import pytest
+from approaches.chatreadretrieveread import ChatReadRetrieveReadApproach
+from openaiclient import CircuitOpenError
+
+QUESTION = "Does my house insurance cover water damage?"
+
+def create_approach(search_client, **options):
+    return ChatReadRetrieveReadApproach(search_client, "test", "sourcepage", "content", **options)
+
+def test_open_circuit_fails_fast(search_client, fake_openai, open_circuit):
+    with pytest.raises(CircuitOpenError):
+        asyncio.run(create_approach(search_client, completions=open_circuit).run([{"user": QUESTION}], {}))
+    assert fake_openai.calls == 0
+
+def test_answer(search_client, fake_openai):
+    r = asyncio.run(create_approach(search_client).run([{"user": QUESTION}], {"top": 3}))
+    assert r["answer"] == fake_openai.answer()
+    assert len(r["data_points"]) == 3
+
+def test_concurrent_requests_keep_their_own_sources(search_client, fake_openai):
+    search_client.latency = 0.01
+    approach = create_approach(search_client)
+    async def run():
+        return await asyncio.gather(approach.run([{"user": QUESTION}], {"top": 2}), approach.run([{"user": QUESTION}], {"top": 4}))
+    two, four = asyncio.run(run())
+    assert [len(two["data_points"]), len(four["data_points"])] == [2, 4]
+
+def test_agent_is_built_once(search_client, fake_openai, monkeypatch):
+    approach = create_approach(search_client)
+    agent = approach.get_agent()
+    monkeypatch.setattr(openai, "api_key", "refreshed")
+    assert approach.get_agent() is agent
+    assert agent.llm_chain.llm.openai_api_key == "refreshed"
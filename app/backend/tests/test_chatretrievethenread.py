@@ -0,0 +1,119 @@
+import asyncio
+import pytest
+from approaches.chatretrievethenread import ChatRetrieveThenReadApproach
+from nearduplicates import NearDuplicateIndex
+from openaiclient import CircuitOpenError
+from searchcache import SearchResults, TTLCache
+
+QUESTION = "Does my house insurance cover water damage?"
+
+def create_approach(search_client, **options):
+    return ChatRetrieveThenReadApproach(search_client, "test", "sourcepage", "content", **options)
+
+async def stream(approach, history, overrides):
+    return [event async for event in approach.run_stream(history, overrides)]
+
+def test_answer(search_client, fake_openai):
+    r = asyncio.run(create_approach(search_client).run([{"user": QUESTION}], {"top": 3}))
+    assert r["answer"] == fake_openai.answer()
+    assert "insurance coverage" in r["thoughts"]
+
+def test_streamed_answer(search_client, fake_openai):
+    events = asyncio.run(stream(create_approach(search_client), [{"user": QUESTION}], {"top": 3}))
+    assert events[0]["data_points"]
+    assert "".join(event["delta"] for event in events[1:-1]).strip() == fake_openai.answer()
+    # The checked answer replaces the streamed text
+    assert events[-1]["answer"].strip() == fake_openai.answer()
+
+def test_generated_query_is_memoized(search_client, fake_openai):
+    approach = create_approach(search_client, query_cache=TTLCache(10, 60))
+    asyncio.run(approach.run([{"user": QUESTION}], {}))
+    assert fake_openai.calls == 2
+    asyncio.run(approach.run([{"user": QUESTION.lower()}], {}))
+    assert fake_openai.calls == 3
+    # The same question after another chat needs its own query
+    asyncio.run(approach.run([{"user": "Is fire damage covered?", "assistant": "Yes [Insurance-0.pdf]"}, {"user": QUESTION}], {}))
+    assert fake_openai.calls == 5
+
+def test_only_answered_first_questions_are_remembered(search_client, fake_openai):
+    near_duplicates = NearDuplicateIndex()
+    approach = create_approach(search_client, near_duplicates=near_duplicates)
+    asyncio.run(approach.run([{"user": QUESTION, "assistant": "Yes [Insurance-0.pdf]"}, {"user": "What about the deductible?"}], {}))
+    assert not near_duplicates.questions
+    asyncio.run(approach.run([{"user": QUESTION}], {}))
+    assert near_duplicates.match(QUESTION) == QUESTION
+
+def test_paraphrased_first_question_shares_the_query(search_client, fake_openai):
+    approach = create_approach(search_client, query_cache=TTLCache(10, 60), near_duplicates=NearDuplicateIndex())
+    asyncio.run(approach.run([{"user": "What does house insurance cover?"}], {}))
+    asyncio.run(approach.run([{"user": "what does the house insurance cover"}], {}))
+    assert fake_openai.calls == 3
+
+def test_speculative_search_for_the_question_is_used(search_client, fake_openai):
+    # The fake generates "insurance coverage" as the query
+    r = asyncio.run(create_approach(search_client, speculative_search=True).run([{"user": "Insurance coverage?"}], {"top": 3}))
+    assert search_client.calls == 1
+    assert r["answer"] == fake_openai.answer()
+
+def test_speculative_search_for_another_query_is_not_used(search_client, fake_openai):
+    asyncio.run(create_approach(search_client, speculative_search=True).run([{"user": QUESTION}], {"top": 3}))
+    assert search_client.calls == 2
+
+def test_speculative_search_for_the_cached_query(search_client, fake_openai):
+    approach = create_approach(search_client, speculative_search=True, query_cache=TTLCache(10, 60))
+    asyncio.run(approach.run([{"user": QUESTION}], {"top": 3}))
+    # A follow-up with the same question guesses the query of the first question as well, and its results are used
+    asyncio.run(approach.run([{"user": "Is fire damage covered?", "assistant": "Yes [Insurance-0.pdf]"}, {"user": QUESTION}], {"top": 3}))
+    assert search_client.calls == 4
+
+@pytest.mark.parametrize("speculative_search", [False, True])
+def test_open_circuit_fails_fast(search_client, fake_openai, open_circuit, speculative_search):
+    approach = create_approach(search_client, completions=open_circuit, speculative_search=speculative_search)
+    with pytest.raises(CircuitOpenError):
+        asyncio.run(approach.run([{"user": QUESTION}], {}))
+    with pytest.raises(CircuitOpenError):
+        asyncio.run(stream(approach, [{"user": QUESTION}], {}))
+    assert fake_openai.calls == 0
+
+class RankedSearchClient:
+    """Returns the documents in the order given for the query and ranking of the search."""
+
+    def __init__(self, rankings):
+        self.rankings = rankings
+
+    async def search(self, search_text, **kwargs):
+        ranking = "semantic" if kwargs.get("query_type") else "keyword"
+        return SearchResults([dict(doc) for doc in self.rankings.get((search_text, ranking), [])])
+
+def doc(id, score, captions=()):
+    return {"id": id, "sourcepage": f"{id}.pdf", "content": id, "@search.score": score, "@search.captions": list(captions)}
+
+def test_query_variants_are_fused_by_reciprocal_rank():
+    search_client = RankedSearchClient({
+        ("insurance water damage", "semantic"): [doc("a", 3.0, ["caption"]), doc("b", 2.5, ["caption"]), doc("c", 2.0, ["caption"])],
+        (QUESTION, "semantic"): [doc("b", 2.8, ["caption"]), doc("d", 2.0, ["caption"])],
+        ("insurance water damage", "keyword"): [doc("b", 9.0), doc("e", 8.0), doc("a", 7.0)],
+    })
+    approach = create_approach(search_client)
+    fused = asyncio.run(approach.search_query_variants("insurance water damage", QUESTION, 3, None, True, {"semantic_ranker": True}))
+    assert [d["id"] for d in fused] == ["b", "a", "d"]
+    # Found by several searches, the highest score and the captions of the semantic search are kept
+    assert fused[0]["@search.score"] == 9.0
+    assert fused[0]["@search.captions"] == ["caption"]
+
+def test_question_is_not_searched_twice():
+    searches = []
+    class RecordingSearchClient:
+        async def search(self, search_text, **kwargs):
+            searches.append((search_text, bool(kwargs.get("query_type"))))
+            return SearchResults([doc("a", 3.0)])
+
+    approach = create_approach(RecordingSearchClient())
+    asyncio.run(approach.search_query_variants("Water damage?", "water damage", 3, None, False, {}))
+    assert searches == [("Water damage?", False)]
+
+def test_multi_query_answer(search_client, fake_openai):
+    r = asyncio.run(create_approach(search_client, multi_query_search=True).run([{"user": QUESTION}], {"top": 3}))
+    assert r["answer"] == fake_openai.answer()
+    # The generated query and the question
+    assert search_client.calls == 2
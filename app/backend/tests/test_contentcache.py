@@ -0,0 +1,80 @@
+import asyncio
+import os
+from contentcache import ContentCache
+
+async def store(cache, name, data, chunk_size=3):
+    writer = cache.writer(name, "etag-" + name, "application/pdf", len(data))
+    for i in range(0, len(data), chunk_size):
+        await writer.write(data[i:i + chunk_size])
+    await writer.commit()
+
+async def read_all(cache, entry, start=0, length=None):
+    return b"".join([chunk async for chunk in cache.read(entry, start, entry.size if length is None else length)])
+
+def test_round_trip(tmp_path):
+    async def run():
+        cache = ContentCache(str(tmp_path), 1000)
+        assert await cache.get("a.pdf") is None
+        await store(cache, "a.pdf", b"0123456789")
+        entry = await cache.get("a.pdf")
+        return entry, await read_all(cache, entry), await read_all(cache, entry, 2, 5)
+
+    entry, data, part = asyncio.run(run())
+    assert (entry.etag, entry.content_type, entry.size) == ("etag-a.pdf", "application/pdf", 10)
+    assert data == b"0123456789"
+    assert part == b"23456"
+
+def test_empty_blob(tmp_path):
+    async def run():
+        cache = ContentCache(str(tmp_path), 1000)
+        await store(cache, "empty.pdf", b"")
+        entry = await cache.get("empty.pdf")
+        return entry.size, await read_all(cache, entry)
+
+    assert asyncio.run(run()) == (0, b"")
+
+def test_incomplete_downloads_are_thrown_away(tmp_path):
+    async def run():
+        cache = ContentCache(str(tmp_path), 1000)
+        writer = cache.writer("a.pdf", "etag", "application/pdf", 10)
+        await writer.write(b"01234")
+        await writer.commit()
+        aborted = cache.writer("b.pdf", "etag", "application/pdf", 10)
+        await aborted.write(b"01234")
+        await aborted.abort()
+        return await cache.get("a.pdf"), await cache.get("b.pdf")
+
+    assert asyncio.run(run()) == (None, None)
+    assert os.listdir(tmp_path) == []
+
+def test_blobs_larger_than_the_cache_are_not_written(tmp_path):
+    assert ContentCache(str(tmp_path), 10).writer("a.pdf", "etag", "application/pdf", 11) is None
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    async def run():
+        cache = ContentCache(str(tmp_path), 25)
+        await store(cache, "a.pdf", b"a" * 10)
+        await store(cache, "b.pdf", b"b" * 10)
+        for i, name in enumerate(["a.pdf", "b.pdf"]):
+            os.utime(cache._base_path(name) + ".data", (i, i))
+        # Reading "a.pdf" makes "b.pdf" the least recently used
+        await cache.get("a.pdf")
+        await store(cache, "c.pdf", b"c" * 10)
+        return [await cache.get(name) is not None for name in ["a.pdf", "b.pdf", "c.pdf"]]
+
+    assert asyncio.run(run()) == [True, False, True]
+
+def test_revalidated_and_remove(tmp_path):
+    async def run():
+        cache = ContentCache(str(tmp_path), 1000)
+        await store(cache, "a.pdf", b"data")
+        entry = await cache.get("a.pdf")
+        entry.validated_on = 0
+        await cache.revalidated("a.pdf", entry)
+        validated_on = (await cache.get("a.pdf")).validated_on
+        await cache.remove("a.pdf")
+        return validated_on, await cache.get("a.pdf")
+
+    validated_on, removed = asyncio.run(run())
+    assert validated_on > 0
+    assert removed is None
@@ -0,0 +1,87 @@
+import asyncio
+import pytest
+import contextpacker
+from overrides import InvalidOverride
+from contextpacker import CHARS_PER_TOKEN, MIN_SOURCE_TOKENS, budget_override, count_tokens, load_encoding, pack_history, pack_sources
+
+class WordEncoding:
+    """One token per word, so the tests don't need to download the tokenizer."""
+
+    def encode(self, text, disallowed_special=()):
+        return text.split(" ")
+
+    def decode(self, tokens):
+        return " ".join(tokens)
+
+@pytest.fixture
+def encoding(monkeypatch):
+    monkeypatch.setattr(contextpacker, "_encoding", WordEncoding())
+    count_tokens.cache_clear()
+    yield
+    count_tokens.cache_clear()
+
+def words(count, word="word"):
+    return " ".join([word] * count)
+
+def test_estimates_until_the_encoding_is_loaded(monkeypatch):
+    monkeypatch.setattr(contextpacker, "_encoding", None)
+    count_tokens.cache_clear()
+    assert count_tokens("x" * (10 * CHARS_PER_TOKEN + 1)) == 11
+
+def test_sources_fill_the_budget(encoding):
+    packed = pack_sources([words(100, "a"), words(100, "b"), words(100, "c")], 250)
+    assert [count_tokens(source) for source in packed.sources] == [100, 100, 50]
+    assert (packed.tokens, packed.dropped, packed.truncated) == (250, 0, 1)
+
+def test_short_remainders_are_dropped(encoding):
+    packed = pack_sources([words(100, "a"), words(100, "b"), words(10, "c")], 100 + MIN_SOURCE_TOKENS - 1)
+    # Sources after a dropped one are dropped as well, even if they would fit
+    assert packed.sources == [words(100, "a")]
+    assert (packed.dropped, packed.truncated) == (2, 0)
+
+def test_sources_are_cut_to_their_share(encoding):
+    packed = pack_sources([words(100, "a"), words(10, "b")], 1000, max_tokens_per_source=60)
+    assert [count_tokens(source) for source in packed.sources] == [60, 10]
+    packed = pack_sources([words(100, "a")], 1000, max_tokens_per_source=10)
+    assert count_tokens(packed.sources[0]) == MIN_SOURCE_TOKENS
+
+def test_the_top_source_is_kept_when_the_budget_is_used_up(encoding, caplog):
+    packed = pack_sources([words(100, "a"), words(100, "b")], -20)
+    assert packed.sources == [words(MIN_SOURCE_TOKENS, "a")]
+    assert (packed.dropped, packed.truncated) == (1, 1)
+    assert "leaves no room for sources" in caplog.text
+    assert pack_sources([], -20).sources == []
+
+def test_history_keeps_the_latest_turns(encoding):
+    history = [{"user": words(40)}, {"user": words(40)}, {"user": words(40)}]
+    kept, tokens = pack_history(history, 100, lambda turn: turn["user"])
+    assert kept == history[1:]
+    assert tokens == 80
+    # The current question is always kept
+    kept, _ = pack_history(history, 10, lambda turn: turn["user"])
+    assert kept == history[2:]
+
+def test_load_encoding_retries(monkeypatch):
+    attempts = []
+    def get_encoding(name):
+        attempts.append(name)
+        if len(attempts) < 3:
+            raise ConnectionError("offline")
+        return WordEncoding()
+    monkeypatch.setattr(contextpacker, "tiktoken", type("tiktoken", (), {"get_encoding": staticmethod(get_encoding)}))
+    monkeypatch.setattr(contextpacker, "_encoding", None)
+    count_tokens.cache_clear()
+    # Counted with the estimate while the encoding isn't loaded, the count must not be kept after loading
+    assert count_tokens(words(10)) == 13
+
+    asyncio.run(load_encoding(retry_delay=0.001))
+    assert len(attempts) == 3
+    assert count_tokens(words(10)) == 10
+    count_tokens.cache_clear()
+
+def test_budget_override():
+    assert budget_override({}, 3000) == 3000
+    assert budget_override({"prompt_token_budget": "500"}, 3000) == 500
+    assert budget_override({"observation_token_budget": 100}, 300, "observation_token_budget") == 100
+    with pytest.raises(InvalidOverride):
+        budget_override({"prompt_token_budget": "lots"}, 3000)
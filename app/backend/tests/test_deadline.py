@@ -0,0 +1,55 @@
+import asyncio
+import time
+import pytest
+from deadline import deadline, expired, iterate_within_deadline, remaining, step_timeout, within_deadline
+
+def test_step_timeout():
+    assert step_timeout(4) == 4
+    assert step_timeout() is None
+    with deadline(time.monotonic() + 2):
+        assert 1.9 < step_timeout(4) <= 2
+        assert step_timeout(1) == 1
+        assert not expired()
+    with deadline(time.monotonic() - 1):
+        assert remaining() == 0
+        assert expired()
+    assert remaining() is None
+
+def test_within_deadline():
+    async def run():
+        with deadline(time.monotonic() + 0.05):
+            assert await within_deadline(asyncio.sleep(0, "done"), "step") == "done"
+            with pytest.raises(asyncio.TimeoutError):
+                await within_deadline(asyncio.sleep(1), "step", 4)
+        with pytest.raises(asyncio.TimeoutError):
+            await within_deadline(asyncio.sleep(1), "step", 0.01)
+
+    asyncio.run(run())
+
+def test_iterate_within_deadline_closes_the_iterator():
+    async def run():
+        closed, items = [], []
+        async def chunks():
+            try:
+                for i in range(10):
+                    await asyncio.sleep(0 if i < 2 else 1)
+                    yield i
+            finally:
+                closed.append(True)
+
+        with deadline(time.monotonic() + 0.05):
+            with pytest.raises(asyncio.TimeoutError):
+                async for item in iterate_within_deadline(chunks(), "stream"):
+                    items.append(item)
+        return items, closed
+
+    assert asyncio.run(run()) == ([0, 1], [True])
+
+def test_iterate_without_deadline():
+    async def run():
+        async def chunks():
+            for i in range(3):
+                yield i
+        return [item async for item in iterate_within_deadline(chunks(), "stream")]
+
+    assert asyncio.run(run()) == [0, 1, 2]
@@ -0,0 +1,67 @@
+import asyncio
+from fakebackends import FakeSearchClient
+from lookupindex import LookupIndex
+
+DOCUMENTS = [
+    {"sourcepage": "Insurance-1.pdf", "category": None,
+     "content": "This sections is about house insurance. The deductible is 4000 NOK. Water damage is covered. "
+                "The deductible for water damage is 10000 NOK."},
+    {"sourcepage": "Insurance-2.pdf", "category": "internal",
+     "content": "The deductible for water damage is 10000 NOK. Claims must be reported within a year."},
+    {"sourcepage": "Travel-1.pdf", "category": None,
+     "content": "Travel insurance covers cancelled trips. Luggage is covered up to 20000 NOK."},
+]
+
+def test_lookup_returns_sentences_with_every_word():
+    index = LookupIndex(None, "sourcepage", "content", max_word_share=1)
+    asyncio.run(index.build(DOCUMENTS))
+    assert index.lookup("water deductible") == ["Insurance-1.pdf:The deductible for water damage is 10000 NOK."]
+    assert index.lookup("flood") == []
+    assert index.lookup("") == []
+
+def test_phrase_matches_come_first():
+    index = LookupIndex(None, "sourcepage", "content", max_word_share=1)
+    asyncio.run(index.build(DOCUMENTS))
+    assert index.lookup("water damage")[0] == "Insurance-1.pdf:Water damage is covered."
+
+def test_preface_and_repeated_sentences_are_not_indexed():
+    index = LookupIndex(None, "sourcepage", "content")
+    asyncio.run(index.build(DOCUMENTS))
+    sentences = [sentence for _, _, sentence, _ in index.sentences]
+    assert "This sections is about house insurance." not in sentences
+    assert sentences.count("The deductible for water damage is 10000 NOK.") == 1
+
+def test_common_words_are_ignored():
+    index = LookupIndex(None, "sourcepage", "content", max_word_share=0.2)
+    asyncio.run(index.build(DOCUMENTS))
+    # "is" is in most sentences, "luggage" in one
+    assert index.lookup("luggage is") == ["Travel-1.pdf:Luggage is covered up to 20000 NOK."]
+
+def test_exclude_category():
+    index = LookupIndex(None, "sourcepage", "content", max_word_share=1)
+    asyncio.run(index.build(DOCUMENTS))
+    assert index.lookup("reported", exclude_category="internal") == []
+    assert index.lookup("reported") == ["Insurance-2.pdf:Claims must be reported within a year."]
+
+def test_update_index_version_rebuilds_the_index():
+    async def run():
+        search_client = FakeSearchClient(DOCUMENTS)
+        index = LookupIndex(search_client, "sourcepage", "content")
+        await index.update_index_version(1)
+        await index.update_index_version(1)
+        search_client.documents = DOCUMENTS[2:]
+        await index.update_index_version(2)
+        return search_client.calls, index.lookup("luggage"), index.lookup("deductible")
+
+    calls, luggage, deductible = asyncio.run(run())
+    assert calls == 2
+    assert luggage == ["Travel-1.pdf:Luggage is covered up to 20000 NOK."]
+    assert deductible == []
+
+def test_load_fetches_at_most_max_sections(caplog):
+    search_client = FakeSearchClient(DOCUMENTS)
+    index = LookupIndex(search_client, "sourcepage", "content", max_word_share=1, max_sections=2)
+    asyncio.run(index.load())
+    assert search_client.last_options["top"] == 2
+    assert index.lookup("luggage") == []
+    assert "limited to 2 of the 3 sections" in caplog.text
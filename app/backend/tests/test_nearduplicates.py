@@ -0,0 +1,42 @@
+from nearduplicates import NearDuplicateIndex, word_similarity
+
+def test_word_similarity():
+    assert word_similarity("What does house insurance cover?", "what does the house insurance cover") == 1.0
+    assert word_similarity("Is water damage covered?", "Is water damage not covered?") == 0.0
+    assert word_similarity("Deductible for 2 claims", "Deductible for 3 claims") == 0.0
+    assert 0 < word_similarity("Is water damage covered?", "Is fire damage covered?") < 1
+
+def test_match_finds_added_questions():
+    index = NearDuplicateIndex(threshold=0.8)
+    index.add("What does house insurance cover?")
+    assert index.match("what does the house insurance cover") == "What does house insurance cover?"
+    assert index.match("What does my house insurance cover for water damage?") is None
+
+def test_match_does_not_add():
+    index = NearDuplicateIndex()
+    assert index.match("What does house insurance cover?") is None
+    assert index.match("What does house insurance cover?") is None
+    assert not index.questions
+
+def test_negations_and_numbers_must_match():
+    index = NearDuplicateIndex(threshold=0.5)
+    index.add("Is water damage in the basement covered?")
+    index.add("What is the deductible for 2 claims?")
+    assert index.match("Is water damage in the basement not covered?") is None
+    assert index.match("What is the deductible for 3 claims?") is None
+
+def test_similar_wording_matches():
+    index = NearDuplicateIndex(threshold=0.7)
+    index.add("How long do I have to report a theft from my car?")
+    assert index.match("How long do I have to report theft from my car") == "How long do I have to report a theft from my car?"
+
+def test_least_recently_matched_questions_are_forgotten():
+    index = NearDuplicateIndex(max_entries=2)
+    index.add("What does house insurance cover?")
+    index.add("How long do I have to report theft?")
+    index.match("What does house insurance cover?")
+    index.add("Is storm damage to the garden covered?")
+    assert index.match("How long do I have to report theft?") is None
+    assert index.match("What does house insurance cover?") == "What does house insurance cover?"
+    assert all(index.buckets.values())
+    assert sum(len(bucket) for bucket in index.buckets.values()) == 2 * index.bands
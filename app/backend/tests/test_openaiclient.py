@@ -0,0 +1,174 @@
+import asyncio
+import time
+import openai
+import openai.error
+import pytest
+from deadline import deadline
+from openaiclient import CircuitOpenError, ResilientOpenAI, parse_retry_after
+
+class ScriptedCompletion:
+    """Stands in for openai.Completion.acreate, raising or returning the scripted results in turn, the last one for good."""
+
+    def __init__(self, *results):
+        self.results = list(results)
+        self.calls = 0
+
+    async def __call__(self, **kwargs):
+        self.calls += 1
+        result = self.results.pop(0) if len(self.results) > 1 else self.results[0]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+@pytest.fixture
+def completion(monkeypatch):
+    def install(*results):
+        scripted = ScriptedCompletion(*results)
+        monkeypatch.setattr(openai.Completion, "acreate", scripted)
+        return scripted
+    return install
+
+def create(client, **kwargs):
+    return asyncio.run(client.completion.acreate(engine="davinci", prompt="q", **kwargs))
+
+def test_retries_transient_errors(completion):
+    scripted = completion(openai.error.ServiceUnavailableError("busy"), openai.error.Timeout("slow"), "answer")
+    assert create(ResilientOpenAI(backoff_base=0.001)) == "answer"
+    assert scripted.calls == 3
+
+def test_gives_up_after_max_retries(completion):
+    scripted = completion(openai.error.APIError("failed"))
+    with pytest.raises(openai.error.APIError):
+        create(ResilientOpenAI(max_retries=2, backoff_base=0.001))
+    assert scripted.calls == 3
+
+def test_rejected_requests_are_not_retried(completion):
+    scripted = completion(openai.error.InvalidRequestError("too long", "prompt"))
+    with pytest.raises(openai.error.InvalidRequestError):
+        create(ResilientOpenAI(backoff_base=0.001))
+    assert scripted.calls == 1
+
+def test_no_retry_after_the_deadline(completion):
+    scripted = completion(openai.error.APIError("failed"))
+    async def run():
+        with deadline(time.monotonic() + 0.05):
+            await ResilientOpenAI(backoff_base=10, backoff_max=10).completion.acreate(engine="davinci", prompt="q")
+    # Random backoff of up to 10s, almost always longer than what is left
+    with pytest.raises(openai.error.APIError):
+        asyncio.run(run())
+    assert scripted.calls <= 2
+
+def test_retry_after_of_rate_limits():
+    assert parse_retry_after(openai.error.RateLimitError("slow down", headers={"Retry-After": "3"})) == 3
+    assert parse_retry_after(openai.error.RateLimitError("slow down", headers={"retry-after-ms": "1500", "Retry-After": "2"})) == 1.5
+    assert parse_retry_after(openai.error.RateLimitError("slow down", headers={"Retry-After": "Wed, 21 Oct 2026 07:28:00 GMT"})) is None
+    assert parse_retry_after(openai.error.RateLimitError("slow down")) is None
+
+def test_long_rate_limits_are_not_waited_for(completion):
+    scripted = completion(openai.error.RateLimitError("slow down", headers={"Retry-After": "60"}))
+    with pytest.raises(openai.error.RateLimitError):
+        create(ResilientOpenAI(max_retry_after=30))
+    assert scripted.calls == 1
+
+def test_circuit_opens_after_failures_in_a_row(completion):
+    scripted = completion(openai.error.APIError("failed"))
+    client = ResilientOpenAI(max_retries=0, failure_threshold=3, reset_timeout=30)
+    for _ in range(3):
+        with pytest.raises(openai.error.APIError):
+            create(client)
+    with pytest.raises(CircuitOpenError) as e:
+        create(client)
+    assert scripted.calls == 3
+    assert e.value.deployment == "davinci"
+    assert 29 < e.value.retry_after <= 30
+    # Other deployments are not affected
+    with pytest.raises(openai.error.APIError):
+        asyncio.run(client.completion.acreate(engine="gpt-35", prompt="q"))
+
+def test_circuit_closes_after_a_successful_probe(completion):
+    completion(openai.error.APIError("failed"), "answer")
+    client = ResilientOpenAI(max_retries=0, failure_threshold=1, reset_timeout=30)
+    with pytest.raises(openai.error.APIError):
+        create(client)
+    client.breaker("davinci").opened_at -= 30
+    assert create(client) == "answer"
+    assert client.breaker("davinci").opened_at is None
+
+def test_failed_probe_keeps_the_circuit_open(completion):
+    completion(openai.error.APIError("failed"))
+    client = ResilientOpenAI(max_retries=0, failure_threshold=1, reset_timeout=30)
+    with pytest.raises(openai.error.APIError):
+        create(client)
+    client.breaker("davinci").opened_at -= 30
+    with pytest.raises(openai.error.APIError):
+        create(client)
+    with pytest.raises(CircuitOpenError):
+        create(client)
+
+def test_rate_limits_do_not_open_the_circuit(completion):
+    completion(openai.error.RateLimitError("slow down", headers={"Retry-After": "60"}))
+    client = ResilientOpenAI(failure_threshold=1)
+    for _ in range(3):
+        with pytest.raises(openai.error.RateLimitError):
+            create(client)
+
+class Stream:
+    def __init__(self, name: str):
+        self.name = name
+        self.closed = False
+
+    async def __aiter__(self):
+        yield self.name
+
+    async def aclose(self):
+        self.closed = True
+
+def hedging_client():
+    client = ResilientOpenAI(hedge=True, hedge_min_delay=0.01)
+    client.latencies[("davinci", True)].extend([0.001] * client.MIN_LATENCY_SAMPLES)
+    return client
+
+def test_slow_requests_are_hedged(monkeypatch):
+    requests = []
+    async def acreate(**kwargs):
+        requests.append("sent")
+        try:
+            await asyncio.sleep(1 if len(requests) == 1 else 0)
+        except asyncio.CancelledError:
+            requests.append("cancelled")
+            raise
+        return Stream(f"request {len(requests)}")
+    monkeypatch.setattr(openai.Completion, "acreate", acreate)
+
+    async def run():
+        response = await hedging_client().completion.acreate(engine="davinci", prompt="q", stream=True)
+        await asyncio.sleep(0)
+        return response.name
+
+    assert asyncio.run(run()) == "request 2"
+    assert requests == ["sent", "sent", "cancelled"]
+
+def test_streamed_response_of_the_loser_is_closed(monkeypatch):
+    hedged = None
+    streams = []
+    async def acreate(**kwargs):
+        stream = Stream(f"request {len(streams) + 1}")
+        streams.append(stream)
+        if len(streams) == 1:
+            await hedged.wait()
+        else:
+            # Both requests are answered before the client picks one
+            hedged.set()
+        return stream
+    monkeypatch.setattr(openai.Completion, "acreate", acreate)
+
+    async def run():
+        nonlocal hedged
+        hedged = asyncio.Event()
+        response = await hedging_client().completion.acreate(engine="davinci", prompt="q", stream=True)
+        await asyncio.sleep(0.01)
+        return response
+
+    response = asyncio.run(run())
+    assert len(streams) == 2
+    assert [stream.closed for stream in streams] == [stream is not response for stream in streams]
@@ -0,0 +1,13 @@
+import pytest
+from overrides import InvalidOverride, positive_override
+
+def test_positive_override():
+    assert positive_override({}, "deadline_seconds", 30.0, float) == 30.0
+    assert positive_override({"deadline_seconds": None}, "deadline_seconds", 30.0, float) == 30.0
+    assert positive_override({"deadline_seconds": "2.5"}, "deadline_seconds", 30.0, float) == 2.5
+    assert positive_override({"prompt_token_budget": 1000}, "prompt_token_budget", 3000, int) == 1000
+
+@pytest.mark.parametrize("value", ["soon", 0, -1, "nan", True, []])
+def test_invalid_override(value):
+    with pytest.raises(InvalidOverride, match="deadline_seconds must be a positive number"):
+        positive_override({"deadline_seconds": value}, "deadline_seconds", 30.0, float)
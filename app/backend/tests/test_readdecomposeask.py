@@ -0,0 +1,100 @@
+import asyncio
+import openai
+import time
+import pytest
+from approaches.approach import RequestContext
+from approaches.readdecomposeask import ReadDecomposeAsk
+from fakebackends import FakeSearchClient
+from lookupindex import LookupIndex
+from openaiclient import CircuitOpenError
+
+QUESTION = "Does my house insurance cover water damage?"
+
+def create_approach(search_client, **options):
+    return ReadDecomposeAsk(search_client, "test", "sourcepage", "content", **options)
+
+def test_open_circuit_fails_fast(search_client, fake_openai, open_circuit):
+    with pytest.raises(CircuitOpenError):
+        asyncio.run(create_approach(search_client, completions=open_circuit).run(QUESTION, {}))
+    assert fake_openai.calls == 0
+
+def test_answer(search_client, fake_openai):
+    r = asyncio.run(create_approach(search_client).run(QUESTION, {"top": 3}))
+    assert "[Insurance-0.pdf]" in r["answer"]
+    assert len(r["data_points"]) == 3
+
+def test_concurrent_requests_keep_their_own_sources(search_client, fake_openai):
+    search_client.latency = 0.01
+    approach = create_approach(search_client)
+    async def run():
+        return await asyncio.gather(approach.run(QUESTION, {"top": 2}), approach.run(QUESTION, {"top": 4}))
+    two, four = asyncio.run(run())
+    assert [len(two["data_points"]), len(four["data_points"])] == [2, 4]
+
+def test_agents_are_built_once_per_prompt_and_temperature(search_client, fake_openai, monkeypatch):
+    approach = create_approach(search_client)
+    agent = approach.get_agent({})
+    assert approach.get_agent({"temperature": 0.3}) is agent
+    assert approach.get_agent({"temperature": 0.5}) is not agent
+    assert approach.get_agent({"prompt_template": "Answer in Norwegian."}) is not agent
+    monkeypatch.setattr(openai, "api_key", "refreshed")
+    assert approach.get_agent({}).llm_chain.llm.openai_api_key == "refreshed"
+
+def test_parallel_plan(search_client, fake_openai):
+    search_client.latency = 0.05
+    start = time.monotonic()
+    r = asyncio.run(create_approach(search_client, parallel_subquestions=True).run(QUESTION, {"top": 3}))
+    # The fake plans a search and a lookup, which run at the same time, then the answer is synthesized
+    assert search_client.calls == 2
+    assert time.monotonic() - start < 0.1
+    assert fake_openai.calls == 2
+    assert "[Insurance-0.pdf]" in r["answer"]
+    assert len(r["data_points"]) == 3
+    assert "Search[insurance coverage]<br>Lookup[deductible]" in r["thoughts"]
+
+def test_parallel_plan_fails_fast_on_an_open_circuit(search_client, fake_openai, open_circuit):
+    with pytest.raises(CircuitOpenError):
+        asyncio.run(create_approach(search_client, completions=open_circuit, parallel_subquestions=True).run(QUESTION, {}))
+    assert search_client.calls == 0
+
+def test_lookups_are_answered_from_the_lookup_index(search_client, fake_openai):
+    lookup_index = LookupIndex(search_client, "sourcepage", "content", max_word_share=1)
+    asyncio.run(lookup_index.build([{"sourcepage": "Insurance-5.pdf", "category": None, "content": "The deductible is 4000 NOK."}]))
+    r = asyncio.run(create_approach(search_client, parallel_subquestions=True, lookup_index=lookup_index).run(QUESTION, {}))
+    assert "Insurance-5.pdf:The deductible is 4000 NOK." in r["data_points"]
+    # Only the search of the plan went to Cognitive Search
+    assert search_client.calls == 1
+
+def test_remote_lookups_exclude_the_category(search_client, fake_openai):
+    approach = create_approach(search_client)
+    asyncio.run(approach.lookup("deductible", RequestContext({"exclude_category": "internal"})))
+    assert search_client.last_options["filter"] == "category ne 'internal'"
+
+@pytest.mark.parametrize("semantic_ranker", [False, True])
+def test_search_observation(search_client, capsys, semantic_ranker):
+    context = RequestContext({"top": 2, "semantic_ranker": semantic_ranker})
+    observation = asyncio.run(create_approach(search_client).search("water damage", context))
+    assert observation.splitlines()[0].startswith("Insurance-0.pdf:")
+    assert len(context.results) == 2
+    assert capsys.readouterr().out == ""
+
+def test_parallel_plan_fails_when_an_action_fails(documents, fake_openai):
+    class FailingSearchClient(FakeSearchClient):
+        finished = 0
+        async def search(self, search_text, **kwargs):
+            if search_text == "insurance coverage":
+                raise ConnectionError("search unavailable")
+            r = await super().search(search_text, **kwargs)
+            self.finished += 1
+            return r
+
+    search_client = FailingSearchClient(documents, latency=0.05)
+    async def run():
+        with pytest.raises(ConnectionError):
+            await create_approach(search_client, parallel_subquestions=True).run(QUESTION, {})
+        # The lookup was cancelled rather than left running
+        await asyncio.sleep(0.1)
+    asyncio.run(run())
+    assert search_client.finished == 0
+    # No answer is synthesized
+    assert fake_openai.calls == 1
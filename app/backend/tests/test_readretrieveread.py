@@ -0,0 +1,39 @@
+import asyncio
+import openai
+import pytest
+from approaches.readretrieveread import ReadRetrieveReadApproach
+from openaiclient import CircuitOpenError
+
+QUESTION = "Does my house insurance cover water damage?"
+
+def create_approach(search_client, **options):
+    return ReadRetrieveReadApproach(search_client, "test", "sourcepage", "content", **options)
+
+def test_open_circuit_fails_fast(search_client, fake_openai, open_circuit):
+    with pytest.raises(CircuitOpenError):
+        asyncio.run(create_approach(search_client, completions=open_circuit).run(QUESTION, {}))
+    assert fake_openai.calls == 0
+
+def test_answer(search_client, fake_openai):
+    r = asyncio.run(create_approach(search_client).run(QUESTION, {"top": 3}))
+    assert r["answer"] == fake_openai.answer()
+    assert len(r["data_points"]) == 3
+    assert "CognitiveSearch" in r["thoughts"]
+
+def test_concurrent_requests_keep_their_own_sources(search_client, fake_openai):
+    search_client.latency = 0.01
+    approach = create_approach(search_client)
+    async def run():
+        return await asyncio.gather(approach.run(QUESTION, {"top": 2}), approach.run(QUESTION, {"top": 4}))
+    two, four = asyncio.run(run())
+    assert [len(two["data_points"]), len(four["data_points"])] == [2, 4]
+
+def test_agents_are_built_once_per_prompt_and_temperature(search_client, fake_openai, monkeypatch):
+    approach = create_approach(search_client)
+    agent = approach.get_agent({})
+    assert approach.get_agent({"temperature": 0}) is agent
+    assert approach.get_agent({"temperature": 0.5}) is not agent
+    assert approach.get_agent({"prompt_template_prefix": "Answer in Norwegian."}) is not agent
+    # The token is refreshed in the background, a reused agent picks up the current one
+    monkeypatch.setattr(openai, "api_key", "refreshed")
+    assert approach.get_agent({}).llm_chain.llm.openai_api_key == "refreshed"
@@ -0,0 +1,66 @@
+import asyncio
+import time
+import pytest
+from answercache import AnswerCache, MemoryAnswerStore
+from deadline import deadline
+from nearduplicates import NearDuplicateIndex
+from openaiclient import CircuitOpenError
+from approaches.retrievethenread import RetrieveThenReadApproach
+
+QUESTION = "Does my house insurance cover water damage?"
+
+def create_approach(search_client, **options):
+    return RetrieveThenReadApproach(search_client, "test", "sourcepage", "content", **options)
+
+async def stream(approach, q, overrides):
+    return [event async for event in approach.run_stream(q, overrides)]
+
+def test_answer(search_client, fake_openai):
+    r = asyncio.run(create_approach(search_client).run(QUESTION, {"top": 3}))
+    assert r["answer"].strip() == fake_openai.answer()
+    assert len(r["data_points"]) == 3
+
+def test_streamed_answer(search_client, fake_openai):
+    events = asyncio.run(stream(create_approach(search_client), QUESTION, {"top": 3}))
+    assert len(events[0]["data_points"]) == 3
+    assert "thoughts" in events[0]
+    deltas = "".join(event["delta"] for event in events[1:-1])
+    assert deltas.strip() == fake_openai.answer()
+    assert events[-1] == {"answer": deltas}
+
+def test_repeated_question_is_answered_from_the_cache(search_client, fake_openai):
+    approach = create_approach(search_client, answer_cache=AnswerCache(MemoryAnswerStore(10, 60), "ask:rtr"))
+    first = asyncio.run(approach.run(QUESTION, {"top": 3}))
+    again = asyncio.run(approach.run(QUESTION.upper(), {"top": 3}))
+    events = asyncio.run(stream(approach, QUESTION, {"top": 3}))
+    assert fake_openai.calls == 1
+    assert again["answer"] == events[-1]["answer"] == first["answer"]
+    # Other sources, another answer
+    asyncio.run(approach.run(QUESTION, {"top": 4}))
+    assert fake_openai.calls == 2
+
+def test_paraphrased_question_is_answered_from_the_cache(search_client, fake_openai):
+    approach = create_approach(search_client, answer_cache=AnswerCache(MemoryAnswerStore(10, 60), "ask:rtr"), near_duplicates=NearDuplicateIndex())
+    first = asyncio.run(approach.run("What does house insurance cover?", {}))
+    second = asyncio.run(approach.run("what does the house insurance cover", {}))
+    assert fake_openai.calls == 1
+    assert second["answer"] == first["answer"]
+
+def test_open_circuit_fails_fast(search_client, fake_openai, open_circuit):
+    approach = create_approach(search_client, completions=open_circuit)
+    with pytest.raises(CircuitOpenError):
+        asyncio.run(approach.run(QUESTION, {}))
+    with pytest.raises(CircuitOpenError):
+        asyncio.run(stream(approach, QUESTION, {}))
+    assert fake_openai.calls == 0
+
+def test_slow_completion_is_cut_off_at_the_deadline(search_client, fake_openai):
+    fake_openai.latency = 1
+    approach = create_approach(search_client)
+    async def run():
+        with deadline(time.monotonic() + 0.05):
+            return await approach.run(QUESTION, {})
+    start = time.monotonic()
+    r = asyncio.run(run())
+    assert r["answer"] == approach.timeout_answer
+    assert time.monotonic() - start < 0.5
@@ -0,0 +1,137 @@
+import asyncio
+import searchcache
+from searchcache import CachingSearchClient, IndexVersionWatcher, SearchResults, TTLCache, normalize_query
+
+class SlowSearchClient:
+    def __init__(self):
+        self.calls = 0
+        self.release = asyncio.Event()
+
+    async def search(self, search_text, **kwargs):
+        self.calls += 1
+        await self.release.wait()
+        return SearchResults([{"id": f"{search_text}-{self.calls}"}], answers=["answer"], count=42)
+
+def test_ttl_cache_evicts_least_recently_used():
+    cache = TTLCache(2, 60)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+    cache.put("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert len(cache) == 2
+
+def test_ttl_cache_expires_entries(monkeypatch):
+    now = 1000.0
+    monkeypatch.setattr(searchcache.time, "monotonic", lambda: now)
+    cache = TTLCache(10, 60)
+    cache.put("a", 1)
+    now += 59
+    assert cache.get("a") == 1
+    now += 2
+    assert cache.get("a") is None
+    assert len(cache) == 0
+
+def test_normalize_query():
+    assert normalize_query("  What does  house insurance\ncover? ") == "what does house insurance cover"
+
+def test_caching_search_client_answers_repeated_searches(search_client):
+    async def run():
+        client = CachingSearchClient(search_client, 10, 60)
+        first = await client.search("Water damage?", top=3)
+        second = await client.search("water   damage", top=3)
+        other = await client.search("water damage", top=5)
+        return first, second, other
+
+    first, second, other = asyncio.run(run())
+    assert search_client.calls == 2
+    assert first.documents == second.documents
+    assert len(other.documents) == 5
+
+def test_caching_search_client_materializes_answers_and_count():
+    async def run():
+        search_client = SlowSearchClient()
+        search_client.release.set()
+        client = CachingSearchClient(search_client, 10, 60)
+        await client.search("q")
+        r = await client.search("q")
+        return [doc async for doc in r], await r.get_answers(), await r.get_count()
+
+    assert asyncio.run(run()) == ([{"id": "q-1"}], ["answer"], 42)
+
+def test_concurrent_searches_wait_for_the_first():
+    async def run():
+        search_client = SlowSearchClient()
+        client = CachingSearchClient(search_client, 10, 60)
+        searches = [asyncio.create_task(client.search("q")) for _ in range(3)]
+        await asyncio.sleep(0)
+        search_client.release.set()
+        results = await asyncio.gather(*searches)
+        return search_client.calls, [r.documents for r in results]
+
+    calls, documents = asyncio.run(run())
+    assert calls == 1
+    assert documents == [[{"id": "q-1"}]] * 3
+
+def test_index_version_change_clears_the_cache(search_client):
+    async def run():
+        client = CachingSearchClient(search_client, 10, 60)
+        await client.update_index_version(1)
+        await client.search("q")
+        await client.update_index_version(1)
+        await client.search("q")
+        await client.update_index_version(2)
+        await client.search("q")
+
+    asyncio.run(run())
+    assert search_client.calls == 2
+
+def test_results_fetched_while_the_index_changed_are_not_cached():
+    async def run():
+        search_client = SlowSearchClient()
+        client = CachingSearchClient(search_client, 10, 60)
+        await client.update_index_version(1)
+        search = asyncio.create_task(client.search("q"))
+        await asyncio.sleep(0)
+        await client.update_index_version(2)
+        search_client.release.set()
+        await search
+        return len(client.cache)
+
+    assert asyncio.run(run()) == 0
+
+def test_index_version_watcher_updates_every_listener():
+    async def run():
+        checks, updates = [], []
+        async def get_version():
+            checks.append(1)
+            return len(checks)
+        async def failing(version):
+            raise RuntimeError("rebuild failed")
+        async def listener(version):
+            updates.append(version)
+
+        watcher = IndexVersionWatcher(get_version, 0.01)
+        watcher.subscribe(failing)
+        watcher.subscribe(listener)
+        watcher.start()
+        await asyncio.sleep(0.035)
+        await watcher.close()
+        return len(checks), updates
+
+    checks, updates = asyncio.run(run())
+    assert checks >= 2
+    assert updates == list(range(1, checks + 1))
+
+def test_index_version_watcher_without_listeners_does_not_check():
+    async def run():
+        async def get_version():
+            raise AssertionError("checked")
+        watcher = IndexVersionWatcher(get_version, 0.01)
+        watcher.start()
+        await watcher.close()
+        return watcher.task
+
+    assert asyncio.run(run()) is None
@@ -0,0 +1,44 @@
+from sections import merge_sections
+
+PREFACE = "This sections is about house insurance. "
+SHARED = "the deductible applies for each claim unless agreed otherwise"
+
+def section(sourcepage, content, sourcefile="Insurance.pdf"):
+    return {"sourcepage": sourcepage, "sourcefile": sourcefile, "content": content}
+
+def merge(documents):
+    return [(doc["sourcepage"], doc["content"]) for doc in merge_sections(documents, "sourcepage", "content")]
+
+def test_overlapping_sections_of_a_page_are_merged():
+    first = section("Insurance-1.pdf", "Water damage is covered, " + SHARED)
+    second = section("Insurance-1.pdf", SHARED + ". Claims are paid within 30 days.")
+    assert merge([second, first]) == [("Insurance-1.pdf", "Water damage is covered, " + SHARED + ". Claims are paid within 30 days.")]
+    assert merge([first, second]) == [("Insurance-1.pdf", "Water damage is covered, " + SHARED + ". Claims are paid within 30 days.")]
+
+def test_sections_of_other_pages_lose_the_shared_text():
+    first = section("Insurance-1.pdf", "Water damage is covered, " + SHARED)
+    second = section("Insurance-2.pdf", SHARED + ". Claims are paid within 30 days.")
+    assert merge([first, second]) == [("Insurance-1.pdf", "Water damage is covered, " + SHARED),
+                                      ("Insurance-2.pdf", ". Claims are paid within 30 days.")]
+
+def test_sections_of_other_files_are_kept():
+    first = section("Insurance-1.pdf", "Water damage is covered, " + SHARED)
+    second = section("Travel-1.pdf", SHARED + ". Claims are paid within 30 days.", "Travel.pdf")
+    assert merge([first, second]) == [("Insurance-1.pdf", first["content"]), ("Travel-1.pdf", second["content"])]
+
+def test_contained_sections_are_dropped():
+    first = section("Insurance-1.pdf", "Water damage is covered, " + SHARED)
+    assert merge([first, section("Insurance-2.pdf", SHARED)]) == [("Insurance-1.pdf", first["content"])]
+
+def test_preface_is_kept_once():
+    first = section("Insurance-1.pdf", PREFACE + "Water damage is covered, " + SHARED)
+    second = section("Insurance-3.pdf", PREFACE + "Storm damage to the garden is not covered.")
+    assert merge([first, second]) == [("Insurance-1.pdf", PREFACE + "Water damage is covered, " + SHARED),
+                                      ("Insurance-3.pdf", "Storm damage to the garden is not covered.")]
+
+def test_documents_are_not_changed():
+    documents = [section("Insurance-1.pdf", PREFACE + "Water damage is covered, " + SHARED),
+                 section("Insurance-1.pdf", PREFACE + SHARED + ". Claims are paid within 30 days.")]
+    copies = [dict(doc) for doc in documents]
+    merge_sections(documents, "sourcepage", "content")
+    assert documents == copies
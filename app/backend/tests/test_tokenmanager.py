@@ -0,0 +1,68 @@
+import asyncio
+import fcntl
+import threading
+import time
+import openai
+import pytest
+import tokenmanager
+from azure.core.credentials import AccessToken
+from tokenmanager import OpenAITokenManager
+
+class FakeCredential:
+    def __init__(self):
+        self.calls = 0
+
+    async def get_token(self, scope):
+        self.calls += 1
+        return AccessToken(f"token-{self.calls}", int(time.time()) + 3600)
+
+@pytest.fixture(autouse=True)
+def api_key(monkeypatch):
+    monkeypatch.setattr(openai, "api_key", None)
+
+def test_workers_share_the_token(tmp_path):
+    credential = FakeCredential()
+    async def run():
+        for _ in range(2):
+            await OpenAITokenManager(credential, str(tmp_path / "token.json")).refresh()
+    asyncio.run(run())
+    assert credential.calls == 1
+    assert openai.api_key == "token-1"
+
+def test_shared_file_is_used_off_the_event_loop(tmp_path, monkeypatch):
+    threads = []
+    monkeypatch.setattr(tokenmanager.json, "load", lambda f, load=tokenmanager.json.load: threads.append(threading.current_thread()) or load(f))
+    monkeypatch.setattr(tokenmanager.json, "dump", lambda *args, dump=tokenmanager.json.dump, **kwargs: threads.append(threading.current_thread()) or dump(*args, **kwargs))
+    (tmp_path / "token.json").write_text('{"token": "expired", "expires_on": 0}')
+    asyncio.run(OpenAITokenManager(FakeCredential(), str(tmp_path / "token.json")).refresh())
+    # Read before and after taking the lock, then written
+    assert len(threads) == 3 and threading.main_thread() not in threads
+
+def test_refresh_waits_for_the_lock_without_blocking_the_loop(tmp_path, monkeypatch):
+    monkeypatch.setattr(OpenAITokenManager, "LOCK_POLL_INTERVAL", 0.01)
+    manager = OpenAITokenManager(FakeCredential(), str(tmp_path / "token.json"))
+    with open(tmp_path / "token.json.lock", "w") as held:
+        fcntl.flock(held, fcntl.LOCK_EX)
+        async def run():
+            refresh = asyncio.create_task(manager.refresh())
+            await asyncio.sleep(0.05)
+            assert not refresh.done()
+            # Another worker is done with the lock
+            fcntl.flock(held, fcntl.LOCK_UN)
+            await refresh
+        asyncio.run(run())
+    assert openai.api_key == "token-1"
+
+def test_stop_while_waiting_for_the_lock_leaves_it_free(tmp_path, monkeypatch):
+    monkeypatch.setattr(OpenAITokenManager, "LOCK_POLL_INTERVAL", 0.01)
+    manager = OpenAITokenManager(FakeCredential(), str(tmp_path / "token.json"))
+    with open(tmp_path / "token.json.lock", "w") as held:
+        fcntl.flock(held, fcntl.LOCK_EX)
+        async def run():
+            manager.start()
+            await asyncio.sleep(0.05)
+            await manager.stop()
+        asyncio.run(run())
+    # Nothing took the lock after the stop
+    with open(tmp_path / "token.json.lock", "w") as f:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
@@ -0,0 +1,29 @@
+from metrics import Counter, Histogram, generate_latest
+from tracing import current_trace, span, top_bucket, trace
+
+def test_top_bucket():
+    assert [top_bucket(top) for top in [None, 0, 3, "5", 6, 10, 11, 1000, "many"]] == \
+           ["default", "default", "<=5", "<=5", "<=10", "<=10", ">10", ">10", "invalid"]
+
+def test_spans_are_recorded_in_the_trace():
+    with trace("ask:rtr", {"top": 3, "semantic_ranker": True}) as request_trace:
+        with span("search", query="q"):
+            pass
+        assert current_trace.get() is request_trace
+    assert current_trace.get() is None
+    assert [s["step"] for s in request_trace.spans] == ["search", "total"]
+    assert request_trace.spans[0]["query"] == "q"
+    assert request_trace.tags == {"approach": "ask:rtr", "semantic_ranker": "true", "semantic_captions": "false", "top": "<=5"}
+
+def test_span_outside_of_a_trace():
+    with span("search"):
+        pass
+
+def test_metrics_are_rendered():
+    counter = Counter("test_requests_total", "Requests", ["approach"])
+    counter.inc(approach='say "hi"')
+    histogram = Histogram("test_seconds", "Durations", buckets=(1, 2))
+    histogram.observe(1.5)
+    rendered = generate_latest()
+    assert '# TYPE test_requests_total counter\ntest_requests_total{approach="say \\"hi\\""} 1' in rendered
+    assert 'test_seconds_bucket{le="1"} 0\ntest_seconds_bucket{le="2"} 1\ntest_seconds_bucket{le="+Inf"} 1\ntest_seconds_sum 1.5\ntest_seconds_count 1' in rendered
@@ -0,0 +1,115 @@
+import asyncio
+import json
+import logging
+import os
+import random
+import time
+from typing import Optional
+import openai
+from azure.core.credentials import AccessToken
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows, the token is then only shared within the process
+    fcntl = None
+
+class OpenAITokenManager:
+    """
+    Keeps the AAD token used for Azure OpenAI fresh in the background, so a request never waits on get_token.
+    The token is refreshed REFRESH_MARGIN seconds before it expires and published through openai.api_key, which is
+    what the approaches and the LangChain LLMs authenticate with. The current token is also stored in a file shared
+    by the gunicorn workers on the machine, so that only one of them has to fetch a new token. The first token is
+    fetched in the background as well, ready is set once it is available.
+    """
+
+    SCOPE = "https://cognitiveservices.azure.com/.default"
+    REFRESH_MARGIN = 300
+    RETRY_WAIT = 10
+    LOCK_POLL_INTERVAL = 0.1
+
+    def __init__(self, credential, cache_path: str):
+        self.credential = credential
+        self.cache_path = cache_path
+        self.token: Optional[AccessToken] = None
+        self.refresh_task: Optional[asyncio.Task] = None
+        self.ready = asyncio.Event()
+
+    def start(self):
+        self.refresh_task = asyncio.create_task(self.refresh_loop())
+
+    async def stop(self):
+        if self.refresh_task:
+            self.refresh_task.cancel()
+            try:
+                await self.refresh_task
+            except asyncio.CancelledError:
+                pass
+
+    def needs_refresh(self, token: Optional[AccessToken]) -> bool:
+        return token is None or token.expires_on - self.REFRESH_MARGIN < time.time()
+
+    async def refresh_loop(self):
+        while True:
+            # Spread out the wake ups of the workers, the first one refreshes and the others pick up its token
+            if self.token:
+                await asyncio.sleep(max(self.token.expires_on - self.REFRESH_MARGIN - time.time(), 0) + random.uniform(0, 10))
+            try:
+                await self.refresh()
+            except Exception:
+                logging.exception("Failed to refresh the OpenAI token")
+                await asyncio.sleep(self.RETRY_WAIT)
+
+    async def refresh(self):
+        # The shared file is read and written in worker threads, the event loop keeps serving requests meanwhile
+        token = await asyncio.to_thread(self.read_shared_token)
+        if self.needs_refresh(token):
+            lock_file = await self.lock()
+            try:
+                # Another worker may have refreshed the token while we waited for the lock
+                token = await asyncio.to_thread(self.read_shared_token)
+                if self.needs_refresh(token):
+                    token = await self.credential.get_token(self.SCOPE)
+                    await asyncio.to_thread(self.write_shared_token, token)
+            finally:
+                await asyncio.to_thread(self.unlock, lock_file)
+        self.token = token
+        openai.api_key = token.token
+        self.ready.set()
+
+    def read_shared_token(self) -> Optional[AccessToken]:
+        try:
+            with open(self.cache_path) as f:
+                cached = json.load(f)
+            return AccessToken(cached["token"], cached["expires_on"])
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def write_shared_token(self, token: AccessToken):
+        tmp_path = f"{self.cache_path}.{os.getpid()}.tmp"
+        with open(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w") as f:
+            json.dump({"token": token.token, "expires_on": token.expires_on}, f)
+        os.replace(tmp_path, self.cache_path)
+
+    # The lock is polled rather than waited for in a worker thread, so stopping while another worker holds it leaves
+    # no thread behind that takes the lock later and never releases it
+    async def lock(self):
+        lock_file = await asyncio.to_thread(open, self.cache_path + ".lock", "w")
+        try:
+            while fcntl and not self.try_lock(lock_file):
+                await asyncio.sleep(self.LOCK_POLL_INTERVAL)
+        except BaseException:
+            lock_file.close()
+            raise
+        return lock_file
+
+    def try_lock(self, lock_file) -> bool:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except BlockingIOError:
+            return False
+
+    def unlock(self, lock_file):
+        if fcntl:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+        lock_file.close()
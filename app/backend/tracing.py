@@ -0,0 +1,62 @@
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Iterator, Optional
+from metrics import Histogram
+
+step_seconds = Histogram("approach_step_seconds", "Duration of the steps taken to answer a request",
+                         ["approach", "step", "semantic_ranker", "semantic_captions", "top"])
+
+# top is sent by the client, the label only tells its range so clients can't create any number of series
+def top_bucket(top: Any) -> str:
+    if not top:
+        return "default"
+    try:
+        top = int(top)
+    except (TypeError, ValueError):
+        return "invalid"
+    return "<=5" if top <= 5 else "<=10" if top <= 10 else ">10"
+
+class Trace:
+    """
+    Spans recorded while one request is answered. Every span is observed in the approach_step_seconds histogram,
+    tagged with the approach and the overrides that change the retrieval, and kept so it can be returned to the client.
+    """
+
+    def __init__(self, approach: str, overrides: dict[str, Any]):
+        self.tags = {
+            "approach": approach,
+            "semantic_ranker": str(bool(overrides.get("semantic_ranker"))).lower(),
+            "semantic_captions": str(bool(overrides.get("semantic_captions"))).lower(),
+            "top": top_bucket(overrides.get("top"))
+        }
+        self.start = time.monotonic()
+        self.spans: list[dict[str, Any]] = []
+
+    def record(self, step: str, start: float, end: float, **attributes: Any):
+        step_seconds.observe(end - start, step=step, **self.tags)
+        self.spans.append({"step": step, "start": round(start - self.start, 4), "duration": round(end - start, 4), **attributes})
+
+current_trace: ContextVar[Optional[Trace]] = ContextVar("current_trace", default=None)
+
+# Traces everything that happens in the block as one request of the approach, the whole request is recorded as "total"
+@contextmanager
+def trace(approach: str, overrides: dict[str, Any]) -> Iterator[Trace]:
+    request_trace = Trace(approach, overrides)
+    token = current_trace.set(request_trace)
+    try:
+        yield request_trace
+    finally:
+        request_trace.record("total", request_trace.start, time.monotonic())
+        current_trace.reset(token)
+
+# Records the block as a step of the current request, does nothing outside of a traced request
+@contextmanager
+def span(step: str, **attributes: Any) -> Iterator[None]:
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        request_trace = current_trace.get()
+        if request_trace:
+            request_trace.record(step, start, time.monotonic(), **attributes)
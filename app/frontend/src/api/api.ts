@@ -1,4 +1,39 @@
-import { AskRequest, AskResponse, ChatRequest } from "./models";
+import { AskRequest, AskResponse, AskStreamEvent, ChatRequest } from "./models";
+
+function askRequestBody(options: AskRequest): string {
+    return JSON.stringify({
+        question: options.question,
+        approach: options.approach,
+        overrides: {
+            semantic_ranker: options.overrides?.semanticRanker,
+            semantic_captions: options.overrides?.semanticCaptions,
+            top: options.overrides?.top,
+            temperature: options.overrides?.temperature,
+            prompt_template: options.overrides?.promptTemplate,
+            prompt_template_prefix: options.overrides?.promptTemplatePrefix,
+            prompt_template_suffix: options.overrides?.promptTemplateSuffix,
+            exclude_category: options.overrides?.excludeCategory
+        }
+    });
+}
+
+function chatRequestBody(options: ChatRequest): string {
+    return JSON.stringify({
+        history: options.history,
+        approach: options.approach,
+        overrides: {
+            semantic_ranker: options.overrides?.semanticRanker,
+            semantic_captions: options.overrides?.semanticCaptions,
+            top: options.overrides?.top,
+            temperature: options.overrides?.temperature,
+            prompt_template: options.overrides?.promptTemplate,
+            prompt_template_prefix: options.overrides?.promptTemplatePrefix,
+            prompt_template_suffix: options.overrides?.promptTemplateSuffix,
+            exclude_category: options.overrides?.excludeCategory,
+            suggest_followup_questions: options.overrides?.suggestFollowupQuestions
+        }
+    });
+}
 
 export async function askApi(options: AskRequest): Promise<AskResponse> {
     const response = await fetch("/ask", {
@@ -6,20 +41,7 @@ export async function askApi(options: AskRequest): Promise<AskResponse> {
         headers: {
             "Content-Type": "application/json"
         },
-        body: JSON.stringify({
-            question: options.question,
-            approach: options.approach,
-            overrides: {
-                semantic_ranker: options.overrides?.semanticRanker,
-                semantic_captions: options.overrides?.semanticCaptions,
-                top: options.overrides?.top,
-                temperature: options.overrides?.temperature,
-                prompt_template: options.overrides?.promptTemplate,
-                prompt_template_prefix: options.overrides?.promptTemplatePrefix,
-                prompt_template_suffix: options.overrides?.promptTemplateSuffix,
-                exclude_category: options.overrides?.excludeCategory
-            }
-        })
+        body: askRequestBody(options)
     });
 
     const parsedResponse: AskResponse = await response.json();
@@ -36,21 +58,7 @@ export async function chatApi(options: ChatRequest): Promise<AskResponse> {
         headers: {
             "Content-Type": "application/json"
         },
-        body: JSON.stringify({
-            history: options.history,
-            approach: options.approach,
-            overrides: {
-                semantic_ranker: options.overrides?.semanticRanker,
-                semantic_captions: options.overrides?.semanticCaptions,
-                top: options.overrides?.top,
-                temperature: options.overrides?.temperature,
-                prompt_template: options.overrides?.promptTemplate,
-                prompt_template_prefix: options.overrides?.promptTemplatePrefix,
-                prompt_template_suffix: options.overrides?.promptTemplateSuffix,
-                exclude_category: options.overrides?.excludeCategory,
-                suggest_followup_questions: options.overrides?.suggestFollowupQuestions
-            }
-        })
+        body: chatRequestBody(options)
     });
 
     const parsedResponse: AskResponse = await response.json();
@@ -61,6 +69,78 @@ export async function chatApi(options: ChatRequest): Promise<AskResponse> {
     return parsedResponse;
 }
 
+export async function askStreamApi(options: AskRequest, onUpdate: (partial: AskResponse) => void): Promise<AskResponse> {
+    const response = await fetch("/ask_stream", {
+        method: "POST",
+        headers: {
+            "Content-Type": "application/json"
+        },
+        body: askRequestBody(options)
+    });
+
+    return await readResponseStream(response, onUpdate);
+}
+
+export async function chatStreamApi(options: ChatRequest, onUpdate: (partial: AskResponse) => void): Promise<AskResponse> {
+    const response = await fetch("/chat_stream", {
+        method: "POST",
+        headers: {
+            "Content-Type": "application/json"
+        },
+        body: chatRequestBody(options)
+    });
+
+    return await readResponseStream(response, onUpdate);
+}
+
+// The stream is newline delimited JSON: supporting content first, then answer deltas, then the final checked answer
+async function readResponseStream(response: Response, onUpdate: (partial: AskResponse) => void): Promise<AskResponse> {
+    if (response.status > 299 || !response.ok || !response.body) {
+        const parsedResponse: AskResponse = await response.json();
+        throw Error(parsedResponse.error || "Unknown error");
+    }
+
+    const result: AskResponse = { answer: "", thoughts: null, data_points: [] };
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = "";
+    while (true) {
+        const { done, value } = await reader.read();
+        if (done) {
+            break;
+        }
+
+        buffer += decoder.decode(value, { stream: true });
+        const lines = buffer.split("\n");
+        buffer = lines.pop() || "";
+        for (const line of lines) {
+            if (line.trim().length === 0) {
+                continue;
+            }
+
+            const event: AskStreamEvent = JSON.parse(line);
+            if (event.error) {
+                throw Error(event.error);
+            }
+            if (event.data_points !== undefined) {
+                result.data_points = event.data_points;
+            }
+            if (event.thoughts !== undefined) {
+                result.thoughts = event.thoughts;
+            }
+            if (event.delta !== undefined) {
+                result.answer += event.delta;
+            }
+            if (event.answer !== undefined) {
+                result.answer = event.answer;
+            }
+            onUpdate({ ...result });
+        }
+    }
+
+    return result;
+}
+
 export function getCitationFilePath(citation: string): string {
     return `/content/${citation}`;
 }
@@ -29,6 +29,14 @@ export type AskResponse = {
     error?: string;
 };
 
+export type AskStreamEvent = {
+    answer?: string;
+    delta?: string;
+    thoughts?: string | null;
+    data_points?: string[];
+    error?: string;
+};
+
 export type ChatTurn = {
     user: string;
     assistant?: string;
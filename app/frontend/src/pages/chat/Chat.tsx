@@ -4,7 +4,7 @@ import { Logo } from "@dnb/eufemia";
 
 import styles from "./Chat.module.css";
 
-import { chatApi, Approaches, AskResponse, ChatRequest, ChatTurn } from "../../api";
+import { chatStreamApi, Approaches, AskResponse, ChatRequest, ChatTurn } from "../../api";
 import { Answer, AnswerError, AnswerLoading } from "../../components/Answer";
 import { QuestionInput } from "../../components/QuestionInput";
 import { ExampleList } from "../../components/Example";
@@ -59,7 +59,10 @@ const Chat = () => {
                     suggestFollowupQuestions: useSuggestFollowupQuestions
                 }
             };
-            const result = await chatApi(request);
+            const result = await chatStreamApi(request, partial => {
+                setIsLoading(false);
+                setAnswers([...answers, [question, partial]]);
+            });
             setAnswers([...answers, [question, result]]);
         } catch (e) {
             setError(e);
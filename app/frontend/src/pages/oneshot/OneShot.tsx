@@ -3,7 +3,7 @@ import { Checkbox, ChoiceGroup, IChoiceGroupOption, Panel, DefaultButton, Spinne
 
 import styles from "./OneShot.module.css";
 
-import { askApi, Approaches, AskResponse, AskRequest } from "../../api";
+import { askStreamApi, Approaches, AskResponse, AskRequest } from "../../api";
 import { Answer, AnswerError } from "../../components/Answer";
 import { QuestionInput } from "../../components/QuestionInput";
 import { ExampleList } from "../../components/Example";
@@ -52,7 +52,10 @@ const OneShot = () => {
                     semanticCaptions: useSemanticCaptions
                 }
             };
-            const result = await askApi(request);
+            const result = await askStreamApi(request, partial => {
+                setIsLoading(false);
+                setAnswer(partial);
+            });
             setAnswer(result);
         } catch (e) {
             setError(e);
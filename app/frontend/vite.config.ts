@@ -12,7 +12,9 @@ export default defineConfig({
     server: {
         proxy: {
             "/ask": "http://localhost:5000",
-            "/chat": "http://localhost:5000"
+            "/chat": "http://localhost:5000",
+            "/ask_stream": "http://localhost:5000",
+            "/chat_stream": "http://localhost:5000"
         }
     }
 });
@@ -19,6 +19,7 @@ from bs4 import BeautifulSoup
 MAX_SECTION_LENGTH = 1000
 SENTENCE_SEARCH_LIMIT = 100
 SECTION_OVERLAP = 100
+INDEX_VERSION_BLOB = "index-version.txt"
 
 parser = argparse.ArgumentParser(
     description="Prepare documents by extracting content from PDFs, splitting content into sections, uploading to blob storage, and indexing in a search index.",
@@ -104,6 +105,15 @@ def remove_blobs(filename):
             if args.verbose: print(f"\tRemoving blob {b}")
             blob_container.delete_blob(b)
 
+def update_index_version():
+    # The app clears its search result cache when this blob changes, see INDEX_VERSION_BLOB in app.py
+    if args.verbose: print(f"Updating index version in '{INDEX_VERSION_BLOB}'")
+    blob_service = BlobServiceClient(account_url=f"https://{args.storageaccount}.blob.core.windows.net", credential=storage_creds)
+    blob_container = blob_service.get_container_client(args.container)
+    if not blob_container.exists():
+        blob_container.create_container()
+    blob_container.upload_blob(INDEX_VERSION_BLOB, str(time.time()), overwrite=True)
+
 def table_to_html(table):
     table_html = "<table>"
     rows = [sorted([cell for cell in table.cells if cell.row_index == i], key=lambda cell: cell.column_index) for i in range(table.row_count)]
@@ -383,6 +393,8 @@ def remove_from_index(filename):
 if args.removeall:
     remove_blobs(None)
     remove_from_index(None)
+    if not args.skipblobs:
+        update_index_version()
 else:
     if not args.remove:
         create_search_index()
@@ -421,6 +433,11 @@ else:
             sections = create_sections_for_file(os.path.basename(filename), page_map, description)
             index_sections(os.path.basename(filename), sections)
 
+    if not args.skipblobs:
+        update_index_version()
+    else:
+        print(f"Blobs were skipped, so the app only notices changes that alter the number of indexed sections. Upload {INDEX_VERSION_BLOB} to the container to clear its search cache")
+
     # print("Processing urls...")
     # for url in urls:
     #     if args.verbose: print(f"Processing '{url}'")